@@ -0,0 +1,293 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from typing import Callable
+import psycopg2
+
+# Postgres channel notified by every writer of the roman_coins table
+change_channel = 'roman_coins_changes'
+# Coin IDs per notification, keeping payloads well under Postgres' 8000 byte limit
+notify_ids = 100
+
+# The notification format is shared with the scraper's notify_change in 
+# web_scraping/web_scraper.py, which ships in its own image: a JSON object with 
+# 'op' and 'count', plus the 'ids' of up to notify_ids coins when they're known.
+# Both sides have a test pinning it; change them together.
+
+def notify_change(cur, op:str, ids:list[str]):
+    '''Queues change notifications naming the changed coins on the cursor's 
+    transaction; Postgres delivers them to listeners, in commit order, only 
+    when the transaction commits'''
+    ids = list(ids)
+    for start in range(0, len(ids), notify_ids):
+        chunk = ids[start:start + notify_ids]
+        cur.execute('SELECT pg_notify(%s, %s)', 
+                    (change_channel, json.dumps({'op': op, 'count': len(chunk), 'ids': chunk})))
+
+def format_token(modified:datetime, coin_id:str) -> str:
+    '''Returns a resume token for a change event'''
+    return f'{modified.isoformat()}|{coin_id}'
+
+def parse_token(token:str) -> tuple[datetime, str]:
+    '''Returns the (modified, id) position encoded in a resume token'''
+    modified, _, coin_id = token.partition('|')
+    return datetime.fromisoformat(modified), coin_id
+
+def change_event(row:dict) -> dict:
+    '''Returns a change event for a (id, created, modified) row'''
+    return {
+        'id': row['id'],
+        'op': 'insert' if row['created'] == row['modified'] else 'update',
+        'modified': row['modified'].isoformat(),
+        'token': format_token(row['modified'], row['id'])
+    }
+
+class Subscription:
+    '''A subscriber's queue of change events'''
+
+    def __init__(self, maxsize:int):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        # Set when the subscriber fell behind and stopped receiving events
+        self.overflowed = False
+
+class ChangeFeed:
+    '''Fans out roman_coins change notifications to subscribers.
+
+    A single connection LISTENs on the change channel. Notifications are
+    delivered in commit order and name the changed coins, so the feed reads
+    those rows and publishes one event per coin, however long after its
+    modified time the writing transaction committed. Notifications without
+    IDs (from other writers) only say that something changed; on those the
+    feed reads the rows modified since its high-water mark. The mark trails by
+    a lookback window, so rows committed up to lookback seconds out of
+    timestamp order are still picked up, but rows committed later than that
+    are missed. Events already sent are skipped.'''
+
+    page_size = 1000
+
+    def __init__(self, connect:Callable[[], psycopg2.extensions.connection], queue_size:int=1000, 
+                 lookback:float=5.0):
+        self.connect = connect
+        self.queue_size = queue_size
+        self.lookback = timedelta(seconds=lookback)
+        self.subscriptions = set()
+        self.listener = None
+        self.reader = None
+        self.loop = None
+        self.lock = None
+        self.starting = None
+        self.mark = None
+        self.sent = {}
+        self.pending = False
+        self.pending_ids = set()
+        self.scan = False
+
+    async def subscribe(self) -> Subscription:
+        '''Registers a subscriber, starting the listener if needed'''
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Concurrent subscribers wait for one shared start
+            if self.starting is None or self.starting.done() or self.starting.get_loop() is not loop:
+                self.starting = loop.create_task(self.start())
+            await asyncio.shield(self.starting)
+        subscription = Subscription(self.queue_size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription:Subscription):
+        '''Removes a subscriber, stopping the listener after the last one'''
+        self.subscriptions.discard(subscription)
+        if not self.subscriptions:
+            self.close()
+
+    def open(self) -> tuple:
+        '''Returns a listening connection, a reader connection, the high-water 
+        mark and the changes already inside its lookback window'''
+        listener = reader = None
+        try:
+            listener, reader = self.connect(), self.connect()
+            for conn in (listener, reader):
+                conn.set_session(autocommit=True)
+            with reader.cursor() as cur:
+                cur.execute('SELECT max(modified) AS modified FROM roman_coins')
+                mark = cur.fetchone()['modified'] or datetime(1970, 1, 1)
+                # Changes already inside the lookback window predate the feed
+                cur.execute('SELECT id, modified FROM roman_coins WHERE modified > %s', (mark - self.lookback,))
+                sent = {(row['id'], row['modified']): row['modified'] for row in cur.fetchall()}
+            with listener.cursor() as cur:
+                cur.execute(f'LISTEN {change_channel}')
+            return listener, reader, mark, sent
+        except:
+            for conn in (listener, reader):
+                if conn is not None:
+                    conn.close()
+            raise
+
+    async def start(self):
+        '''Connects the feed, run as the self.starting task; it's only published 
+        (loop, reader) once both connections are ready, and abandoned if 
+        closed meanwhile'''
+        self.disconnect()
+        listener, reader, mark, sent = await asyncio.to_thread(self.open)
+        if self.starting is not asyncio.current_task():
+            listener.close()
+            reader.close()
+            raise RuntimeError('Change feed closed while starting')
+        loop = asyncio.get_running_loop()
+        loop.add_reader(listener.fileno(), self.on_notify)
+        self.listener, self.reader, self.mark, self.sent = listener, reader, mark, sent
+        self.lock = asyncio.Lock()
+        self.loop = loop
+
+    def close(self):
+        '''Stops the listener, and any start in progress; safe to call at any
+        time, and more than once'''
+        self.starting = None
+        self.disconnect()
+
+    def disconnect(self):
+        listener, reader, loop = self.listener, self.reader, self.loop
+        self.listener = self.reader = self.loop = None
+        self.sent = {}
+        self.pending_ids = set()
+        self.scan = False
+        if listener is not None and loop is not None:
+            try:
+                loop.remove_reader(listener.fileno())
+            except (RuntimeError, ValueError, psycopg2.InterfaceError):
+                pass
+        for conn in (listener, reader):
+            if conn is not None:
+                conn.close()
+
+    def on_notify(self):
+        '''Event loop reader callback for the listening connection'''
+        try:
+            self.listener.poll()
+        except psycopg2.Error as e:
+            print('Change feed error:', e)
+            self.close()
+            return
+        if self.listener.notifies:
+            for notify in self.listener.notifies:
+                try:
+                    ids = json.loads(notify.payload).get('ids')
+                except (ValueError, AttributeError):
+                    ids = None
+                if isinstance(ids, list):
+                    self.pending_ids.update(ids)
+                else:
+                    self.scan = True
+            self.listener.notifies.clear()
+            if not self.pending:
+                self.pending = True
+                self.loop.create_task(self.catch_up())
+
+    def fetch_since(self, reader:psycopg2.extensions.connection, modified:datetime, 
+                    coin_id:str | None=None) -> list[dict]:
+        '''Returns a page of rows modified after a position, in position order'''
+        with reader.cursor() as cur:
+            if coin_id is None:
+                cur.execute('SELECT id, created, modified FROM roman_coins WHERE modified > %s '
+                            'ORDER BY modified, id LIMIT %s', (modified, self.page_size))
+            else:
+                cur.execute('SELECT id, created, modified FROM roman_coins WHERE (modified, id) > (%s, %s) '
+                            'ORDER BY modified, id LIMIT %s', (modified, coin_id, self.page_size))
+            return cur.fetchall()
+
+    def fetch_ids(self, reader:psycopg2.extensions.connection, ids:list[str]) -> list[dict]:
+        '''Returns the rows of the coins with ids, in position order'''
+        with reader.cursor() as cur:
+            cur.execute('SELECT id, created, modified FROM roman_coins WHERE id = ANY(%s) '
+                        'ORDER BY modified, id', (ids,))
+            return cur.fetchall()
+
+    async def rows_since(self, modified:datetime, coin_id:str | None=None):
+        '''Yields every row modified after a position'''
+        reader, lock = self.reader, self.lock
+        while True:
+            async with lock:
+                rows = await asyncio.to_thread(self.fetch_since, reader, modified, coin_id)
+            for row in rows:
+                yield row
+            if len(rows) < self.page_size:
+                return
+            modified, coin_id = rows[-1]['modified'], rows[-1]['id']
+
+    async def changed_rows(self, ids:list[str], scan:bool):
+        '''Yields the rows of the notified coins, then with scan every row 
+        modified since the high-water mark'''
+        reader, lock = self.reader, self.lock
+        if ids:
+            async with lock:
+                rows = await asyncio.to_thread(self.fetch_ids, reader, ids)
+            for row in rows:
+                yield row
+        if scan and self.reader is reader:
+            async for row in self.rows_since(self.mark - self.lookback):
+                yield row
+
+    async def catch_up(self):
+        '''Publishes an event for every coin notified, or changed since the high-water mark'''
+        self.pending = False
+        ids, scan = list(self.pending_ids), self.scan
+        self.pending_ids, self.scan = set(), False
+        reader = self.reader
+        if reader is None:
+            return
+        try:
+            async for row in self.changed_rows(ids, scan):
+                key = (row['id'], row['modified'])
+                if key in self.sent:
+                    continue
+                self.sent[key] = row['modified']
+                self.mark = max(self.mark, row['modified'])
+                self.publish(change_event(row))
+        except psycopg2.Error as e:
+            print('Change feed error:', e)
+        if self.reader is not reader:
+            # Closed meanwhile
+            return
+        self.sent = {key: modified for key, modified in self.sent.items()
+                     if modified > self.mark - self.lookback}
+
+    def publish(self, event:dict):
+        for subscription in list(self.subscriptions):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+                self.subscriptions.discard(subscription)
+
+    async def events(self, since:str | None=None, timeout:float | None=None, keepalive:float=15.0):
+        '''Yields server-sent event messages: a replay of changes after the
+        resume token, then live changes. Ends after timeout seconds, or when
+        the subscriber falls behind, so the client can resume from its token.'''
+        subscription = await self.subscribe()
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        replayed = set()
+        try:
+            if since:
+                modified, coin_id = parse_token(since)
+                async for row in self.rows_since(modified, coin_id):
+                    replayed.add((row['id'], row['modified'].isoformat()))
+                    yield sse_message(change_event(row))
+            while not (subscription.overflowed and subscription.queue.empty()):
+                wait = keepalive if deadline is None else min(keepalive, deadline - loop.time())
+                if wait <= 0:
+                    return
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), wait)
+                except asyncio.TimeoutError:
+                    if deadline is None or loop.time() < deadline:
+                        yield ': keepalive\n\n'
+                    continue
+                if (event['id'], event['modified']) not in replayed:
+                    yield sse_message(event)
+        finally:
+            self.unsubscribe(subscription)
+
+def sse_message(event:dict) -> str:
+    '''Formats a change event as a server-sent event message'''
+    return f"id: {event['token']}\nevent: change\ndata: {json.dumps(event)}\n\n"
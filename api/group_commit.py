@@ -0,0 +1,151 @@
+import asyncio
+from typing import Callable
+import psycopg2
+from psycopg2.extras import execute_values
+from changes import notify_change
+
+class GroupCommitter:
+    '''Queues single-row inserts from concurrent requests and writes them
+    together as one multi-row INSERT and commit.
+
+    A batch is flushed once it holds max_batch_size rows or its first row has
+    waited max_wait seconds. If the multi-row INSERT fails, the batch is
+    replayed row by row under savepoints in the same transaction, so each
+    caller still gets its own success or failure.'''
+
+    def __init__(self, connect:Callable[[], psycopg2.extensions.connection], table:str,
+                 columns:list[str], max_batch_size:int=100, max_wait:float=0.005):
+        self.connect = connect
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_query = f'INSERT INTO {table} ({", ".join(columns)}) VALUES %s'
+        self.row_query = (f'INSERT INTO {table} ({", ".join(columns)}) '
+                          f'VALUES ({", ".join("%s" for _ in columns)})')
+        # Inserted coins are named in their change notifications
+        self.id_index = columns.index('id')
+        self.conn = None
+        self.queue = None
+        self.worker = None
+        # The (row, future) pairs of the batch being written
+        self.in_flight = []
+        self.stats = {
+            'max_batch_size': max_batch_size,
+            'max_wait_ms': max_wait * 1000,
+            'batches': 0,
+            'rows': 0,
+            'failed_rows': 0,
+            'full_flushes': 0,
+            'timed_flushes': 0,
+            'row_by_row_flushes': 0,
+            'mean_batch_size': 0.0,
+            'total_flush_ms': 0.0
+        }
+
+    async def submit(self, row:tuple):
+        '''Queues a row and waits until its batch is committed. Raises the
+        psycopg2 error for this row if it could not be inserted, or the 
+        error that failed its whole batch. Raises RuntimeError if the committer
+        is closed first.'''
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done() or self.worker.get_loop() is not loop:
+            self.queue = asyncio.Queue()
+            self.worker = loop.create_task(self.run())
+        future = loop.create_future()
+        await self.queue.put((row, future))
+        await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self.in_flight = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            full = len(batch) >= self.max_batch_size
+
+            start = loop.time()
+            try:
+                errors = await asyncio.to_thread(self.flush, [row for row, _ in batch])
+            except Exception as e:
+                # Any error fails only this batch; the connection is dropped 
+                # so the next batch starts on a fresh one
+                self.close_connection()
+                errors = [e] * len(batch)
+            self.record(len(batch), full, errors, loop.time() - start)
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+            self.in_flight = []
+
+    def connection(self) -> psycopg2.extensions.connection:
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+        return self.conn
+
+    def flush(self, rows:list[tuple]) -> list[psycopg2.Error | None]:
+        '''Inserts rows in one transaction; returns an error (or None) per row'''
+        conn = self.connection()
+        try:
+            with conn.cursor() as cur:
+                execute_values(cur, self.batch_query, rows, page_size=len(rows))
+                notify_change(cur, 'insert', [row[self.id_index] for row in rows])
+            conn.commit()
+            return [None] * len(rows)
+        except psycopg2.Error:
+            conn.rollback()
+
+        self.stats['row_by_row_flushes'] += 1
+        errors = []
+        with conn.cursor() as cur:
+            for row in rows:
+                cur.execute('SAVEPOINT group_commit_row')
+                try:
+                    cur.execute(self.row_query, row)
+                    cur.execute('RELEASE SAVEPOINT group_commit_row')
+                    errors.append(None)
+                except psycopg2.Error as e:
+                    cur.execute('ROLLBACK TO SAVEPOINT group_commit_row')
+                    errors.append(e)
+            inserted = [row[self.id_index] for row, error in zip(rows, errors) if error is None]
+            if inserted:
+                notify_change(cur, 'insert', inserted)
+        conn.commit()
+        return errors
+
+    def record(self, size:int, full:bool, errors:list, elapsed:float):
+        '''Updates batching statistics after a flush'''
+        stats = self.stats
+        stats['batches'] += 1
+        stats['rows'] += size
+        stats['failed_rows'] += sum(error is not None for error in errors)
+        stats['full_flushes' if full else 'timed_flushes'] += 1
+        stats['mean_batch_size'] = round(stats['rows'] / stats['batches'], 2)
+        stats['total_flush_ms'] = round(stats['total_flush_ms'] + elapsed * 1000, 3)
+
+    def close_connection(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        '''Stops the worker and fails every row still queued or being written, 
+        so no caller is left waiting; rows being written may still commit'''
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        pending = list(self.in_flight)
+        self.in_flight = []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError('Group committer closed'))
+        self.close_connection()
@@ -1,26 +1,112 @@
-from fastapi import FastAPI, Query, Path, HTTPException, Depends
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, field_validator
-from typing import Annotated
+from fastapi import FastAPI, Query, Path, Body, Header, HTTPException, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, Field, field_validator, ValidationError
+from typing import Annotated, Any
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+import httpx
+import asyncio
+import threading
+import time
 import os
+import json
+import weakref
+from contextlib import asynccontextmanager
 from datetime import datetime
-
-app = FastAPI()
-
-# Database connection manager
-def get_conn():
-    conn = psycopg2.connect(
+from changes import ChangeFeed, notify_change, format_token, parse_token
+from group_commit import GroupCommitter
+from profiling import TimedDictCursor, enable_profiling
+
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    yield
+    change_feed.close()
+    if group_committer:
+        group_committer.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Opt-in request profiling, triggered per request by the X-Profile header
+profiling_enabled = os.getenv('PROFILING', 'false').lower() == 'true'
+if profiling_enabled:
+    enable_profiling(app, 
+                     allowed_clients=set(os.getenv('PROFILING_ALLOWED_CLIENTS', '127.0.0.1').split(',')),
+                     output_dir=os.getenv('PROFILING_OUTPUT_DIR', '/tmp/profiles'))
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    '''Threaded connection pool that waits for a free connection instead of 
+    raising PoolError when all connections are in use. Requests wait for one 
+    on the event loop (see slots), so waiting requests don't hold the worker 
+    threads that the requests holding connections need to finish.'''
+
+    def __init__(self, minconn:int, maxconn:int, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._loop_slots = weakref.WeakKeyDictionary()
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def slots(self) -> asyncio.Semaphore:
+        '''Returns the running event loop's semaphore of free connections'''
+        loop = asyncio.get_running_loop()
+        if loop not in self._loop_slots:
+            self._loop_slots[loop] = asyncio.Semaphore(self.maxconn)
+        return self._loop_slots[loop]
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            return super().getconn(key)
+        except:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+def connect_db() -> psycopg2.extensions.connection:
+    '''Returns a new connection with the coins database'''
+    return psycopg2.connect(**db_params())
+
+def db_params() -> dict:
+    return dict(
         dbname=os.getenv('DB_NAME'), 
         user=os.getenv('DB_USER'), 
         password=os.getenv('DB_PASSWORD'), 
-        host='db', 
-        cursor_factory=RealDictCursor)
-    try:
-        yield conn
-    finally:
-        conn.close()
+        host=os.getenv('DB_HOST', 'db'), 
+        cursor_factory=TimedDictCursor if profiling_enabled else RealDictCursor)
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_pool() -> BlockingConnectionPool:
+    '''Returns the shared connection pool, creating it on first use'''
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = BlockingConnectionPool(
+                int(os.getenv('DB_POOL_MIN', 1)),
+                int(os.getenv('DB_POOL_MAX', 20)),
+                **db_params())
+    return db_pool
+
+# Database connection manager
+async def get_conn():
+    pool = await run_in_threadpool(get_pool)
+    # A free slot is waited for on the event loop, so getconn doesn't block its thread
+    async with pool.slots():
+        taken = []
+        try:
+            # The thread runs to completion even if the request is cancelled meanwhile
+            await run_in_threadpool(lambda: taken.append(pool.getconn()))
+            yield taken[0]
+        finally:
+            if taken:
+                await run_in_threadpool(pool.putconn, taken[0])
 
 # Base root
 @app.get('/')
@@ -45,7 +131,12 @@ async def v1_root() -> JSONResponse:
             '/v1/coins/search': 'Search for coins based on a query. This allows you to find coins by matching against their descriptions or other text attributes.',
             '/v1/coins/id/{coin_id} [POST]': 'Add a new coin to the database. This endpoint is for inserting new coin data into the collection.',
             '/v1/coins/id/{coin_id} [PUT]': 'Fully update an existing coin’s data. This endpoint replaces all data for the specified coin. Unspecified fields in the request are set to their default values or null.',
-            '/v1/coins/id/{coin_id} [PATCH]': 'Partially update an existing coin’s data. Use this endpoint to modify specific fields without affecting the rest of the coin’s data.'
+            '/v1/coins/id/{coin_id} [PATCH]': 'Partially update an existing coin’s data. Use this endpoint to modify specific fields without affecting the rest of the coin’s data.',
+            '/v1/coins/changes': 'Stream coin change events as Server-Sent Events. Each event carries a resume token; reconnect with the Last-Event-ID header (or the since parameter) to replay the changes missed in between.',
+            '/v1/stats/group-commit': 'Batching statistics for group committed coin inserts (enabled with GROUP_COMMIT=true).',
+            '/v1/batch [POST]': 'Run several read requests (coin listings, searches, and lookups by ID) concurrently in one round trip. A status code and body are returned per sub-request.',
+            '/v1/coins/batch [PUT]': 'Fully update many coins in a single transaction. Each item holds a coin ID plus its replacement data; a status is returned per item.',
+            '/v1/coins/batch [PATCH]': 'Partially update many coins in a single transaction. Each item holds a coin ID plus the fields to change; a status is returned per item.'
         }
     })
 
@@ -128,12 +219,13 @@ class Coin(CoinDetails):
         }
     }
 
-# Pagination models
+# Pagination models. Pages read with a cursor have no totals or page number.
 class Pagination(BaseModel):
-    total_items: int
-    total_pages: int
-    current_page: int
+    total_items: int | None = None
+    total_pages: int | None = None
+    current_page: int | None = None
     items_per_page: int
+    next_cursor: str | None = None
 
 class PaginatedResponse(BaseModel):
     data: list[Coin]
@@ -148,7 +240,7 @@ def validate_sort_column(sort_by:str):
 
 # Endpoint for all coins, with sorting and filtering
 @app.get('/v1/coins/', response_model=PaginatedResponse, response_model_exclude_none=True)
-async def read_coins(
+def read_coins(
     db: psycopg2.extensions.connection = Depends(get_conn), 
     page: int = 1, 
     page_size: int = 10, 
@@ -167,8 +259,22 @@ async def read_coins(
     start_created: datetime = None,
     end_created: datetime = None,
     start_modified: datetime = None,
-    end_modified: datetime = None
+    end_modified: datetime = None,
+    cursor: Annotated[str | None, Query(title='next_cursor of the previous page, with sort_by=modified', max_length=100)] = None
     ):
+    '''Sorted by modified, coins are in (modified, id) order and each page has 
+    a next_cursor while more coins follow. Passing it as cursor continues 
+    right after the previous page, however deep, without counting or skipping 
+    rows; a coin modified meanwhile moves to the end rather than shifting the 
+    pages, so none are missed.'''
+    keyset = sort_by is not None and sort_by.lower() == 'modified'
+    if cursor is not None:
+        if not keyset:
+            raise HTTPException(status_code=400, detail='Cursor paging requires sort_by=modified')
+        try:
+            cursor_modified, cursor_id = parse_token(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
 
     if name:
         name = name.title()
@@ -202,43 +308,63 @@ async def read_coins(
     try:
         filter_clauses = [(f'{col} {op} %s', val) for col, op, val in filter_mappings.values() if val is not None]
         conditions, params = [list(a) for a in zip(*filter_clauses)]
-        query += ' WHERE ' + ' AND '.join(conditions)
     except:
         conditions, params = [], []
+
+    # Keyset paging continues after the cursor's (modified, id) position
+    page_conditions, page_params = list(conditions), list(params)
+    if cursor is not None:
+        page_conditions.append(f'(modified, id) {"<" if desc else ">"} (%s, %s)')
+        page_params += [cursor_modified, cursor_id]
+    if page_conditions:
+        query += ' WHERE ' + ' AND '.join(page_conditions)
     
     # Sorting logic
     if sort_by:
         sort_by = validate_sort_column(sort_by)
-        if desc == True:
+        if keyset:
+            # id breaks ties, so the order is total and stable
+            sort_by = 'modified DESC, id DESC' if desc else 'modified, id'
+        elif desc == True:
             sort_by += ' DESC'
         query += f' ORDER BY {sort_by}'
 
     try:
         with db.cursor() as cur:
-            # Count total items
-            count_query = 'SELECT COUNT(*) FROM roman_coins'
-            if conditions:
-                count_query += ' WHERE ' + ' AND '.join(conditions)
+            # Count total items, unless continuing from a cursor
+            if cursor is None:
+                count_query = 'SELECT COUNT(*) FROM roman_coins'
+                if conditions:
+                    count_query += ' WHERE ' + ' AND '.join(conditions)
 
-            cur.execute(count_query, params)
-            total_items = cur.fetchone()['count']
+                cur.execute(count_query, params)
+                total_items = cur.fetchone()['count']
 
-            # Pagination logic
+            # Pagination logic; in keyset order one more row tells whether another page follows
             query += ' LIMIT %s OFFSET %s'
-            params += [page_size, (page - 1) * page_size]
+            page_params += [page_size + 1 if keyset else page_size, 
+                            0 if cursor is not None else (page - 1) * page_size]
 
             # Execute main query
-            cur.execute(query, params)
+            cur.execute(query, page_params)
             coins = cur.fetchall()
+
+        next_cursor = None
+        if keyset and len(coins) > page_size:
+            coins = coins[:page_size]
+            next_cursor = format_token(coins[-1]['modified'], coins[-1]['id'])
         
         # Calculate pagination metadata
-        total_pages = total_items // page_size + (total_items % page_size > 0)
-        pagination = Pagination(
-            total_items=total_items,
-            total_pages=total_pages,
-            current_page=page,
-            items_per_page=page_size
-        )
+        if cursor is None:
+            pagination = Pagination(
+                total_items=total_items,
+                total_pages=total_items // page_size + (total_items % page_size > 0),
+                current_page=page,
+                items_per_page=page_size,
+                next_cursor=next_cursor
+            )
+        else:
+            pagination = Pagination(items_per_page=page_size, next_cursor=next_cursor)
 
         return PaginatedResponse(
             data = [dict(row) for row in coins] if coins else [],
@@ -251,7 +377,7 @@ async def read_coins(
 
 # Coin Search endpoint
 @app.get('/v1/coins/search', response_model=list[Coin], response_model_exclude_none=True)
-async def search_coins(
+def search_coins(
     query: Annotated[str, Query(title='Query string', min_length=3, max_length=50, examples=["crowned by Victory"])], 
     db: psycopg2.extensions.connection = Depends(get_conn)
     ) -> list[Coin]:
@@ -273,7 +399,7 @@ async def search_coins(
 
 # Coins by ID endpoint
 @app.get('/v1/coins/id/{coin_id}', response_model=Coin, response_model_exclude_none=True)
-async def coin_by_id(
+def coin_by_id(
     coin_id: Annotated[str, Path(title='The ID of the coin to be retrieved', 
                                  examples=["64c3075e-2b01-4b09-a4f0-07be61f7f9b7"],
                                  min_length=10, max_length=50)], 
@@ -294,20 +420,51 @@ async def coin_by_id(
     
     raise HTTPException(status_code=404, detail='Coin not found')
     
+# Optional group commit of single-coin inserts
+coin_columns = ['id', 'name', 'name_detail', 'catalog', 'description', 'metal', 'mass', 
+                'diameter', 'era', 'year', 'inscriptions', 'txt', 'created', 'modified']
+
+if os.getenv('GROUP_COMMIT', 'false').lower() == 'true':
+    group_committer = GroupCommitter(
+        connect_db, 'roman_coins', coin_columns,
+        max_batch_size=int(os.getenv('GROUP_COMMIT_MAX_BATCH', 100)),
+        max_wait=float(os.getenv('GROUP_COMMIT_MAX_WAIT_MS', 5)) / 1000)
+else:
+    group_committer = None
+
+def no_conn():
+    return None
+
+# Group committed inserts don't hold a connection per request
+insert_conn = no_conn if group_committer else get_conn
+
+# SQL for adding a Coin to the database
+insert_query = '''
+INSERT INTO roman_coins (id, name, name_detail, catalog, description, metal, mass, diameter, era, year, inscriptions, txt, created, modified)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+def insert_coin(db:psycopg2.extensions.connection, coin_data:tuple):
+    '''Inserts a coin and commits; run in the threadpool'''
+    try:
+        cur = db.cursor()
+        cur.execute(insert_query, coin_data)
+        notify_change(cur, 'insert', [coin_data[0]])
+        db.commit()
+    except psycopg2.Error as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Error inserting coin: {e}")
+    finally:
+        cur.close()
+
 # Add coin endpoint
 @app.post('/v1/coins/id/{coin_id}')
 async def add_coin(
     coin_id:Annotated[str, Path(title='The ID of the coin to be added')], 
     coin_details:CoinDetails, 
-    db: psycopg2.extensions.connection = Depends(get_conn)
+    db: psycopg2.extensions.connection | None = Depends(insert_conn)
     ) -> JSONResponse:
 
-    # SQL for adding a Coin to the database
-    insert_query = '''
-    INSERT INTO roman_coins (id, name, name_detail, catalog, description, metal, mass, diameter, era, year, inscriptions, txt, created, modified)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    '''
-
     current_datetime = datetime.now()
 
     # Data to be inserted
@@ -328,22 +485,22 @@ async def add_coin(
         current_datetime
     )
 
-    # Execute the query
-    try:
-        cur = db.cursor()
-        cur.execute(insert_query, coin_data)
-        db.commit()
-    except psycopg2.Error as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=f"Error inserting coin: {e}")
-    finally:
-        cur.close()
+    # Queue the row for the next group commit
+    if group_committer:
+        try:
+            await group_committer.submit(coin_data)
+        except psycopg2.Error as e:
+            raise HTTPException(status_code=400, detail=f"Error inserting coin: {e}")
+        return JSONResponse(status_code=201, content={"message": "Coin added successfully"})
+
+    # Execute the query off the event loop
+    await run_in_threadpool(insert_coin, db, coin_data)
 
     return JSONResponse(status_code=201, content={"message": "Coin added successfully"})
 
 # Full coin update endpoint
 @app.put("/v1/coins/id/{coin_id}", status_code=200)
-async def update_coin(
+def update_coin(
     coin_id: Annotated[str, Path(title='The ID of the coin to be updated')], 
     coin_update: CoinDetails, 
     db: psycopg2.extensions.connection = Depends(get_conn)
@@ -363,6 +520,8 @@ async def update_coin(
     try:
         cur = db.cursor()
         cur.execute(update_query, values)
+        if cur.rowcount:
+            notify_change(cur, 'update', [coin_id])
         db.commit()
     except psycopg2.Error as e:
         db.rollback()
@@ -374,7 +533,7 @@ async def update_coin(
 
 # Partial coin update endpoint
 @app.patch("/v1/coins/id/{coin_id}")
-async def patch_coin(
+def patch_coin(
     coin_id: Annotated[str, Path(title='The ID of the coin to be updated')], 
     coin_update: CoinDetails, 
     db: psycopg2.extensions.connection = Depends(get_conn)
@@ -395,6 +554,7 @@ async def patch_coin(
         cur.execute(update_query, values)
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Coin not found")
+        notify_change(cur, 'update', [coin_id])
         db.commit()
     except psycopg2.Error as e:
         db.rollback()
@@ -403,3 +563,188 @@ async def patch_coin(
         cur.close()
 
     return JSONResponse(status_code=200, content={"message": "Coin updated successfully"})
+
+# Batch update validation model
+class CoinBatchItem(CoinDetails):
+    id: str = Field(title="The coin's ID", min_length=10, max_length=50)
+
+# Maximum number of items accepted by the batch update endpoints
+batch_max_items = 5000
+
+# SQL types used to cast VALUES rows in batch updates
+coin_column_types = {
+    'name': 'text', 'name_detail': 'text', 'catalog': 'text', 'description': 'text',
+    'metal': 'text', 'mass': 'real', 'diameter': 'real', 'era': 'text',
+    'year': 'integer', 'inscriptions': 'text', 'txt': 'text', 'modified': 'timestamp'
+}
+
+def batch_update(items:list[dict[str, Any]], db:psycopg2.extensions.connection, partial:bool) -> JSONResponse:
+    '''Validates batch items, groups them by changed columns, and runs one 
+    set-based UPDATE per group inside a single transaction'''
+    results = [None] * len(items)
+    groups = {}
+    seen_ids = set()
+    current_datetime = datetime.now()
+
+    for index, item in enumerate(items):
+        try:
+            coin = CoinBatchItem.model_validate(item)
+        except ValidationError as e:
+            results[index] = {'id': item.get('id') if isinstance(item, dict) else None,
+                              'status': 422, 'detail': json.loads(e.json(include_url=False))}
+            continue
+        if coin.id in seen_ids:
+            results[index] = {'id': coin.id, 'status': 400, 'detail': 'Duplicate coin ID in batch'}
+            continue
+        seen_ids.add(coin.id)
+        update_fields = coin.model_dump(exclude_unset=partial, exclude={'id'})
+        if not update_fields:
+            results[index] = {'id': coin.id, 'status': 400, 'detail': 'No fields to update'}
+            continue
+        update_fields['modified'] = current_datetime
+        groups.setdefault(tuple(update_fields.keys()), []).append((index, coin.id, update_fields))
+
+    updated_ids = set()
+    try:
+        with db.cursor() as cur:
+            for columns, group in groups.items():
+                set_clause = ', '.join(f'{col} = v.{col}' for col in columns)
+                template = '(%s, ' + ', '.join(f'%s::{coin_column_types[col]}' for col in columns) + ')'
+                update_query = (f'UPDATE roman_coins AS c SET {set_clause} '
+                                f'FROM (VALUES %s) AS v (id, {", ".join(columns)}) '
+                                'WHERE c.id = v.id RETURNING c.id')
+                rows = [(coin_id, *fields.values()) for _, coin_id, fields in group]
+                updated = execute_values(cur, update_query, rows, template=template, 
+                                         page_size=len(rows), fetch=True)
+                updated_ids.update(row['id'] for row in updated)
+            if updated_ids:
+                notify_change(cur, 'update', sorted(updated_ids))
+        db.commit()
+    except psycopg2.Error as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Error updating coins: {e}")
+
+    for group in groups.values():
+        for index, coin_id, _ in group:
+            if coin_id in updated_ids:
+                results[index] = {'id': coin_id, 'status': 200, 'detail': 'Coin updated successfully'}
+            else:
+                results[index] = {'id': coin_id, 'status': 404, 'detail': 'Coin not found'}
+
+    return JSONResponse(status_code=200, content={
+        'message': 'Batch processed',
+        'updated': len(updated_ids),
+        'results': results
+        })
+
+# Batch full coin update endpoint
+@app.put('/v1/coins/batch')
+def update_coins(
+    items: Annotated[list[dict[str, Any]], Body(min_length=1, max_length=batch_max_items)], 
+    db: psycopg2.extensions.connection = Depends(get_conn)
+    ) -> JSONResponse:
+    '''Updates entire rows for many coins. Missing fields will reset to default values.'''
+    return batch_update(items, db, partial=False)
+
+# Batch partial coin update endpoint
+@app.patch('/v1/coins/batch')
+def patch_coins(
+    items: Annotated[list[dict[str, Any]], Body(min_length=1, max_length=batch_max_items)], 
+    db: psycopg2.extensions.connection = Depends(get_conn)
+    ) -> JSONResponse:
+    return batch_update(items, db, partial=True)
+
+# Multi-query batch models
+batch_read_routes = ('/v1/coins/', '/v1/coins/search', '/v1/coins/id/{coin_id}')
+
+class BatchReadRequest(BaseModel):
+    path: str = Field(title="Path of a read endpoint, e.g. /v1/coins/id/{coin_id}", max_length=200)
+    params: dict[str, Any] = Field(default={}, title="Query parameters for the request")
+
+    @field_validator('path')
+    def validate_path(cls, v):
+        # Only the GET read routes themselves, not the change stream or write routes under them
+        if not any(isinstance(route, APIRoute) and route.path in batch_read_routes 
+                   and 'GET' in route.methods and route.path_regex.match(v) for route in app.routes):
+            raise ValueError('Unsupported batch path')
+        return v
+
+class BatchRead(BaseModel):
+    requests: list[BatchReadRequest] = Field(min_length=1, max_length=50)
+    timeout: float = Field(default=10.0, gt=0, le=30, title="Total time budget for the batch in seconds")
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "requests": [
+                        {"path": "/v1/coins/", "params": {"page": 1, "page_size": 20}},
+                        {"path": "/v1/coins/", "params": {"metal": "Gold", "sort_by": "year"}},
+                        {"path": "/v1/coins/search", "params": {"query": "Victory"}},
+                        {"path": "/v1/coins/id/f351566b-7f7b-4ff6-9d90-aac9a09045db"}
+                    ],
+                    "timeout": 5.0
+                }
+            ]
+        }
+    }
+
+# Multi-query batch endpoint
+@app.post('/v1/batch')
+async def batch_read(batch: BatchRead) -> JSONResponse:
+    '''Runs read sub-requests concurrently against this app, each on its own 
+    pooled connection, and returns the combined results in request order'''
+    start = time.perf_counter()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://batch') as client:
+        tasks = [asyncio.create_task(client.get(item.path, params=item.params)) 
+                 for item in batch.requests]
+        _, pending = await asyncio.wait(tasks, timeout=batch.timeout)
+        for task in pending:
+            task.cancel()
+
+        responses = []
+        for task in tasks:
+            if task in pending:
+                responses.append({'status': 504, 'body': {'detail': 'Batch time budget exceeded'}})
+            elif task.exception():
+                print('Batch error:', task.exception())
+                responses.append({'status': 500, 'body': {'detail': 'Internal Server Error'}})
+            else:
+                response = task.result()
+                responses.append({'status': response.status_code, 'body': response.json()})
+
+    return JSONResponse(content={
+        'responses': responses,
+        'elapsed': round(time.perf_counter() - start, 4)
+        })
+
+# Coin change feed, fed by LISTEN/NOTIFY from the API and the web scraper. Writers 
+# that don't name the changed coins are only caught up to CHANGE_FEED_LOOKBACK 
+# seconds out of modified order.
+change_feed = ChangeFeed(connect_db, lookback=float(os.getenv('CHANGE_FEED_LOOKBACK', 5)))
+
+# Coin change stream endpoint
+@app.get('/v1/coins/changes')
+async def coin_changes(
+    since: Annotated[str | None, Query(title='Resume token of the last event received', max_length=100)] = None,
+    timeout: Annotated[float | None, Query(title='Close the stream after this many seconds', gt=0)] = None,
+    last_event_id: Annotated[str | None, Header(max_length=100)] = None
+    ) -> StreamingResponse:
+    '''Streams coin change events as Server-Sent Events'''
+    token = last_event_id or since
+    if token:
+        try:
+            parse_token(token)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid resume token')
+    return StreamingResponse(change_feed.events(since=token, timeout=timeout), 
+                             media_type='text/event-stream', 
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Group commit statistics endpoint
+@app.get('/v1/stats/group-commit')
+async def group_commit_stats() -> JSONResponse:
+    if not group_committer:
+        return JSONResponse(content={'enabled': False})
+    return JSONResponse(content={'enabled': True, **group_committer.stats})
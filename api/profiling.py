@@ -0,0 +1,266 @@
+'''Opt-in per-request profiling. Nothing here runs unless enable_profiling()
+is called at startup; then requests with an X-Profile header from allow-listed
+clients are sampled (the request's task on the event loop, and the threadpool
+workers while they run its sync code), stored as speedscope profiles, and
+answered with a Server-Timing breakdown.
+
+FastAPI's serialization, JSON rendering and threadpool calls are wrapped
+while any profiled request runs, and restored after the last one. The
+wrapping is process-wide: requests that aren't profiled but run meanwhile
+also go through the wrappers, which only time or trace the profiled ones.'''
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+import anyio.to_thread
+import fastapi.routing
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse
+from psycopg2.extras import RealDictCursor
+
+class Profile:
+    '''Phase timings of a profiled request, and the threadpool workers 
+    running its code at the moment'''
+
+    def __init__(self):
+        self.timings = {}
+        self.threads = set()
+
+# Profile of the request being profiled, if any
+active_profile = ContextVar('active_profile', default=None)
+
+def record_phase(phase:str, start:float):
+    '''Adds the time since start to a phase of the profiled request'''
+    profile = active_profile.get()
+    if profile is not None:
+        profile.timings[phase] = profile.timings.get(phase, 0.0) + time.perf_counter() - start
+
+class TimedDictCursor(RealDictCursor):
+    '''RealDictCursor that records time spent in the database'''
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_phase('db', start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            record_phase('db', start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            record_phase('db', start)
+
+# The wrapped functions, and how many profiled requests are running
+originals = {}
+instrumented = 0
+instrument_lock = threading.Lock()
+
+async def timed_serialize_response(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return await originals['serialize_response'](*args, **kwargs)
+    finally:
+        record_phase('serialize', start)
+
+def timed_render(self, content):
+    start = time.perf_counter()
+    try:
+        return originals['render'](self, content)
+    finally:
+        record_phase('render', start)
+
+async def traced_run_sync(func, *args, **kwargs):
+    '''Runs func in the threadpool, marking its worker as running the 
+    profiled request's code meanwhile'''
+    profile = active_profile.get()
+    if profile is None:
+        return await originals['run_sync'](func, *args, **kwargs)
+
+    def traced(*args):
+        thread_id = threading.get_ident()
+        profile.threads.add(thread_id)
+        try:
+            return func(*args)
+        finally:
+            profile.threads.discard(thread_id)
+    return await originals['run_sync'](traced, *args, **kwargs)
+
+def instrument():
+    '''Wraps FastAPI's response model serialization, JSON rendering and 
+    threadpool calls, unless a profiled request already did'''
+    global instrumented
+    with instrument_lock:
+        instrumented += 1
+        if instrumented > 1:
+            return
+        originals.update(serialize_response=fastapi.routing.serialize_response, 
+                         render=JSONResponse.render, run_sync=anyio.to_thread.run_sync)
+        fastapi.routing.serialize_response = timed_serialize_response
+        JSONResponse.render = timed_render
+        anyio.to_thread.run_sync = traced_run_sync
+
+def uninstrument():
+    '''Restores the wrapped functions once no profiled request is running'''
+    global instrumented
+    with instrument_lock:
+        instrumented -= 1
+        if instrumented > 0:
+            return
+        fastapi.routing.serialize_response = originals['serialize_response']
+        JSONResponse.render = originals['render']
+        anyio.to_thread.run_sync = originals['run_sync']
+
+class Sampler(threading.Thread):
+    '''Samples the stacks of a request at a fixed interval: the event loop 
+    thread while it runs the request's task, and the threadpool workers 
+    while they run the request's code'''
+
+    def __init__(self, profile:Profile, interval:float=0.001):
+        super().__init__(daemon=True)
+        self.profile = profile
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.loop_thread = threading.get_ident()
+        self.samples = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            threads = set(self.profile.threads)
+            if asyncio.current_task(self.loop) is self.task:
+                threads.add(self.loop_thread)
+            frames = sys._current_frames()
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples.setdefault(thread_id, []).append(tuple(reversed(stack)))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def speedscope(self, name:str) -> dict:
+        '''Returns the samples as a speedscope file, with a profile per thread'''
+        frames, frame_index, profiles = [], {}, []
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, stacks in self.samples.items():
+            samples = []
+            for stack in stacks:
+                for frame in stack:
+                    if frame not in frame_index:
+                        frame_index[frame] = len(frames)
+                        frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+                samples.append([frame_index[frame] for frame in stack])
+            profiles.append({
+                'type': 'sampled',
+                'name': thread_names.get(thread_id, str(thread_id)),
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': len(samples) * self.interval,
+                'samples': samples,
+                'weights': [self.interval] * len(samples)
+            })
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'roman-coins-api',
+            'shared': {'frames': frames},
+            'profiles': profiles
+        }
+
+def server_timing(timings:dict, total:float) -> str:
+    '''Formats phase timings (in seconds) as a Server-Timing header value'''
+    phases = {phase: timings.get(phase, 0.0) for phase in ('db', 'serialize', 'render')}
+    phases['other'] = max(total - sum(phases.values()), 0.0)
+    phases['total'] = total
+    return ', '.join(f'{phase};dur={duration * 1000:.3f}' for phase, duration in phases.items())
+
+class ProfilingMiddleware:
+    '''ASGI middleware that profiles requests carrying the X-Profile header
+    from allow-listed clients, and passes every other request straight through'''
+
+    def __init__(self, app, allowed_clients:set[str], output_dir:str, interval:float=0.001):
+        self.app = app
+        self.allowed_clients = allowed_clients
+        self.output_dir = output_dir
+        self.interval = interval
+
+    def triggered(self, scope) -> bool:
+        if scope['type'] != 'http':
+            return False
+        client = scope.get('client')
+        if not client or client[0] not in self.allowed_clients:
+            return False
+        return any(name == b'x-profile' for name, _ in scope['headers'])
+
+    async def __call__(self, scope, receive, send):
+        if not self.triggered(scope):
+            return await self.app(scope, receive, send)
+
+        profile_id = str(uuid.uuid4())
+        profile = Profile()
+        token = active_profile.set(profile)
+        instrument()
+        sampler = Sampler(profile, self.interval)
+        sampler.start()
+        start = time.perf_counter()
+
+        async def send_profiled(message):
+            if message['type'] == 'http.response.start' and not sampler.stopped.is_set():
+                total = time.perf_counter() - start
+                # Building and writing the profile would hold up the event loop
+                await asyncio.to_thread(self.finish, sampler, profile_id, f"{scope['method']} {scope['path']}")
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'server-timing', server_timing(profile.timings, total).encode()),
+                    (b'x-profile-id', profile_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            active_profile.reset(token)
+            if not sampler.stopped.is_set():
+                sampler.stop()
+            uninstrument()
+
+    def finish(self, sampler:Sampler, profile_id:str, name:str):
+        '''Stops the sampler and saves its profile'''
+        sampler.stop()
+        self.save(profile_id, sampler.speedscope(name))
+
+    def save(self, profile_id:str, profile:dict):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, f'{profile_id}.speedscope.json'), 'w') as file:
+            json.dump(profile, file)
+
+def enable_profiling(app:FastAPI, allowed_clients:set[str], output_dir:str):
+    '''Adds the profiling middleware and the stored profile endpoint to app'''
+    app.add_middleware(ProfilingMiddleware, allowed_clients=allowed_clients, output_dir=output_dir)
+
+    @app.get('/v1/profiles/{profile_id}', include_in_schema=False)
+    async def stored_profile(profile_id:uuid.UUID, request:Request) -> FileResponse:
+        path = os.path.join(output_dir, f'{profile_id}.speedscope.json')
+        if request.client is None or request.client.host not in allowed_clients or not os.path.exists(path):
+            raise HTTPException(status_code=404, detail='Profile not found')
+        return FileResponse(path, media_type='application/json')
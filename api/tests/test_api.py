@@ -2,11 +2,20 @@ import os
 import sys
 sys.path.append(os.getcwd()) # Add cwd to path
 from fastapi.testclient import TestClient
-from main import app, get_conn
+import main
+from main import app, get_conn, change_feed, coin_columns
+from changes import notify_change
+from group_commit import GroupCommitter
+from profiling import ProfilingMiddleware, TimedDictCursor
+import fastapi.routing
 import pytest
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import json
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Set up test client
@@ -167,6 +176,61 @@ def test_read_coins(test_client, test_database):
     assert response.status_code == 200
     assert len(response.json()["data"]) == 0
 
+# Cursor paging of all coins in (modified, id) order
+def test_read_coins_cursor(test_client, test_database):
+
+    def read_all(params:str) -> list[dict]:
+        response = test_client.get(f"/v1/coins/?{params}")
+        assert response.status_code == 200
+        pagination = response.json()["pagination"]
+        total_items = pagination["total_items"]
+        coins = response.json()["data"]
+        while "next_cursor" in pagination:
+            response = test_client.get(f"/v1/coins/?{params}", params={"cursor": pagination["next_cursor"]})
+            assert response.status_code == 200
+            pagination = response.json()["pagination"]
+            # Cursor pages aren't counted
+            assert "total_items" not in pagination and "current_page" not in pagination
+            coins += response.json()["data"]
+        assert len(coins) == total_items
+        return coins
+
+    # Coins that share a modified time are ordered by id
+    conn = psycopg2.connect(dbname="test_database", user="postgres", password="postgres",
+                            host="test_db", cursor_factory=RealDictCursor)
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, modified FROM roman_coins ORDER BY id LIMIT 6")
+        originals = cur.fetchall()
+        cur.execute("UPDATE roman_coins SET modified = '2023-12-11 07:30:00' WHERE id = ANY(%s)", 
+                    ([row["id"] for row in originals],))
+        conn.commit()
+    try:
+        coins = read_all("sort_by=modified&page_size=4")
+        assert len(coins) == 20
+        assert [(coin["modified"], coin["id"]) for coin in coins] == sorted((coin["modified"], coin["id"]) for coin in coins)
+        coins = read_all("sort_by=modified&desc=true&page_size=7")
+        assert [(coin["modified"], coin["id"]) for coin in coins] == sorted(((coin["modified"], coin["id"]) for coin in coins), reverse=True)
+        assert len({coin["id"] for coin in coins}) == 20
+
+        # The last page has no cursor, and filters apply across pages
+        response = test_client.get("/v1/coins/?sort_by=modified&page_size=20")
+        assert "next_cursor" not in response.json()["pagination"]
+        filtered = read_all("sort_by=modified&page_size=2&start_modified=2023-12-11T07:30:00")
+        assert [coin["id"] for coin in filtered] == [coin["id"] for coin in reversed(coins) 
+                                                     if coin["modified"] >= "2023-12-11T07:30:00"]
+    finally:
+        with conn.cursor() as cur:
+            for row in originals:
+                cur.execute("UPDATE roman_coins SET modified = %(modified)s WHERE id = %(id)s", row)
+            conn.commit()
+        conn.close()
+
+    # A cursor needs the modified order and must be one the API returned
+    response = test_client.get("/v1/coins/?sort_by=name&cursor=2023-12-11T07:30:00|abc")
+    assert response.status_code == 400
+    response = test_client.get("/v1/coins/?sort_by=modified&cursor=yesterday")
+    assert response.status_code == 400
+
 # Coin Search endpoint
 def test_search_coins(test_client, test_database):
     
@@ -388,4 +452,431 @@ def test_patch_coin(test_client, test_database):
     # Case with missing ID
     coin = {"name":"Test name 2", "catalog":"Test Catalog", "metal":"Gold"}
     response = test_client.patch("/v1/coins/id/", json=coin)
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+# Batch partial coin update endpoint
+def test_patch_coins(test_client, test_database):
+
+    # Normal case, mixed field sets and a missing coin
+    coins = [
+        {"id":"ecb12350-84a2-415e-922f-21ebdb25d40e", "metal":"bronze"},
+        {"id":"e5837a7b-9277-4da2-98ba-5f196bb55b2e", "metal":"bronze"},
+        {"id":"3c6e0ea7-3975-4a73-9ca1-d8fa3ac6b797", "year":380, "era":"ad"},
+        {"id":"no-such-coin-id-0001", "year":380}
+    ]
+    response = test_client.patch("/v1/coins/batch", json=coins)
+    assert response.status_code == 200
+    assert response.json()["updated"] == 3
+    assert [r["status"] for r in response.json()["results"]] == [200, 200, 200, 404]
+    # Verify coins updated in test database
+    response = test_client.get("/v1/coins/id/ecb12350-84a2-415e-922f-21ebdb25d40e")
+    assert response.json()["metal"] == "Bronze"
+    assert response.json()["name"] == "Aelia Flaccilla"
+    modified_at = datetime.strptime(response.json()["modified"], r"%Y-%m-%dT%H:%M:%S.%f")
+    modified_truncated = modified_at.replace(second=0, microsecond=0)
+    current_datetime_truncated = datetime.now().replace(second=0, microsecond=0)
+    assert modified_truncated == current_datetime_truncated
+    response = test_client.get("/v1/coins/id/3c6e0ea7-3975-4a73-9ca1-d8fa3ac6b797")
+    assert response.json()["year"] == 380
+    assert response.json()["era"] == "AD"
+    assert response.json()["metal"] == "Copper"
+
+    # Case with invalid, empty and duplicate items
+    coins = [
+        {"id":"448b0c4d-c23c-4db5-9979-be1ecf1d5ece", "metal":"Aluminum"},
+        {"id":"61a435d4-b63b-4179-b543-76a9b6c8423e"},
+        {"id":"4c767b5c-e394-4135-95df-2a0cd6778100", "mass":3.2},
+        {"id":"4c767b5c-e394-4135-95df-2a0cd6778100", "mass":3.3}
+    ]
+    response = test_client.patch("/v1/coins/batch", json=coins)
+    assert response.status_code == 200
+    assert response.json()["updated"] == 1
+    assert [r["status"] for r in response.json()["results"]] == [422, 400, 200, 400]
+    response = test_client.get("/v1/coins/id/4c767b5c-e394-4135-95df-2a0cd6778100")
+    assert response.json()["mass"] == 3.2
+
+    # Empty batch
+    response = test_client.patch("/v1/coins/batch", json=[])
+    assert response.status_code == 422
+
+# Batch full coin update endpoint
+def test_update_coins(test_client, test_database):
+
+    # Normal case, missing fields reset to null
+    coins = [
+        {"id":"this-is-a-test-id-0001", "name":"Test name 8", "metal":"Gold", "year":100},
+        {"id":"this-is-a-test-id-0002", "name":"Test name 9", "mass":5.5}
+    ]
+    response = test_client.put("/v1/coins/batch", json=coins)
+    assert response.status_code == 200
+    assert response.json()["updated"] == 2
+    response = test_client.get("/v1/coins/id/this-is-a-test-id-0001")
+    assert response.json()["name"] == "Test name 8"
+    assert response.json()["year"] == 100
+    assert "mass" not in response.json().keys()
+    response = test_client.get("/v1/coins/id/this-is-a-test-id-0002")
+    assert response.json()["name"] == "Test name 9"
+    assert response.json()["mass"] == 5.5
+    assert "era" not in response.json().keys()
+
+# Write endpoints run their queries off the event loop
+def test_writes_off_loop(test_client, test_database):
+
+    writes = [
+        ("put", "/v1/coins/batch", [{"id":"this-is-a-test-id-0001", "name":"Test name 8", "metal":"Gold", "year":100}], 200),
+        ("patch", "/v1/coins/batch", [{"id":"this-is-a-test-id-0002", "mass":5.5}], 200),
+        ("put", "/v1/coins/id/this-is-a-test-id-0001", {"name":"Test name 8", "metal":"Gold", "year":100}, 200),
+        ("patch", "/v1/coins/id/this-is-a-test-id-0002", {"mass":5.5}, 200),
+        # Already exists, so it's rejected once the lock is released
+        ("post", "/v1/coins/id/this-is-a-test-id-0001", {"name":"Test name 8"}, 400)
+    ]
+    conn = psycopg2.connect(dbname="test_database", user="postgres", password="postgres", host="test_db")
+    try:
+        for method, path, body, status in writes:
+            # The write waits on the lock, while other requests are still served
+            with conn.cursor() as cur:
+                cur.execute("LOCK TABLE roman_coins IN EXCLUSIVE MODE")
+            with ThreadPoolExecutor(2) as executor:
+                write = executor.submit(getattr(test_client, method), path, json=body)
+                time.sleep(0.2)
+                read = executor.submit(test_client.get, "/")
+                try:
+                    read.result(timeout=0.5)
+                    waiting = not write.done()
+                finally:
+                    conn.rollback()
+                assert waiting
+                assert write.result(timeout=5).status_code == status
+    finally:
+        conn.rollback()
+        conn.close()
+
+# Multi-query batch endpoint
+def test_batch_read(test_client, test_database):
+
+    # Normal case, listings, filtered listings, searches and lookups by ID
+    batch = {"requests":[
+        {"path":"/v1/coins/"},
+        {"path":"/v1/coins/", "params":{"metal":"gold", "max_mass":2}},
+        {"path":"/v1/coins/", "params":{"sort_by":"year", "page_size":5}},
+        {"path":"/v1/coins/search", "params":{"query":["Victory", "officina"]}},
+        {"path":"/v1/coins/id/343a3001-ae2e-4745-888e-994374e398a3"},
+        {"path":"/v1/coins/id/023-450938fgldf-to0r90ftu-438537"},
+        {"path":"/v1/coins/", "params":{"sort_by":"description"}}
+    ]}
+    response = test_client.post("/v1/batch", json=batch)
+    assert response.status_code == 200
+    responses = response.json()["responses"]
+    assert [r["status"] for r in responses] == [200, 200, 200, 200, 200, 404, 400]
+    assert len(responses[0]["body"]["data"]) == 10
+    assert len(responses[1]["body"]["data"]) == 3
+    assert responses[2]["body"]["data"][0]["year"] == 100
+    assert len(responses[3]["body"]) == 2
+    assert responses[4]["body"]["name"] == "Aelia Ariadne"
+    assert responses[5]["body"]["detail"] == "Coin not found"
+
+    # Exhausted time budget
+    batch = {"requests":[{"path":"/v1/coins/"}], "timeout":0.000001}
+    response = test_client.post("/v1/batch", json=batch)
+    assert response.status_code == 200
+    assert response.json()["responses"][0]["status"] == 504
+
+    # Unsupported paths, including the change stream and write routes under /v1/coins/
+    for path in ["/v1/batch", "/v1/coins/changes", "/v1/coins/batch", "/v1/coins/search/more", "/v1/coins"]:
+        response = test_client.post("/v1/batch", json={"requests":[{"path":path}]})
+        assert response.status_code == 422
+
+    # Empty batch
+    response = test_client.post("/v1/batch", json={"requests":[]})
+    assert response.status_code == 422
+
+# Concurrent batches sharing a small connection pool
+def test_batch_read_concurrent(test_client, test_database, monkeypatch):
+    test_env = {"DB_NAME":"test_database", "DB_USER":"postgres", "DB_PASSWORD":"postgres", 
+                "DB_HOST":"test_db", "DB_POOL_MAX":"4"}
+    for name, value in test_env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(main, "db_pool", None)
+    overridden_conn = app.dependency_overrides.pop(get_conn)
+    try:
+        # Far more sub-requests than connections or worker threads
+        batch = {"requests":[{"path":"/v1/coins/"}] * 50, "timeout":5}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(3) as executor:
+            responses = list(executor.map(lambda _: test_client.post("/v1/batch", json=batch), range(3)))
+        assert time.perf_counter() - start < 5
+        for response in responses:
+            assert response.status_code == 200
+            assert [r["status"] for r in response.json()["responses"]] == [200] * 50
+    finally:
+        app.dependency_overrides[get_conn] = overridden_conn
+        if main.db_pool:
+            main.db_pool.closeall()
+
+# Coin change stream endpoint
+def test_coin_changes(test_client, test_database):
+
+    def connect_test_db():
+        return psycopg2.connect(dbname="test_database", user="postgres", password="postgres",
+                                host="test_db", cursor_factory=RealDictCursor)
+    change_feed.connect = connect_test_db
+
+    def change_events(response):
+        return [json.loads(line[len("data: "):]) for line in response.text.splitlines()
+                if line.startswith("data: ")]
+
+    # Replay of changes after a resume token
+    token = f"{datetime.now().isoformat()}|"
+    test_id = "5c4ec1b2-9e0e-45fb-8fcb-1f5d0fa673a6"
+    response = test_client.patch(f"/v1/coins/id/{test_id}", json={"mass":2.5})
+    assert response.status_code == 200
+    response = test_client.get("/v1/coins/changes", params={"since":token, "timeout":0.2})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = change_events(response)
+    assert [(e["id"], e["op"]) for e in events] == [(test_id, "update")]
+
+    # Resuming from the last event replays nothing
+    response = test_client.get("/v1/coins/changes", headers={"Last-Event-ID":events[0]["token"]}, 
+                               params={"timeout":0.2})
+    assert change_events(response) == []
+
+    # Live change notified by another writer
+    def write_change():
+        time.sleep(0.5)
+        conn = connect_test_db()
+        with conn.cursor() as cur:
+            cur.execute("UPDATE roman_coins SET year = 384, modified = %s WHERE id = %s", 
+                        (datetime.now(), "1f0c3d45-3dbc-45c4-937f-758d0687530c"))
+            cur.execute("SELECT pg_notify('roman_coins_changes', '{}')")
+        conn.commit()
+        conn.close()
+    writer = threading.Thread(target=write_change)
+    writer.start()
+    response = test_client.get("/v1/coins/changes", params={"timeout":2})
+    writer.join()
+    events = change_events(response)
+    assert [(e["id"], e["op"]) for e in events] == [("1f0c3d45-3dbc-45c4-937f-758d0687530c", "update")]
+
+    # Invalid resume token
+    response = test_client.get("/v1/coins/changes", params={"since":"yesterday"})
+    assert response.status_code == 400
+
+# Change feed startup, shutdown and late commits
+def test_coin_changes_concurrent(test_client, test_database):
+
+    def connect_test_db():
+        return psycopg2.connect(dbname="test_database", user="postgres", password="postgres",
+                                host="test_db", cursor_factory=RealDictCursor)
+    change_feed.connect = connect_test_db
+    test_id = "1f0c3d45-3dbc-45c4-937f-758d0687530c"
+
+    # Concurrent resumes share one start of the feed
+    async def resume_all():
+        token = f"{datetime.now().isoformat()}|"
+        async def resume():
+            return [message async for message in change_feed.events(since=token, timeout=0.2)]
+        return await asyncio.gather(*[resume() for _ in range(4)], return_exceptions=True)
+    assert asyncio.run(resume_all()) == [[], [], [], []]
+    assert change_feed.listener is None and change_feed.reader is None
+
+    # Closing while the feed starts abandons the start, and closing again is harmless
+    async def close_while_starting():
+        subscribe = asyncio.create_task(change_feed.subscribe())
+        await asyncio.sleep(0)
+        change_feed.close()
+        change_feed.close()
+        with pytest.raises(RuntimeError):
+            await subscribe
+        subscription = await change_feed.subscribe()
+        change_feed.unsubscribe(subscription)
+    asyncio.run(close_while_starting())
+    assert change_feed.listener is None
+
+    # A change committed long after its modified time is still sent, as it's named in the notification
+    def write_late_change():
+        time.sleep(0.5)
+        conn = connect_test_db()
+        with conn.cursor() as cur:
+            cur.execute("UPDATE roman_coins SET year = 385, modified = %s WHERE id = %s",
+                        (datetime(2020, 1, 1), test_id))
+            notify_change(cur, "update", [test_id])
+        conn.commit()
+        conn.close()
+    writer = threading.Thread(target=write_late_change)
+    writer.start()
+    response = test_client.get("/v1/coins/changes", params={"timeout":2})
+    writer.join()
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert [(e["id"], e["modified"]) for e in events] == [(test_id, "2020-01-01T00:00:00")]
+
+# Group commit of single-coin inserts
+def test_notify_change_format():
+    # Pins the payloads the scraper's notify_change also sends (see changes.py)
+    class RecordingCursor:
+        def __init__(self):
+            self.notifications = []
+        def execute(self, query, params):
+            self.notifications.append((params[0], json.loads(params[1])))
+    cur = RecordingCursor()
+    ids = [f"coin-{number}" for number in range(250)]
+    notify_change(cur, "insert", ids)
+    assert cur.notifications == [("roman_coins_changes", {"op":"insert", "count":len(chunk), "ids":chunk})
+                                 for chunk in (ids[:100], ids[100:200], ids[200:])]
+
+def test_group_commit(test_client, test_database):
+
+    def connect_test_db():
+        return psycopg2.connect(dbname="test_database", user="postgres", password="postgres",
+                                host="test_db", cursor_factory=RealDictCursor)
+    committer = GroupCommitter(connect_test_db, "roman_coins", coin_columns, 
+                               max_batch_size=5, max_wait=0.05)
+
+    def coin_row(test_id):
+        now = datetime.now()
+        return (test_id, "Group Commit", None, None, None, "Gold", None, None, None, None, None, None, now, now)
+
+    # Concurrent inserts, including a duplicate within the batch and an existing ID
+    test_ids = [f"group-commit-test-id-{i:04}" for i in range(12)]
+    test_ids += ["group-commit-test-id-0003", "this-is-a-test-id-0001"]
+
+    async def insert_all():
+        results = await asyncio.gather(*[committer.submit(coin_row(test_id)) for test_id in test_ids], 
+                                       return_exceptions=True)
+        committer.close()
+        return results
+    results = asyncio.run(insert_all())
+
+    assert results[:12] == [None] * 12
+    assert all(isinstance(result, psycopg2.IntegrityError) for result in results[12:])
+    assert committer.stats["rows"] == 14
+    assert committer.stats["failed_rows"] == 2
+    assert committer.stats["batches"] == 3
+    assert committer.stats["full_flushes"] == 2
+    assert committer.stats["row_by_row_flushes"] == 1
+    # Verify coins added to test database
+    response = test_client.get("/v1/coins/?name=group%20commit&page_size=20")
+    assert response.json()["pagination"]["total_items"] == 12
+
+    # An error other than psycopg2's fails only its batch; the worker keeps running
+    committer = GroupCommitter(connect_test_db, "roman_coins", coin_columns, max_batch_size=5, max_wait=0.05)
+    flush = committer.flush
+    def failing_flush(rows):
+        committer.flush = flush
+        raise ValueError("Cannot adapt row")
+    committer.flush = failing_flush
+
+    async def insert_after_error():
+        results = await asyncio.gather(*[committer.submit(coin_row(f"group-commit-error-id-{i}")) for i in range(2)],
+                                       return_exceptions=True)
+        results.append(await asyncio.wait_for(committer.submit(coin_row("group-commit-error-id-2")), 5))
+        committer.close()
+        return results
+    results = asyncio.run(insert_after_error())
+    assert [type(result) for result in results] == [ValueError, ValueError, type(None)]
+    assert committer.stats["failed_rows"] == 2
+    response = test_client.get("/v1/coins/id/group-commit-error-id-2")
+    assert response.status_code == 200
+    response = test_client.get("/v1/coins/id/group-commit-error-id-0")
+    assert response.status_code == 404
+
+    # Closing fails the rows being written and those still queued
+    committer = GroupCommitter(connect_test_db, "roman_coins", coin_columns, max_batch_size=2, max_wait=0.01)
+    def slow_flush(rows):
+        time.sleep(0.3)
+        return [None] * len(rows)
+    committer.flush = slow_flush
+
+    async def close_while_pending():
+        submits = [asyncio.ensure_future(committer.submit(coin_row(f"group-commit-close-id-{i}"))) for i in range(5)]
+        await asyncio.sleep(0.1)
+        committer.close()
+        return await asyncio.wait_for(asyncio.gather(*submits, return_exceptions=True), 1)
+    results = asyncio.run(close_while_pending())
+    assert [type(result) for result in results] == [RuntimeError] * 5
+
+    # Statistics endpoint with group commit disabled
+    response = test_client.get("/v1/stats/group-commit")
+    assert response.status_code == 200
+    assert response.json() == {"enabled": False}
+
+# Per-request profiling
+def test_profiling(test_database, tmp_path):
+
+    def get_timed_conn():
+        conn = psycopg2.connect(dbname="test_database", user="postgres", password="postgres",
+                                host="test_db", cursor_factory=TimedDictCursor)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    overridden_conn = app.dependency_overrides[get_conn]
+    app.dependency_overrides[get_conn] = get_timed_conn
+    serialize_response = fastapi.routing.serialize_response
+    profiled_app = ProfilingMiddleware(app, allowed_clients={"10.0.0.1"}, output_dir=str(tmp_path))
+    saved_on_loop = []
+    save = profiled_app.save
+    def save_off_loop(profile_id, profile):
+        try:
+            asyncio.get_running_loop()
+            saved_on_loop.append(profile_id)
+        except RuntimeError:
+            pass
+        save(profile_id, profile)
+    profiled_app.save = save_off_loop
+
+    async def client_app(scope, receive, send):
+        # TestClient requests carry no client address
+        await profiled_app(dict(scope, client=("10.0.0.1", 50000)), receive, send)
+
+    try:
+        with TestClient(client_app) as client:
+            # Profiled request
+            response = client.get("/v1/coins/?sort_by=year", headers={"X-Profile":"1"})
+            assert response.status_code == 200
+            assert len(response.json()["data"]) == 10
+            timings = dict(item.split(";dur=") for item in response.headers["server-timing"].split(", "))
+            assert set(timings) == {"db", "serialize", "render", "other", "total"}
+            assert float(timings["db"]) > 0
+            assert float(timings["serialize"]) > 0
+            assert float(timings["total"]) >= float(timings["db"])
+            with open(tmp_path / f"{response.headers['x-profile-id']}.speedscope.json") as file:
+                profile = json.load(file)
+            assert profile["shared"]["frames"]
+            assert all(p["type"] == "sampled" for p in profile["profiles"])
+            # Serialization is only wrapped while a profiled request runs
+            assert fastapi.routing.serialize_response is serialize_response
+            # The profile is built and written off the event loop
+            assert not saved_on_loop
+
+            # Other threads busy meanwhile aren't sampled, only the request's own code
+            stop = threading.Event()
+            def unrelated_step():
+                return sum(range(100))
+            def unrelated_work():
+                while not stop.is_set():
+                    unrelated_step()
+            busy = threading.Thread(target=unrelated_work)
+            busy.start()
+            try:
+                response = client.get("/v1/coins/?sort_by=year", headers={"X-Profile":"1"})
+            finally:
+                stop.set()
+                busy.join()
+            with open(tmp_path / f"{response.headers['x-profile-id']}.speedscope.json") as file:
+                profile = json.load(file)
+            names = {frame["name"] for frame in profile["shared"]["frames"]}
+            assert not names & {"unrelated_work", "unrelated_step"}
+
+            # Requests without the header are not profiled
+            response = client.get("/v1/coins/")
+            assert response.status_code == 200
+            assert "server-timing" not in response.headers
+
+        # Requests from clients outside the allow list are not profiled
+        profiled_app.allowed_clients = {"127.0.0.1"}
+        with TestClient(client_app) as client:
+            response = client.get("/v1/coins/", headers={"X-Profile":"1"})
+            assert "server-timing" not in response.headers
+    finally:
+        app.dependency_overrides[get_conn] = overridden_conn
@@ -0,0 +1,265 @@
+'''Times the connector's record path against a local stub of the coin API.
+
+The stub serves recorded pages of coins: a file of /v1/coins responses, one
+per line, either recorded from a running API with --record or made up of
+synthetic coins. It runs in its own process and answers the requests the
+stream makes (counts, the latest coin, and modified-ordered pages by number
+or cursor) from the recorded coins, so the connector's CPU time is measured
+apart from the server's. Besides the full stream read, it times decoding a
+page the old way (json, once for the records and once for the pagination)
+against decode(), and strptime against parse_timestamp. Results can be
+written as JSON and compared against an earlier run's.
+
+Run from the custom-airbyte-connector directory:
+    python benchmarks/bench_connector.py --record http://localhost:8010/v1/ --pages pages.jsonl
+    python benchmarks/bench_connector.py --pages pages.jsonl --output bench.json
+    python benchmarks/bench_connector.py --records 20000 --compare bench.json'''
+import argparse
+import bisect
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import orjson
+import requests
+sys.path.append(os.getcwd())
+from airbyte_cdk.models import SyncMode
+from source_roman_coin_api.source import RomanCoinApiStream, cursor_format, decode, parse_timestamp
+
+page_size = 100
+
+def record_pages(url:str, path:str) -> int:
+    '''Writes every page of coins the API at url serves, in modified order, to path'''
+    params = {'page_size': page_size, 'sort_by': 'modified', 'page': 1}
+    pages = 0
+    with requests.Session() as session, open(path, 'wb') as output:
+        while True:
+            response = session.get(url + 'coins/', params=params, timeout=60)
+            response.raise_for_status()
+            output.write(response.content.strip() + b'\n')
+            pages += 1
+            next_cursor = response.json()['pagination'].get('next_cursor')
+            if not next_cursor:
+                return pages
+            params = {'page_size': page_size, 'sort_by': 'modified', 'cursor': next_cursor}
+
+def padded(timestamp:str) -> str:
+    '''Returns an isoformat timestamp with microseconds, which it leaves out when they're 0'''
+    return timestamp if '.' in timestamp else timestamp + '.000000'
+
+def synthetic_pages(records:int, seed:int=0) -> list[bytes]:
+    '''Returns pages of made-up coins shaped like the API's, some sharing a modified time'''
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    coins = []
+    for number in range(records):
+        modified = start + datetime.timedelta(seconds=rng.randrange(86400 * 90), microseconds=rng.randrange(10**6))
+        if number % 8 == 0:
+            # Bulk loads give many coins the same modified time
+            modified = start + datetime.timedelta(days=number % 90)
+        coins.append({'id': f'{rng.getrandbits(128):032x}', 'name': 'Trajan', 'name_detail': 'AD 98-117',
+                      'catalog': f'RIC {number}', 'description': 'Laureate head right / Victory standing left',
+                      'metal': rng.choice(['Gold', 'Silver', 'Bronze']), 'mass': round(rng.uniform(1, 30), 2),
+                      'diameter': round(rng.uniform(10, 40), 1), 'era': 'AD', 'year': rng.randrange(98, 118),
+                      'inscriptions': 'IMP CAES NERVA TRAIAN AVG GERM', 'txt': f'https://example.com/{number}.txt',
+                      'created': start.isoformat(), 'modified': modified.isoformat()})
+    coins.sort(key=lambda coin: (padded(coin['modified']), coin['id']))
+    return [orjson.dumps({'data': coins[offset:offset + page_size],
+                          'pagination': {'total_items': records, 'items_per_page': page_size}})
+            for offset in range(0, records, page_size)]
+
+def load_pages(path:str) -> list[bytes]:
+    with open(path, 'rb') as pages:
+        return [line for line in pages if line.strip()]
+
+class StubApi(BaseHTTPRequestHandler):
+    '''Answers /v1/coins/ requests from the recorded coins, held in (modified, id) order'''
+    keys = []
+    bodies = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        size = int(query.get('page_size', 10))
+        # Timestamps padded to microseconds compare in time order as strings
+        low = bisect.bisect_left(self.keys, (query['start_modified'], '')) if 'start_modified' in query else 0
+        high = bisect.bisect_right(self.keys, (query['end_modified'] + '~', '')) if 'end_modified' in query else len(self.keys)
+        pagination = {'items_per_page': size}
+        if query.get('desc') == 'true':
+            rows = self.bodies[max(high - size, low):high][::-1]
+        elif 'cursor' in query:
+            modified, _, coin_id = query['cursor'].partition('|')
+            first = max(bisect.bisect_right(self.keys, (padded(modified), coin_id)), low)
+            rows = self.bodies[first:min(first + size, high)]
+        else:
+            page = int(query.get('page', 1))
+            first = low + (page - 1) * size
+            rows = self.bodies[first:min(first + size, high)]
+            pagination.update(total_items=high - low, total_pages=-(-(high - low) // size), current_page=page)
+        if query.get('desc') != 'true' and query.get('sort_by') == 'modified' and first + size < high:
+            pagination['next_cursor'] = '|'.join(self.keys[first + size - 1])
+        body = b'{"data":[' + b','.join(rows) + b'],"pagination":' + orjson.dumps(pagination) + b'}'
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(pages:list[bytes], port:int):
+    coins = sorted((coin for page in pages for coin in orjson.loads(page)['data']),
+                   key=lambda coin: (padded(coin['modified']), coin['id']))
+    StubApi.keys = [(padded(coin['modified']), coin['id']) for coin in coins]
+    StubApi.bodies = [orjson.dumps(coin) for coin in coins]
+    ThreadingHTTPServer(('127.0.0.1', port), StubApi).serve_forever()
+
+def start_stub(pages:list[bytes], port:int) -> multiprocessing.Process:
+    stub = multiprocessing.Process(target=serve, args=(pages, port), daemon=True)
+    stub.start()
+    for _ in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/v1/coins/', params={'page_size': 1}, timeout=1)
+            return stub
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Stub API did not start on port {port}')
+
+def timed(function, repeat:int) -> list[float]:
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_decode(pages:list[bytes], repeat:int) -> list[dict]:
+    responses = []
+    for page in pages:
+        response = requests.Response()
+        response._content = page
+        response.encoding = 'utf-8'
+        responses.append(response)
+    records = sum(len(orjson.loads(page)['data']) for page in pages)
+
+    def json_twice():
+        for response in responses:
+            list(response.json().get('data', []))
+            response.json().get('pagination', {})
+
+    def decode_once():
+        for response in responses:
+            response._decoded = None
+            decode(response).get('data', [])
+            decode(response).get('pagination', {})
+
+    timestamps = [coin['modified'] for page in pages for coin in orjson.loads(page)['data']]
+    # strptime's format requires the microseconds
+    with_microseconds = [padded(value) for value in timestamps]
+    benchmarks = {('decode_page', 'json_twice'): json_twice, ('decode_page', 'decode_once'): decode_once,
+                  ('parse_timestamp', 'strptime'): lambda: [datetime.datetime.strptime(value, cursor_format) for value in with_microseconds],
+                  ('parse_timestamp', 'fromisoformat'): lambda: [parse_timestamp(value) for value in timestamps]}
+    results = []
+    for (name, variant), function in benchmarks.items():
+        times = timed(function, repeat)
+        results.append({'benchmark': name, 'variant': variant, 'records': records, 'repeat': repeat,
+                        'min_ms': min(times) * 1000, 'median_ms': statistics.median(times) * 1000,
+                        'per_record_us': min(times) / max(records, 1) * 1e6})
+    return results
+
+def read_stream(port:int, parallelism:int, slice_records:int) -> int:
+    stream = RomanCoinApiStream({'start_date': '2000-01-01', 'parallelism': parallelism, 'slice_records': slice_records})
+    stream.url_base = f'http://127.0.0.1:{port}/v1/'
+    records = 0
+    for stream_slice in stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={}):
+        for _ in stream.read_records(SyncMode.incremental, stream_slice=stream_slice, stream_state={}):
+            records += 1
+    return records
+
+def bench_read(port:int, parallelism:int, slice_records:int, repeat:int) -> list[dict]:
+    read_stream(port, parallelism, slice_records)
+    walls, cpus = [], []
+    for _ in range(repeat):
+        start, cpu = time.perf_counter(), time.process_time()
+        records = read_stream(port, parallelism, slice_records)
+        walls.append(time.perf_counter() - start)
+        cpus.append(time.process_time() - cpu)
+    return [{'benchmark': 'read_stream', 'variant': f'parallelism {parallelism}', 'records': records,
+             'repeat': repeat, 'min_ms': min(walls) * 1000, 'median_ms': statistics.median(walls) * 1000,
+             'per_record_us': min(cpus) / max(records, 1) * 1e6, 'records_per_second': records / min(walls)}]
+
+def environment() -> dict:
+    import airbyte_cdk
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'airbyte_cdk': getattr(airbyte_cdk, '__version__', None), 'orjson': orjson.__version__,
+            'cpus': os.cpu_count(), 'run_at': datetime.datetime.now().isoformat(timespec='seconds')}
+
+def result_key(result:dict) -> tuple:
+    return result['benchmark'], result['variant'], result['records']
+
+def compare(results:list[dict], baseline:list[dict]):
+    '''Prints each result against the same benchmark in baseline'''
+    previous = {result_key(result): result for result in baseline}
+    print(f'{"benchmark":<16} {"variant":>14} {"records":>8} {"baseline":>12} {"now":>12} {"ratio":>7}')
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old:
+            continue
+        ratio = result['min_ms'] / old['min_ms'] if old['min_ms'] else float('nan')
+        print(f'{result["benchmark"]:<16} {result["variant"]:>14} {result["records"]:>8} '
+              f'{old["min_ms"]:>12.3f} {result["min_ms"]:>12.3f} {ratio:>6.2f}x')
+
+def report(results:list[dict]):
+    for result in results:
+        line = f'{result["benchmark"]:<16} {result["variant"]:>14} {result["records"]:>8} records ' \
+               f'{result["min_ms"]:10.2f} ms min {result["median_ms"]:10.2f} ms median ' \
+               f'{result["per_record_us"]:8.2f} us/record'
+        if 'records_per_second' in result:
+            line += f' (CPU), {result["records_per_second"]:.0f} records/s'
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--record', metavar='URL', help='record the pages of the API at this base url (.../v1/) to --pages')
+    parser.add_argument('--pages', help='file of recorded pages, one response per line')
+    parser.add_argument('--records', type=int, default=20000, help='synthetic coins, without --pages')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic coins')
+    parser.add_argument('--parallelism', type=int, nargs='+', default=[1, 4], help='slices read at a time')
+    parser.add_argument('--slice-records', type=int, default=5000, help='coins per slice')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--port', type=int, default=8019, help='port of the stub API')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.pages:
+            parser.error('--record needs --pages to write to')
+        print(f'Recorded {record_pages(args.record, args.pages)} pages to {args.pages}')
+        return
+    pages = load_pages(args.pages) if args.pages else synthetic_pages(args.records, args.seed)
+    results = bench_decode(pages, args.repeat)
+    stub = start_stub(pages, args.port)
+    try:
+        for parallelism in args.parallelism:
+            results.extend(bench_read(args.port, parallelism, args.slice_records, args.repeat))
+    finally:
+        stub.terminate()
+    report(results)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline)['results'])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'environment': environment(), 'args': vars(args), 'results': results}, output, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,37 @@
 # Copyright (c) 2023 Airbyte, Inc., all rights reserved.
 #
 import os
+import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Iterable, List, Mapping, MutableMapping, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Mapping, MutableMapping, Optional, Tuple
+import orjson
 import requests
+from airbyte_cdk.models import SyncMode
 from airbyte_cdk.sources import AbstractSource
 from airbyte_cdk.sources.streams import Stream, IncrementalMixin
 from airbyte_cdk.sources.streams.http import HttpStream
+from airbyte_cdk.sources.streams.http.exceptions import DefaultBackoffException, UserDefinedBackoffException
+from airbyte_cdk.sources.streams.http.rate_limiting import default_backoff_handler, user_defined_backoff_handler
 # from airbyte_cdk.sources.streams.http.auth import TokenAuthenticator # Authentication not currently implemented
 
 url_base = f'{os.getenv("HOST", "http://host.docker.internal")}:8010/v1/'
+cursor_format = "%Y-%m-%dT%H:%M:%S.%f"
 
-# Incremental stream
+def decode(response:requests.Response) -> Mapping[str, Any]:
+    '''Returns the response's JSON, decoded once however often it's asked for'''
+    decoded = getattr(response, "_decoded", None)
+    if decoded is None:
+        decoded = response._decoded = orjson.loads(response.content)
+    return decoded
+
+def parse_timestamp(value:str) -> datetime:
+    '''Parses a cursor_format timestamp, or one the API wrote without microseconds. 
+    The format is fixed, so fromisoformat's C parser can read it instead of strptime's.'''
+    return datetime.fromisoformat(value)
+
+# Incremental stream, read in slices of modified time that are fetched concurrently
 class RomanCoinApiStream(HttpStream, IncrementalMixin):
 
     # Save the state every 100 records
@@ -21,11 +41,21 @@ class RomanCoinApiStream(HttpStream, IncrementalMixin):
     url_base = url_base
     cursor_field = "modified"
     primary_key = "id"
+    page_size = 100
+    # Windows aren't split below this, however many coins they hold
+    min_slice = timedelta(seconds=1)
 
     def __init__(self, config:Mapping[str, Any], **kwargs):
         super().__init__()
         self.start_date = datetime.strptime(config["start_date"], '%Y-%m-%d')
-        self._cursor_value = datetime.strptime(self.start_date, "%Y-%m-%dT%H:%M:%S.%f") if isinstance(self.start_date, str) else self.start_date
+        self._cursor_value = parse_timestamp(self.start_date) if isinstance(self.start_date, str) else self.start_date
+        self.parallelism = config.get("parallelism", 4)
+        self.slice_records = config.get("slice_records", 5000)
+        self._slices: List[Mapping[str, Any]] = []
+        self._prefetched: Dict[str, Future] = {}
+        self._pool: Optional[ThreadPoolExecutor] = None
+        # Set when the pool is shut down, so running fetches stop after their current page
+        self._stopping = threading.Event()
     
     @property
     def state(self) -> Mapping[str, Any]:
@@ -33,14 +63,123 @@ class RomanCoinApiStream(HttpStream, IncrementalMixin):
     
     @state.setter
     def state(self, value: Mapping[str, Any]):
-        self._cursor_value = datetime.strptime(value[self.cursor_field], "%Y-%m-%dT%H:%M:%S.%f")
+        # The first sync starts without a state
+        if value and value.get(self.cursor_field):
+            self._cursor_value = parse_timestamp(value[self.cursor_field])
 
     def path(self, stream_state: Mapping[str, Any] = None, stream_slice: Mapping[str, Any] = None, next_page_token: Mapping[str, Any] = None) -> str:
         return "coins/"
     
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.parallelism)
+            self._stopping = threading.Event()
+        return self._pool
+
+    def close_pool(self):
+        '''Shuts the fetch pool down, cancelling the prefetches not yet started'''
+        if self._pool is not None:
+            self._stopping.set()
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self._prefetched.clear()
+
+    def get(self, session:requests.Session, params:Mapping[str, Any]) -> requests.Response:
+        '''Requests a page of coins, retrying failures with the CDK's backoff handlers 
+        and the stream's should_retry, backoff_time, max_retries, max_time and 
+        retry_factor, as HttpStream's own requests do. Slices are fetched on several 
+        threads, so the request is sent on the caller's session rather than through 
+        HttpStream._send_request, which shares one session across the stream.'''
+        def send(request:requests.PreparedRequest, request_kwargs:Mapping[str, Any]) -> requests.Response:
+            response = session.send(request, **request_kwargs)
+            if self.should_retry(response):
+                backoff = self.backoff_time(response)
+                if backoff:
+                    raise UserDefinedBackoffException(backoff=backoff, request=request, response=response, 
+                                                      error_message=self.error_message(response))
+                raise DefaultBackoffException(request=request, response=response, error_message=self.error_message(response))
+            response.raise_for_status()
+            return response
+        max_tries = None if self.max_retries is None else max(0, self.max_retries) + 1
+        send = user_defined_backoff_handler(max_tries=max_tries, max_time=self.max_time)(send)
+        send = default_backoff_handler(max_tries=max_tries, max_time=self.max_time, factor=self.retry_factor)(send)
+        request = session.prepare_request(requests.Request("GET", self.url_base + self.path(), params=params))
+        return send(request, {"timeout": 60})
+
+    def count(self, start:datetime, end:datetime) -> int:
+        '''Returns how many coins were modified between start and end, inclusive'''
+        with requests.Session() as session:
+            response = self.get(session, {"page": 1, "page_size": 1, 
+                                          "start_modified": start.strftime(cursor_format), 
+                                          "end_modified": end.strftime(cursor_format)})
+        return decode(response)["pagination"]["total_items"]
+
+    def latest(self, start:datetime) -> Optional[datetime]:
+        '''Returns the last modified time of the coins modified since start'''
+        with requests.Session() as session:
+            response = self.get(session, {"page": 1, "page_size": 1, "sort_by": "modified", "desc": "true", 
+                                          "start_modified": start.strftime(cursor_format)})
+        data = decode(response).get("data")
+        return parse_timestamp(data[0][self.cursor_field]) if data else None
+
+    def plan_slices(self, start:datetime, end:datetime) -> List[Mapping[str, Any]]:
+        '''Splits start to end into windows of at most about slice_records coins. 
+        Windows are counted concurrently, and those holding too many coins are 
+        split in proportion to their count until they fit; empty ones are dropped.'''
+        slices = []
+        windows = [(start, end)]
+        while windows:
+            counts = list(self.pool.map(lambda window: self.count(*window), windows))
+            split = []
+            for (low, high), count in zip(windows, counts):
+                if not count:
+                    continue
+                if count <= self.slice_records or high - low <= self.min_slice:
+                    slices.append({"start_modified": low.strftime(cursor_format), 
+                                   "end_modified": high.strftime(cursor_format), "records": count})
+                    continue
+                parts = min(math.ceil(count / self.slice_records), 16)
+                width = (high - low) / parts
+                bounds = [low + width * part for part in range(parts)] + [high + timedelta(microseconds=1)]
+                split += [(bounds[part], bounds[part + 1] - timedelta(microseconds=1)) for part in range(parts)]
+            windows = split
+        return sorted(slices, key=lambda stream_slice: stream_slice["start_modified"])
+
+    def stream_slices(self, sync_mode: SyncMode, cursor_field: List[str] = None, stream_state: Mapping[str, Any] = None) -> Iterable[Optional[Mapping[str, Any]]]:
+        start = self.start_date
+        if sync_mode == SyncMode.incremental and stream_state and stream_state.get(self.cursor_field):
+            synced = parse_timestamp(stream_state[self.cursor_field])
+            if synced > start:
+                start = synced + timedelta(microseconds=1)
+        end = self.latest(start)
+        self._slices = self.plan_slices(start, end) if end else []
+        self.logger.info(f"Reading {sum(stream_slice['records'] for stream_slice in self._slices)} coins modified "
+                         f"since {start} in {len(self._slices)} slices, {self.parallelism} at a time")
+        return self._slices
+
+    def fetch_slice(self, stream_slice:Mapping[str, Any], stream_state:Mapping[str, Any]) -> List[Mapping[str, Any]]:
+        '''Returns the coins of a slice, requesting its pages in order. Stops early, 
+        with the coins fetched so far, once the pool is shut down.'''
+        records = []
+        next_page_token = None
+        stopping = self._stopping
+        with requests.Session() as session:
+            while not stopping.is_set():
+                response = self.get(session, self.request_params(stream_state, stream_slice, next_page_token))
+                records.extend(self.parse_response(response, stream_state=stream_state, stream_slice=stream_slice, 
+                                                   next_page_token=next_page_token))
+                next_page_token = self.next_page_token(response)
+                if not next_page_token:
+                    return records
+        return records
+
     def next_page_token(self, response: requests.Response) -> Optional[Mapping[str, Any]]:
-        json_response = response.json()
-        pagination_info = json_response.get("pagination", {})
+        pagination_info = decode(response).get("pagination", {})
+        # The API continues from a (modified, id) cursor where it supports it, 
+        # and otherwise by page number; cursor pages have no page number
+        if "next_cursor" in pagination_info:
+            return {"cursor": pagination_info["next_cursor"]}
         current_page = pagination_info.get("current_page")
         total_pages = pagination_info.get("total_pages")
 
@@ -50,26 +189,44 @@ class RomanCoinApiStream(HttpStream, IncrementalMixin):
             return None
 
     def parse_response(self, response: requests.Response, stream_state: Mapping[str, Any], stream_slice: Mapping[str, Any] = None, next_page_token: Mapping[str, Any] = None) -> Iterable[Mapping]:
-        json_response = response.json()
-        records = json_response.get('data', []) 
-        for record in records:
-            yield record
-
-    def read_records(self, *args, **kwargs) -> Iterable[Mapping[str, Any]]:
-        for record in super().read_records(*args, **kwargs):
-            record_cursor_value = datetime.strptime(record[self.cursor_field], "%Y-%m-%dT%H:%M:%S.%f")
-            if record_cursor_value > self._cursor_value:
-                yield record
-                self._cursor_value = record_cursor_value
+        # The decoded records are passed on as they are, without a generator step per record
+        return decode(response).get('data', [])
+
+    def read_records(self, sync_mode: SyncMode, cursor_field: List[str] = None, stream_slice: Mapping[str, Any] = None, stream_state: Mapping[str, Any] = None) -> Iterable[Mapping[str, Any]]:
+        if not stream_slice:
+            yield from super().read_records(sync_mode, cursor_field, stream_slice, stream_state)
+            return
+        # Slices are read in order while the next ones are fetched in the background
+        index = next(i for i, planned in enumerate(self._slices) if planned["start_modified"] == stream_slice["start_modified"])
+        more = False
+        try:
+            for upcoming in self._slices[index:index + self.parallelism]:
+                if upcoming["start_modified"] not in self._prefetched:
+                    self._prefetched[upcoming["start_modified"]] = self.pool.submit(self.fetch_slice, upcoming, stream_state)
+            yield from self._prefetched.pop(stream_slice["start_modified"]).result()
+            # Every earlier slice is complete, so the state is the low-water mark up to this one's end
+            self._cursor_value = max(self._cursor_value, parse_timestamp(stream_slice["end_modified"]))
+            more = index < len(self._slices) - 1
+        finally:
+            # The pool is kept for the next slice only when this one was read in full; 
+            # after the last slice, a failure or an interrupted read, it's shut down
+            if not more:
+                self.close_pool()
 
     def request_params(self, stream_state: Mapping[str, Any], stream_slice: Mapping[str, Any] = None, next_page_token: Mapping[str, Any] = None) -> MutableMapping[str, Any]:
         params = {
-            "page": next_page_token["page"] if next_page_token else 1,
-            "page_size": 100,
+            "page_size": self.page_size,
             "sort_by": "modified"
         }
-        if stream_state:
-            last_synced_time = datetime.strptime(stream_state[self.cursor_field], "%Y-%m-%dT%H:%M:%S.%f")
+        if next_page_token and "cursor" in next_page_token:
+            params["cursor"] = next_page_token["cursor"]
+        else:
+            params["page"] = next_page_token["page"] if next_page_token else 1
+        if stream_slice:
+            params["start_modified"] = stream_slice["start_modified"]
+            params["end_modified"] = stream_slice["end_modified"]
+        elif stream_state:
+            last_synced_time = parse_timestamp(stream_state[self.cursor_field])
             next_start_time = last_synced_time + timedelta(microseconds=1)
             params["start_modified"] = next_start_time.strftime("%Y-%m-%dT%H:%M:%S.%f")
         else:
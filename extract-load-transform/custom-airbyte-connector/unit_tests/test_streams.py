@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2023 Airbyte, Inc., all rights reserved.
+#
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Mapping, Optional
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+import requests_mock
+from airbyte_cdk.models import SyncMode
+from source_roman_coin_api.source import RomanCoinApiStream, cursor_format
+
+start = datetime(2024, 1, 1)
+
+def make_coins(offsets:List[float]) -> List[Dict[str, Any]]:
+    '''Returns coins modified at each offset, in seconds, from start'''
+    return [{"id": f"coin-{number:03d}", "name": "Trajan",
+             "modified": (start + timedelta(seconds=offset)).strftime(cursor_format)}
+            for number, offset in enumerate(offsets)]
+
+class StubApi:
+    '''Answers the stream's /v1/coins/ requests from coins held in (modified, id)
+    order: counts, the latest coin, and modified-ordered pages by number or cursor.
+    Requests for a slice starting at fail_start are answered with a 400, and those
+    for a slice starting at a key of delays after that many seconds. The first
+    unavailable requests are answered with a 503.'''
+
+    def __init__(self, coins:List[Dict[str, Any]], fail_start:Optional[str] = None,
+                 delays:Optional[Mapping[str, float]] = None):
+        self.coins = sorted(coins, key=lambda coin: (coin["modified"], coin["id"]))
+        self.fail_start = fail_start
+        self.delays = delays or {}
+        self.unavailable = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def __call__(self, request, context) -> Dict[str, Any]:
+        # request.qs lowercases values, which would change the timestamps
+        query = {key: values[0] for key, values in parse_qs(urlparse(request.url).query).items()}
+        with self.lock:
+            self.requests.append(query)
+            if self.unavailable:
+                self.unavailable -= 1
+                context.status_code = 503
+                return {"detail": "Service unavailable"}
+        time.sleep(self.delays.get(query.get("start_modified"), 0))
+        if query.get("start_modified") is not None and query.get("start_modified") == self.fail_start:
+            context.status_code = 400
+            return {"detail": "Bad request"}
+        size = int(query.get("page_size", 10))
+        rows = [coin for coin in self.coins
+                if query.get("start_modified", "") <= coin["modified"] <= query.get("end_modified", "~")]
+        pagination = {"items_per_page": size}
+        if query.get("desc") == "true":
+            return {"data": rows[::-1][:size], "pagination": pagination}
+        if "cursor" in query:
+            modified, _, coin_id = query["cursor"].partition("|")
+            first = next((index for index, coin in enumerate(rows) if (coin["modified"], coin["id"]) > (modified, coin_id)),
+                         len(rows))
+        else:
+            page = int(query.get("page", 1))
+            first = (page - 1) * size
+            pagination.update(total_items=len(rows), total_pages=-(-len(rows) // size), current_page=page)
+        if query.get("sort_by") == "modified" and first + size < len(rows):
+            last = rows[first + size - 1]
+            pagination["next_cursor"] = f'{last["modified"]}|{last["id"]}'
+        return {"data": rows[first:first + size], "pagination": pagination}
+
+@pytest.fixture
+def api():
+    '''Returns a function that serves coins from a StubApi in place of the coin API'''
+    with requests_mock.Mocker() as mocker:
+        def serve(coins:List[Dict[str, Any]], **options) -> StubApi:
+            stub = StubApi(coins, **options)
+            mocker.get(RomanCoinApiStream.url_base + "coins/", json=stub)
+            return stub
+        yield serve
+
+def make_stream(**config) -> RomanCoinApiStream:
+    stream = RomanCoinApiStream({"start_date": "2024-01-01", **config})
+    stream.page_size = 3
+    return stream
+
+def read_slice(stream:RomanCoinApiStream, stream_slice:Mapping[str, Any]) -> List[Mapping[str, Any]]:
+    return list(stream.read_records(SyncMode.incremental, stream_slice=stream_slice, stream_state={}))
+
+# Slice planning
+def test_slices_empty(api):
+    api([])
+    stream = make_stream()
+    assert stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={}) == []
+    assert stream.state == {"modified": start.strftime(cursor_format)}
+
+def test_slices_empty_windows(api):
+    # Coins at both ends of the range, so the windows in between are empty and dropped
+    api(make_coins([0, 1, 2, 3, 997, 998, 999, 1000]))
+    stream = make_stream(slice_records=2)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    assert all(stream_slice["records"] for stream_slice in slices)
+    assert sum(stream_slice["records"] for stream_slice in slices) == 8
+
+def test_slices_uneven(api):
+    offsets = [0, 0.5, 1, 1.5, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377, 610, 987, 987, 987]
+    coins = make_coins(offsets)
+    api(coins)
+    stream = make_stream(slice_records=4)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    # Every coin is in exactly one slice, and slices are in order without overlapping
+    counted = [[coin["id"] for coin in coins if stream_slice["start_modified"] <= coin["modified"] <= stream_slice["end_modified"]]
+               for stream_slice in slices]
+    assert sorted(coin_id for ids in counted for coin_id in ids) == [coin["id"] for coin in coins]
+    assert [len(ids) for ids in counted] == [stream_slice["records"] for stream_slice in slices]
+    assert all(earlier["end_modified"] < later["start_modified"] for earlier, later in zip(slices, slices[1:]))
+    # Slices hold at most slice_records coins unless they can't be split further
+    for stream_slice in slices:
+        width = datetime.fromisoformat(stream_slice["end_modified"]) - datetime.fromisoformat(stream_slice["start_modified"])
+        assert stream_slice["records"] <= 4 or width <= stream.min_slice
+
+def test_slices_shared_modified(api):
+    # Coins modified at once can't be split below min_slice, so they stay in one slice
+    api(make_coins([5] * 7 + [500]))
+    stream = make_stream(slice_records=2)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    assert [stream_slice["records"] for stream_slice in slices] == [7, 1]
+
+def test_slices_from_state(api):
+    coins = make_coins(range(10))
+    api(coins)
+    stream = make_stream(slice_records=3)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={"modified": coins[5]["modified"]})
+    assert sum(stream_slice["records"] for stream_slice in slices) == 4
+    assert slices[0]["start_modified"] > coins[5]["modified"]
+
+# Reading slices
+def test_read_in_order(api):
+    coins = make_coins([offset * 7 % 100 for offset in range(40)])
+    ordered = sorted(coins, key=lambda coin: (coin["modified"], coin["id"]))
+    stream = make_stream(slice_records=5, parallelism=4)
+    stub = api(coins)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    assert len(slices) > stream.parallelism
+    # Earlier slices answer slowest, so later ones are fetched first
+    stub.delays = {stream_slice["start_modified"]: 0.05 * (len(slices) - index) for index, stream_slice in enumerate(slices)}
+    records = []
+    for stream_slice in slices:
+        records += read_slice(stream, stream_slice)
+        assert stream.state == {"modified": stream_slice["end_modified"]}
+    assert [coin["id"] for coin in records] == [coin["id"] for coin in ordered]
+
+def test_read_prefetches(api):
+    coins = make_coins(range(0, 200, 10))
+    stream = make_stream(slice_records=4, parallelism=3)
+    stub = api(coins)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    stub.requests.clear()
+    read_slice(stream, slices[0])
+    # Reading the first slice also fetched the next two in the background
+    fetched = {query["start_modified"] for query in stub.requests}
+    assert fetched == {stream_slice["start_modified"] for stream_slice in slices[:3]}
+
+def test_state_failed_slice(api):
+    coins = make_coins(range(0, 200, 10))
+    stream = make_stream(slice_records=4, parallelism=3)
+    stub = api(coins)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    stub.fail_start = slices[1]["start_modified"]
+    assert len(read_slice(stream, slices[0])) == slices[0]["records"]
+    pool = stream.pool
+    with pytest.raises(requests.HTTPError):
+        read_slice(stream, slices[1])
+    # The state stays at the end of the last slice that was read in full
+    assert stream.state == {"modified": slices[0]["end_modified"]}
+    # and the prefetches are dropped with the pool
+    assert pool._shutdown and stream._pool is None and not stream._prefetched
+
+def test_state_unfinished_slice(api):
+    coins = make_coins(range(0, 200, 10))
+    stream = make_stream(slice_records=4, parallelism=2)
+    api(coins)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    read_slice(stream, slices[0])
+    records = stream.read_records(SyncMode.incremental, stream_slice=slices[1], stream_state={})
+    next(records)
+    pool = stream.pool
+    records.close()
+    assert stream.state == {"modified": slices[0]["end_modified"]}
+    assert pool._shutdown and stream._pool is None and not stream._prefetched
+
+def test_read_retries(api, monkeypatch):
+    monkeypatch.setattr(RomanCoinApiStream, "retry_factor", 0.01)
+    coins = make_coins(range(10))
+    stream = make_stream(slice_records=20)
+    stub = api(coins)
+    slices = stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    # Unavailable answers are retried with the CDK's backoff, up to max_retries times
+    stub.unavailable = 2
+    assert len(read_slice(stream, slices[0])) == 10
+    stream = make_stream(slice_records=20)
+    stub.unavailable = stream.max_retries + 1
+    with pytest.raises(requests.HTTPError):
+        stream.stream_slices(sync_mode=SyncMode.incremental, stream_state={})
+    assert stub.unavailable == 0
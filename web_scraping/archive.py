@@ -0,0 +1,77 @@
+'''Archive of fetched pages as compressed raw html.
+
+Every page fetched with new content is saved as {sha256(url)}.html.gz, next to
+a JSON entry with its URL, content hash and fetch time. The dataset can then be
+rebuilt from the archive (see replay in web_scraper.py) after a parser change,
+without requesting the pages again.'''
+import gzip
+import hashlib
+import json
+import os
+import time
+
+def read_page(path:str) -> bytes:
+    '''Returns the raw html of an archived page'''
+    with gzip.open(path, 'rb') as page:
+        return page.read()
+
+class PageArchive:
+    '''On-disk store of the raw html of fetched pages, keyed by URL'''
+
+    def __init__(self, directory:str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, url:str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def page_path(self, url:str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.html.gz')
+
+    def lookup(self, url:str) -> dict | None:
+        '''Returns the archive entry for url, if any'''
+        try:
+            with open(self.entry_path(url)) as entry:
+                return json.load(entry)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def store(self, url:str, content:bytes, content_hash:str | None=None):
+        '''Saves a page's raw html, unless the archived copy has the same hash'''
+        content_hash = content_hash or hashlib.sha256(content).hexdigest()
+        entry = self.lookup(url)
+        if entry and entry['content_hash'] == content_hash and os.path.exists(self.page_path(url)):
+            return
+        # The page is written before its entry, so an entry always has its page
+        path = self.page_path(url)
+        with open(path + '.tmp', 'wb') as temp:
+            temp.write(gzip.compress(content, compresslevel=6, mtime=0))
+        os.replace(path + '.tmp', path)
+        path = self.entry_path(url)
+        with open(path + '.tmp', 'w') as temp:
+            json.dump({'url': url, 'content_hash': content_hash, 'size': len(content),
+                       'fetched': time.time()}, temp)
+        os.replace(path + '.tmp', path)
+
+    def read(self, url:str) -> bytes | None:
+        '''Returns the archived raw html of url, if any'''
+        try:
+            return read_page(self.page_path(url))
+        except FileNotFoundError:
+            return None
+
+    def entries(self) -> list[dict]:
+        '''Returns the entries of all archived pages, in URL order, with the
+        path of each page's html'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as entry:
+                    entry = json.load(entry)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            entry['path'] = self.page_path(entry['url'])
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['url'])
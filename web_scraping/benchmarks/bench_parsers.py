@@ -0,0 +1,32 @@
+'''Compares the parser backends on a synthetic coin page.
+
+Run from the web_scraping directory:
+    python benchmarks/bench_parsers.py --rows 300 --repeat 20'''
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.getcwd())
+from synthetic import synthetic_page
+from web_scraper import parse_page
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=300, help='coin rows per page')
+    parser.add_argument('--repeat', type=int, default=20, help='pages parsed per backend')
+    args = parser.parse_args()
+
+    page = synthetic_page(args.rows)
+    print(f'{len(page) / 1024:.0f} KiB page, {args.rows} rows, {args.repeat} runs')
+    timings = {}
+    for backend in ('bs4', 'lxml'):
+        parse_page(page, backend)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            coins = parse_page(page, backend)
+        timings[backend] = (time.perf_counter() - start) / args.repeat
+        print(f'{backend:>5}: {timings[backend] * 1000:8.2f} ms/page, {len(coins)} coins')
+    print(f'speedup: {timings["bs4"] / timings["lxml"]:.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''Times the scraper's parsing on synthetic catalog pages.
+
+For each page size and parser backend, times building the document, finding
+the coin rows, coins_from_soup and each coin_* extractor over all rows, and
+measures the peak Python memory of parsing one page with tracemalloc (lxml's
+own C allocations aren't traced). Results can be written as JSON and
+compared against an earlier run's.
+
+Run from the web_scraping directory:
+    python benchmarks/bench_scraper.py --rows 100 1000 5000 --output bench.json
+    python benchmarks/bench_scraper.py --rows 100 1000 5000 --compare bench.json'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+sys.path.append(os.getcwd())
+from parsers import parse_html
+from synthetic import synthetic_page
+from web_scraper import (pull_title, pull_subtitle, pull_coins, coins_from_soup, parse_page,
+                         coin_catalog, coin_description, coin_metal, coin_era, coin_year,
+                         coin_txt, coin_mass, coin_diameter, coin_inscriptions)
+
+extractors = {'coin_catalog': coin_catalog, 'coin_description': coin_description,
+              'coin_metal': coin_metal, 'coin_era': coin_era, 'coin_year': coin_year,
+              'coin_txt': lambda coin: coin_txt(coin, 'Trajan'), 'coin_mass': coin_mass,
+              'coin_diameter': coin_diameter, 'coin_inscriptions': coin_inscriptions}
+
+def timed(function, repeat:int) -> list[float]:
+    '''Returns the seconds each of repeat calls of function took, after a warm-up call'''
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def peak_memory(function) -> int:
+    '''Returns the peak bytes of Python memory allocated during a call of function'''
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_page(page:bytes, backend:str, repeat:int) -> list[dict]:
+    '''Returns a result per benchmark of one page with one backend. The 
+    'stream' backend has no document, so only parse_page is measured.'''
+    if backend == 'stream':
+        return bench_stream(page, repeat)
+    document = parse_html(page, backend)
+    rows = pull_coins(document)
+    coins = coins_from_soup(document) or []
+    benchmarks = {'parse_html': lambda: parse_html(page, backend),
+                  'pull_title': lambda: pull_title(document),
+                  'pull_subtitle': lambda: pull_subtitle(document),
+                  'pull_coins': lambda: pull_coins(document),
+                  'coins_from_soup': lambda: coins_from_soup(document),
+                  'parse_page': lambda: parse_page(page, backend)}
+    for name, extractor in extractors.items():
+        benchmarks[name] = lambda extractor=extractor: [extractor(row) for row in rows]
+    results = []
+    for name, function in benchmarks.items():
+        times = timed(function, repeat)
+        results.append({'benchmark': name, 'backend': backend, 'rows': len(rows), 'coins': len(coins),
+                        'page_bytes': len(page), 'repeat': repeat,
+                        'min_ms': min(times) * 1000, 'median_ms': statistics.median(times) * 1000,
+                        'per_row_us': min(times) / max(len(rows), 1) * 1e6})
+    results.append({'benchmark': 'parse_page_peak_memory', 'backend': backend, 'rows': len(rows),
+                    'coins': len(coins), 'page_bytes': len(page),
+                    'peak_bytes': peak_memory(lambda: parse_page(page, backend))})
+    return results
+
+def bench_stream(page:bytes, repeat:int) -> list[dict]:
+    coins = parse_page(page, 'stream') or []
+    rows = len(pull_coins(parse_html(page, 'lxml')))
+    times = timed(lambda: parse_page(page, 'stream'), repeat)
+    return [{'benchmark': 'parse_page', 'backend': 'stream', 'rows': rows, 'coins': len(coins),
+             'page_bytes': len(page), 'repeat': repeat,
+             'min_ms': min(times) * 1000, 'median_ms': statistics.median(times) * 1000,
+             'per_row_us': min(times) / max(rows, 1) * 1e6},
+            {'benchmark': 'parse_page_peak_memory', 'backend': 'stream', 'rows': rows,
+             'coins': len(coins), 'page_bytes': len(page),
+             'peak_bytes': peak_memory(lambda: parse_page(page, 'stream'))}]
+
+def environment() -> dict:
+    import bs4
+    import lxml.etree
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'lxml': '.'.join(map(str, lxml.etree.LXML_VERSION)), 'bs4': bs4.__version__,
+            'cpus': os.cpu_count(), 'run_at': datetime.datetime.now().isoformat(timespec='seconds')}
+
+def result_key(result:dict) -> tuple:
+    return result['benchmark'], result['backend'], result['rows']
+
+def compare(results:list[dict], baseline:list[dict]):
+    '''Prints each result against the same benchmark in baseline'''
+    previous = {result_key(result): result for result in baseline}
+    print(f'{"benchmark":<24} {"backend":>7} {"rows":>6} {"baseline":>12} {"now":>12} {"ratio":>7}')
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old:
+            continue
+        metric = 'peak_bytes' if 'peak_bytes' in result else 'min_ms'
+        ratio = result[metric] / old[metric] if old[metric] else float('nan')
+        print(f'{result["benchmark"]:<24} {result["backend"]:>7} {result["rows"]:>6} '
+              f'{old[metric]:>12.3f} {result[metric]:>12.3f} {ratio:>6.2f}x')
+
+def report(results:list[dict]):
+    for result in results:
+        if 'peak_bytes' in result:
+            value = f'{result["peak_bytes"] / 2**20:10.2f} MiB peak'
+        else:
+            value = f'{result["min_ms"]:10.3f} ms min {result["median_ms"]:10.3f} ms median ' \
+                    f'{result["per_row_us"]:8.2f} us/row'
+        print(f'{result["benchmark"]:<24} {result["backend"]:>5} {result["rows"]:>6} rows  {value}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 5000], help='coin rows per page')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--backends', nargs='+', default=['lxml', 'bs4'], choices=['lxml', 'bs4', 'stream'])
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic pages')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    for rows in args.rows:
+        page = synthetic_page(rows, args.seed)
+        for backend in args.backends:
+            results.extend(bench_page(page, backend, args.repeat))
+    report(results)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline)['results'])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'environment': environment(), 'args': vars(args), 'results': results}, output, indent=1)
+
+if __name__ == '__main__':
+    main()
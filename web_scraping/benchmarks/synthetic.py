@@ -0,0 +1,78 @@
+'''Synthetic wildwinds-style coin pages for benchmarks.
+
+Pages follow the layout of the catalog pages the scraper reads: a title, an
+h2 with the ruler's name and dates, a table of coin rows whose first cell's
+bgcolor gives the metal, a description cell and a links cell. Descriptions
+are generated from the pieces real ones are made of (denomination, size,
+weight, obverse and reverse legends, dates and references) and vary in which
+of them are present, so every extractor has work to do. Pages are generated
+from a seed, so the same arguments always give the same page.'''
+import random
+
+metals = {'#FFD700': ['AV Aureus', 'AV Solidus', 'AV Quinarius'],
+          '#C0C0C0': ['AR Denarius', 'AR Antoninianus', 'AR Siliqua', 'AR Quinarius'],
+          '#B87333': ['AE As', 'AE Quadrans', 'Cu As'],
+          '#B7A642': ['AE Sestertius', 'AE Dupondius', 'AE Follis', 'AE3'],
+          'red': ['Fourree Denarius', 'Cast copy'],
+          '#AC9B88': ['PB Tessera']}
+obverse_legends = ['IMP CAES NERVA TRAIAN AVG GERM', 'IMP TRAIANO AVG GER DAC P M TR P COS V P P',
+                   'DIVVS AVGVSTVS PATER', 'TI CAESAR DIVI AVG F AVGVSTVS',
+                   'IMP C M AVR SEV ALEXAND AVG', 'CONSTANTINVS P F AVG', 'IMP CAESAR VESPASIANVS AVG',
+                   'ANTONINVS AVG PIVS P P TR P COS III', 'C CAESAR AVG GERM P M TR POT']
+obverse_types = ['laureate head right', 'laureate, draped and cuirassed bust right',
+                 'radiate head left', 'bare head right', 'diademed, draped bust right']
+reverse_legends = ['P M TR P COS II P P', 'S P Q R OPTIMO PRINCIPI', 'PAX AVGVSTI', 'VIRTVS AVG',
+                   'PONTIF MAXIM', 'SOLI INVICTO COMITI', 'CONCORDIA MILITVM', 'FIDES EXERCITVS, S C']
+reverse_types = ['Pax standing left holding branch and cornucopiae',
+                 'Victory advancing right with wreath and palm',
+                 'Sol standing left, raising hand and holding globe', 'Livia seated right',
+                 'eagle between two standards', 'Mars walking right with spear and trophy']
+references = ['RIC {n}', 'RIC {n}; BMC {m}', 'RIC {n}; Cohen {m}; BMC {k}', 'RSC {n}',
+              'Sear {m}; RIC {n}', 'Crawford {n}/{k}']
+
+def description(rng:random.Random, denomination:str) -> str:
+    '''Returns a coin description made of a random selection of the usual parts'''
+    parts = [denomination]
+    if rng.random() < 0.9:
+        diameter = rng.randint(14, 38)
+        parts.append(f'{diameter}.{rng.randint(0, 9)}mm' if rng.random() < 0.4 else f'{diameter}mm')
+    if rng.random() < 0.85:
+        mass = f'{rng.randint(1, 30)}.{rng.randint(0, 99):02d}'
+        unit = rng.choice(['g', 'g', 'gm', ' g', 'gr'])
+        parts.append((mass.replace('.', ',') if rng.random() < 0.1 else mass) + unit)
+    parts.append(f'{rng.choice(obverse_legends)}, {rng.choice(obverse_types)}')
+    parts.append(f'{rng.choice(reverse_legends)}, {rng.choice(reverse_types)}')
+    year = rng.randint(1, 400)
+    if rng.random() < 0.15:
+        parts.append(f'Struck {rng.randint(1, 49)}-{rng.randint(1, 49)} BC')
+    elif rng.random() < 0.5:
+        parts.append(f'Struck AD {year}' if rng.random() < 0.5 else f'Struck {year}/{year + 1} AD')
+    parts.append(rng.choice(references).format(n=rng.randint(1, 900), m=rng.randint(1, 3000),
+                                               k=rng.randint(1, 99)))
+    return '. '.join(parts) + '.'
+
+def coin_row(rng:random.Random, i:int) -> str:
+    color = rng.choice(list(metals))
+    catalog = f'RIC {i // 2 + 1}{rng.choice(["", "", "a", "b"])}'
+    links = f'<a href="RIC_{i}.jpg">Image</a>'
+    if rng.random() < 0.8:
+        links += f' <a href="RIC_{i}.txt">Text</a>'
+    sold = '<td><!-- sold --><font color="red">Sold</font></td>' if rng.random() < 0.3 else ''
+    return (f'<tr bgcolor="#FFFFFF"><td bgcolor="{color}"><b>{catalog}</b></td>\n'
+            f'<td>{description(rng, rng.choice(metals[color]))}</td>\n'
+            f'<td>{links}</td>{sold}</tr>\n')
+
+def synthetic_page(rows:int, seed:int=0) -> bytes:
+    '''Returns a coin page shaped like a catalog page, with rows coin rows'''
+    rng = random.Random(seed)
+    body = []
+    for i in range(rows):
+        # Section headings and spacer rows are interleaved like on real pages
+        if i % 50 == 0:
+            body.append(f'<tr><td colspan="3"><h3>Issue {i // 50 + 1}</h3></td></tr>\n')
+        body.append(coin_row(rng, i))
+    return f'''<html><head><title>Trajan, Roman Imperial Coins</title>
+<script>function hl(x) {{ return x; }}</script></head><body>
+<h2>Trajan</h2> AD 98-117 <p>Click on a coin to see more.</p>
+<font>Marcus Ulpius Traianus</font>
+<table border="1">{''.join(body)}</table></body></html>'''.encode('latin-1')
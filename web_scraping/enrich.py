@@ -0,0 +1,56 @@
+'''Concurrent fetching of the coins' .txt detail files.
+
+Each coin row links a .txt file with the coin's full description, which often
+has the weight, size or legends the row leaves out. Files are requested through
+the crawl's Fetcher, so they share its per-host politeness budget, with at most
+`concurrency` requests in flight. Fetched files are kept in a disk cache (a
+PageArchive), so an interrupted run resumes without requesting them again, and
+missing files (404 or 410) are cached as empty so they aren't retried.'''
+import asyncio
+import httpx
+from archive import PageArchive
+from fetcher import Fetcher
+
+missing_statuses = {404, 410}
+
+async def fetch_files(urls:list[str], fetcher:Fetcher, cache:PageArchive,
+                      concurrency:int=4) -> tuple[dict[str, bytes], dict[str, int]]:
+    '''Returns the contents of the urls that could be read, from the cache or
+    fetched, and counts of files cached, fetched, missing and failed'''
+    contents = {}
+    stats = {'cached': 0, 'fetched': 0, 'missing': 0, 'failed': 0}
+    pending = []
+    for url in dict.fromkeys(urls):
+        content = await asyncio.to_thread(cache.read, url)
+        if content is None:
+            pending.append(url)
+        elif content:
+            contents[url] = content
+            stats['cached'] += 1
+        else:
+            stats['missing'] += 1
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def fetch(url:str):
+        async with in_flight:
+            await fetcher.wait_turn(url)
+            try:
+                # Not a page, so it's neither revalidated nor counted by the page cache
+                response = await fetcher.get(url, headers={})
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in missing_statuses:
+                    stats['failed'] += 1
+                    return
+                stats['missing'] += 1
+                await asyncio.to_thread(cache.store, url, b'')
+                return
+            except httpx.HTTPError as e:
+                print(f'Fetch error for {url}:', e)
+                stats['failed'] += 1
+                return
+        contents[url] = response.content
+        stats['fetched'] += 1
+        await asyncio.to_thread(cache.store, url, response.content)
+
+    await asyncio.gather(*[fetch(url) for url in pending])
+    return contents, stats
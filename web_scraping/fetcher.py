@@ -0,0 +1,287 @@
+import asyncio
+import collections
+import email.utils
+import hashlib
+import json
+import os
+import random
+import time
+from urllib.parse import urlsplit
+import httpx
+
+# Responses worth retrying: rate limited, or the server is struggling
+retry_statuses = {429, 500, 502, 503, 504}
+
+def retry_after(value:str | None, now:float | None=None) -> float | None:
+    '''Returns the seconds to wait from a Retry-After header, given in seconds 
+    or as an HTTP date, or None if it's missing or invalid'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - (time.time() if now is None else now))
+
+def backoff_delay(attempt:int, base:float=1.0, cap:float=60.0) -> float:
+    '''Returns the wait before retry number attempt (from 0): exponential, 
+    capped, with half of it jittered so retrying clients spread out'''
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class TokenBucket:
+    '''Politeness budget for one host: up to `burst` requests at once,
+    refilled at `requests_per_minute`'''
+
+    def __init__(self, requests_per_minute:float, burst:int=1, clock=time.monotonic):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock()
+
+    def reserve(self) -> float:
+        '''Takes a token and returns how many seconds the caller must wait
+        before using it. Tokens may go negative, which queues callers in
+        arrival order without polling.'''
+        self.refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, requests_per_minute:float):
+        '''Changes the refill rate from now on'''
+        self.refill()
+        self.rate = requests_per_minute / 60
+
+    def defer(self, seconds:float):
+        '''Holds back reservations made from now on for at least seconds'''
+        self.refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class RateController:
+    '''Adapts a host's request rate to how the host is coping (AIMD). After an
+    error or timeout, or while the smoothed latency is above slow_seconds, the
+    rate is multiplied by decrease; after other responses it grows by increase
+    requests per minute, unless more than max_error_rate of the last window
+    requests failed. The rate always stays between floor and ceiling.'''
+
+    def __init__(self, bucket:TokenBucket, floor:float, ceiling:float, increase:float | None=None,
+                 decrease:float=0.5, slow_seconds:float=10.0, window:int=20, max_error_rate:float=0.1):
+        self.bucket = bucket
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.increase = increase if increase is not None else (self.ceiling - floor) / 10
+        self.decrease = decrease
+        self.slow_seconds = slow_seconds
+        self.max_error_rate = max_error_rate
+        self.outcomes = collections.deque(maxlen=window)
+        self.latency = None
+        self.requests_per_minute = None
+        self.set_rate(bucket.rate * 60)
+
+    def set_rate(self, requests_per_minute:float):
+        self.requests_per_minute = min(self.ceiling, max(self.floor, requests_per_minute))
+        self.bucket.set_rate(self.requests_per_minute)
+
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def record(self, latency:float, failed:bool):
+        '''Adjusts the rate after a response that took latency seconds, or a 
+        failed request'''
+        self.outcomes.append(failed)
+        if not failed:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if failed or self.latency > self.slow_seconds:
+            self.set_rate(self.requests_per_minute * self.decrease)
+        elif self.error_rate() <= self.max_error_rate:
+            self.set_rate(self.requests_per_minute + self.increase)
+
+    def report(self) -> str:
+        latency = f'{self.latency:.2f}s' if self.latency is not None else 'n/a'
+        return (f'{self.requests_per_minute:.2f} requests/minute, smoothed latency {latency}, '
+                f'error rate {self.error_rate():.0%} of last {len(self.outcomes)}')
+
+class HttpCache:
+    '''On-disk store of response validators (ETag and Last-Modified) keyed 
+    by URL, used to send conditional requests'''
+
+    def __init__(self, directory:str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.stats = {'requests': 0, 'revalidations': 0, 'hits': 0}
+
+    def entry_path(self, url:str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def lookup(self, url:str) -> dict | None:
+        '''Returns the cached validators for url, if any'''
+        try:
+            with open(self.entry_path(url)) as entry:
+                return json.load(entry)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def request_headers(self, url:str) -> dict:
+        '''Returns conditional request headers for url'''
+        entry = self.lookup(url) or {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, request_headers:dict, response:httpx.Response):
+        '''Counts a request made with request_headers'''
+        self.stats['requests'] += 1
+        if request_headers:
+            self.stats['revalidations'] += 1
+            if response.status_code == 304:
+                self.stats['hits'] += 1
+
+    def store(self, url:str, response_headers:httpx.Headers):
+        '''Saves the validators of a response once its content has been used'''
+        entry = {'url': url,
+                 'etag': response_headers.get('etag'),
+                 'last_modified': response_headers.get('last-modified'),
+                 'stored': time.time()}
+        if not (entry['etag'] or entry['last_modified']):
+            return
+        path = self.entry_path(url)
+        with open(path + '.tmp', 'w') as temp:
+            json.dump(entry, temp)
+        os.replace(path + '.tmp', path)
+
+    def report(self) -> str:
+        stats = self.stats
+        return (f"HTTP cache: {stats['requests']} requests, {stats['revalidations']} revalidations, "
+                f"{stats['hits']} hits (304 Not Modified), "
+                f"{stats['revalidations'] - stats['hits']} changed, "
+                f"{stats['requests'] - stats['revalidations']} uncached")
+
+class Fetcher:
+    '''Asynchronous page fetcher on a persistent keep-alive session, with a
+    token bucket per host and a bound on concurrent connections. With a 
+    cache, requests are made conditional on the cached validators. Each 
+    host's rate is adapted between min_requests_per_minute and 
+    max_requests_per_minute (by default a quarter of requests_per_minute, 
+    and requests_per_minute, so it never goes faster than the configured 
+    politeness; a higher max lets it probe past where it started) by a 
+    RateController. Timeouts, connection errors and retryable statuses are 
+    retried up to retries times, after the server's Retry-After or a jittered 
+    exponential backoff.'''
+
+    def __init__(self, requests_per_minute:float=2.0, burst:int=1, max_connections:int=4,
+                 timeout:float=60.0, transport:httpx.AsyncBaseTransport | None=None, 
+                 cache:HttpCache | None=None, min_requests_per_minute:float | None=None,
+                 max_requests_per_minute:float | None=None, retries:int=0, 
+                 backoff_base:float=1.0, max_backoff:float=60.0):
+        self.cache = cache
+        self.requests_per_minute = requests_per_minute
+        self.min_requests_per_minute = min_requests_per_minute or requests_per_minute / 4
+        self.max_requests_per_minute = max_requests_per_minute or requests_per_minute
+        self.burst = burst
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.controllers = {}
+        self.connections = asyncio.Semaphore(max_connections)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            timeout=timeout,
+            follow_redirects=True,
+            transport=transport)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    def bucket(self, url:str) -> TokenBucket:
+        '''Returns the token bucket for the url's host'''
+        return self.controller(url).bucket
+
+    def controller(self, url:str) -> RateController:
+        '''Returns the rate controller for the url's host'''
+        host = urlsplit(url).netloc
+        if host not in self.controllers:
+            self.buckets[host] = TokenBucket(self.requests_per_minute, self.burst)
+            self.controllers[host] = RateController(self.buckets[host], self.min_requests_per_minute,
+                                                    self.max_requests_per_minute)
+        return self.controllers[host]
+
+    async def wait_turn(self, url:str):
+        '''Waits until the url's host has politeness budget for a request'''
+        await self.bucket(url).acquire()
+
+    async def get(self, url:str, headers:dict | None=None) -> httpx.Response:
+        '''Requests url once a connection is free, retrying failures within 
+        the host's politeness budget. Returns the response, which is a 304 if 
+        the cached copy of url is still current. Without headers, conditional 
+        headers come from the cache and the request is counted in its report; 
+        with headers, the cache isn't used.'''
+        cached = headers is None and self.cache is not None
+        if headers is None:
+            headers = self.cache.request_headers(url) if cached else {}
+        controller = self.controller(url)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await self.wait_turn(url)
+            start = time.monotonic()
+            try:
+                async with self.connections:
+                    response = await self.client.get(url, headers=headers)
+            except httpx.TransportError:
+                controller.record(time.monotonic() - start, failed=True)
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.max_backoff))
+                continue
+            failed = response.status_code in retry_statuses
+            controller.record(time.monotonic() - start, failed)
+            if not failed or attempt == self.retries:
+                break
+            delay = retry_after(response.headers.get('retry-after'))
+            if delay is not None:
+                # The whole host asked for a pause, not just this request
+                controller.bucket.defer(min(delay, self.max_backoff))
+            else:
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.max_backoff))
+        if cached:
+            self.cache.record(headers, response)
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    async def fetch(self, url:str) -> bytes | None:
+        '''Returns the body of url within the host's politeness budget, or None
+        if it hasn't changed since it was cached'''
+        await self.wait_turn(url)
+        response = await self.get(url)
+        return None if response.status_code == 304 else response.content
+
+    def report(self) -> list[str]:
+        '''Returns a line per host with its current rate'''
+        return [f'{host}: {controller.report()}' for host, controller in self.controllers.items()]
@@ -0,0 +1,120 @@
+'''Crawl frontier kept in postgres.
+
+Every page URL has a row with its crawl status ('pending', 'claimed', 'done'
+or 'failed'), the number of fetch attempts, when it was last fetched, the hash
+of its content and the last error. Workers claim URLs with FOR UPDATE SKIP
+LOCKED, so any number of scraper processes can share one frontier without
+claiming the same page. A claim expires after a lease, so pages held by a
+crashed worker are picked up again. Crawled pages are requeued to be 
+crawled again, keeping their content hash so unchanged pages are skipped.'''
+from typing import Callable
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+class Frontier:
+    '''Per-URL crawl state shared by all scraper processes'''
+
+    statuses = ('pending', 'claimed', 'done', 'failed')
+
+    def __init__(self, connect:Callable[[], psycopg2.extensions.connection],
+                 table:str='crawl_frontier', max_attempts:int=3, lease_minutes:float=30):
+        self.connect = connect
+        self.table = table
+        self.max_attempts = max_attempts
+        self.lease_minutes = lease_minutes
+        self.conn = None
+
+    def connection(self) -> psycopg2.extensions.connection:
+        # Every statement commits on its own, so claims are visible at once
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+            self.conn.set_session(autocommit=True)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def execute(self, query:str, params=None) -> list[dict]:
+        with self.connection().cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, params)
+            return cur.fetchall() if cur.description else []
+
+    def create(self):
+        '''Creates the frontier table if it doesn't exist'''
+        self.execute(f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                     'url VARCHAR(300) PRIMARY KEY, '
+                     'position INTEGER, '
+                     "status VARCHAR(10) NOT NULL DEFAULT 'pending', "
+                     'attempts INTEGER NOT NULL DEFAULT 0, '
+                     'claimed_at TIMESTAMP, '
+                     'last_fetched TIMESTAMP, '
+                     'content_hash VARCHAR(64), '
+                     'error VARCHAR(1000))')
+        self.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_status_idx ON {self.table} (status, position)')
+
+    def add(self, urls:list[str]) -> int:
+        '''Adds new URLs as pending, in crawl order. Returns how many were new.'''
+        with self.connection().cursor() as cur:
+            # execute_values inserts in pages, so rowcount would only count the last one
+            added = execute_values(cur, f'INSERT INTO {self.table} (url, position) VALUES %s '
+                                        'ON CONFLICT DO NOTHING RETURNING url',
+                                   list(zip(urls, range(len(urls)))), fetch=True)
+            return len(added)
+
+    def claim(self, limit:int=1) -> list[dict]:
+        '''Claims up to limit URLs that are pending, failed with attempts left,
+        or claimed by a worker whose lease ran out. Returns their rows.'''
+        return self.execute(
+            f'UPDATE {self.table} SET status = %s, claimed_at = now(), attempts = attempts + 1 '
+            f'WHERE url IN (SELECT url FROM {self.table} '
+            "WHERE status = 'pending' "
+            "OR (status = 'failed' AND attempts < %s) "
+            "OR (status = 'claimed' AND claimed_at < now() - make_interval(mins => %s)) "
+            'ORDER BY position, url LIMIT %s FOR UPDATE SKIP LOCKED) '
+            'RETURNING url, position, attempts, content_hash',
+            ('claimed', self.max_attempts, self.lease_minutes, limit))
+
+    def done(self, url:str, content_hash:str | None=None):
+        '''Marks a URL as crawled; without a hash its stored hash is kept'''
+        self.execute(f"UPDATE {self.table} SET status = 'done', last_fetched = now(), error = NULL, "
+                     'content_hash = COALESCE(%s, content_hash) WHERE url = %s', (content_hash, url))
+
+    def done_batch(self, conn:psycopg2.extensions.connection, pages:list[tuple[str, str | None]]):
+        '''Marks (url, content hash) pages as crawled in conn's open transaction,
+        so they're only done once it commits, together with what else it wrote'''
+        with conn.cursor() as cur:
+            execute_values(cur, f"UPDATE {self.table} AS f SET status = 'done', last_fetched = now(), "
+                                'error = NULL, content_hash = COALESCE(v.content_hash, f.content_hash) '
+                                'FROM (VALUES %s) AS v (url, content_hash) WHERE f.url = v.url',
+                           pages, template='(%s, %s::VARCHAR)')
+
+    def failed(self, url:str, error:str):
+        '''Records a failed attempt; the URL is retried until max_attempts'''
+        self.execute(f"UPDATE {self.table} SET status = 'failed', last_fetched = now(), error = %s "
+                     'WHERE url = %s', (error[:1000], url))
+
+    def requeue(self, max_age_minutes:float=0) -> int:
+        '''Requeues done and failed URLs last fetched more than max_age_minutes
+        ago as pending, with fresh attempts; their content hashes are kept. 
+        Returns how many were requeued.'''
+        with self.connection().cursor() as cur:
+            cur.execute(f"UPDATE {self.table} SET status = 'pending', attempts = 0, claimed_at = NULL "
+                        "WHERE status IN ('done', 'failed') "
+                        'AND last_fetched <= now() - make_interval(mins => %s)', (max_age_minutes,))
+            return cur.rowcount
+
+    def progress(self) -> dict[str, int]:
+        '''Returns the number of URLs in each status, and in total'''
+        counts = dict.fromkeys(self.statuses, 0)
+        for row in self.execute(f'SELECT status, count(*) AS urls FROM {self.table} GROUP BY status'):
+            counts[row['status']] = row['urls']
+        counts['total'] = sum(counts.values())
+        return counts
+
+    def remaining(self) -> int:
+        '''Returns the number of URLs that still can be claimed'''
+        return self.execute(
+            f"SELECT count(*) AS urls FROM {self.table} WHERE status IN ('pending', 'claimed') "
+            "OR (status = 'failed' AND attempts < %s)", (self.max_attempts,))[0]['urls']
@@ -0,0 +1,214 @@
+'''Bulk loading of scraped records into postgres.
+
+Records are checked against the target table's columns (from
+information_schema) before loading. Valid records are streamed with COPY into a
+temporary staging table and merged into the target with a single INSERT ...
+SELECT. Tables with a primary key are upserted: a row is only rewritten when
+its content differs, and only then is its touch column (e.g. modified) moved
+forward. Records that fail validation are moved to a reject table next to
+the target ({table}_rejects) with the reason. If the merge still fails, the
+batch is replayed row by row under savepoints so only the bad rows are rejected.'''
+import datetime
+import io
+import json
+import math
+import time
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+text_types = {'character varying', 'character', 'text'}
+float_types = {'real': 3.4e38, 'double precision': 1.7e308, 'numeric': math.inf}
+integer_types = {'smallint': 2**15, 'integer': 2**31, 'bigint': 2**63}
+timestamp_types = {'timestamp without time zone', 'timestamp with time zone'}
+
+def table_schema(cur, table:str) -> dict[str, dict]:
+    '''Returns column name: information_schema.columns row for a table'''
+    cur.execute('SELECT column_name, data_type, character_maximum_length, is_nullable '
+                'FROM information_schema.columns '
+                'WHERE table_schema = current_schema() AND table_name = %s', (table,))
+    return {row['column_name']: row for row in cur.fetchall()}
+
+def primary_key(cur, table:str) -> list[str]:
+    '''Returns the primary key columns of a table'''
+    cur.execute('SELECT k.column_name FROM information_schema.table_constraints c '
+                'JOIN information_schema.key_column_usage k '
+                'ON k.constraint_name = c.constraint_name AND k.table_schema = c.table_schema '
+                "WHERE c.constraint_type = 'PRIMARY KEY' AND c.table_schema = current_schema() "
+                'AND c.table_name = %s ORDER BY k.ordinal_position', (table,))
+    return [row['column_name'] for row in cur.fetchall()]
+
+class Merge:
+    '''How staged rows are merged into a table: insert new rows, and without a 
+    key skip conflicting ones. With a key, conflicting rows are updated when 
+    any column other than the key, keep and touch columns has changed; keep 
+    columns (e.g. created) are never updated and touch is set only on change.'''
+
+    def __init__(self, table:str, columns:list[str], key:list[str], keep:tuple=(), touch:str | None=None):
+        self.table = table
+        self.columns = columns
+        self.key = key if key and set(key) <= set(columns) else []
+        self.compared = [column for column in columns 
+                         if column not in self.key and column not in keep and column != touch]
+        self.updated = self.compared + ([touch] if touch in columns else [])
+
+    def conflict_clause(self) -> str:
+        if not self.key or not self.updated:
+            return 'ON CONFLICT DO NOTHING'
+        if not self.compared:
+            return f'ON CONFLICT ({", ".join(self.key)}) DO NOTHING'
+        assignments = ', '.join(f'{column} = EXCLUDED.{column}' for column in self.updated)
+        current = ', '.join(f'{self.table}.{column}' for column in self.compared)
+        excluded = ', '.join(f'EXCLUDED.{column}' for column in self.compared)
+        return (f'ON CONFLICT ({", ".join(self.key)}) DO UPDATE SET {assignments} '
+                f'WHERE ROW({current}) IS DISTINCT FROM ROW({excluded})')
+
+    def query(self, source:str) -> str:
+        '''Returns the merge statement for rows selected by source, reporting 
+        each written row's key and whether it was inserted'''
+        returned = ''.join(f'{column}, ' for column in self.key)
+        return (f'INSERT INTO {self.table} ({", ".join(self.columns)}) {source} '
+                f'{self.conflict_clause()} RETURNING {returned}(xmax = 0) AS inserted')
+
+    def staged(self, staging:str) -> str:
+        '''Returns the merge statement for a staging table, keeping one row per key'''
+        names = ', '.join(self.columns)
+        if self.key:
+            key = ', '.join(self.key)
+            return self.query(f'SELECT DISTINCT ON ({key}) {names} FROM {staging} ORDER BY {key}')
+        return self.query(f'SELECT {names} FROM {staging}')
+
+def written(rows:list[dict]) -> tuple[int, int]:
+    '''Returns the (inserted, updated) counts from a merge's returned rows'''
+    inserted = sum(1 for row in rows if row['inserted'])
+    return inserted, len(rows) - inserted
+
+def value_error(value, column:dict) -> str | None:
+    '''Returns why value can't be stored in column, or None if it can'''
+    data_type = column['data_type']
+    if value is None:
+        return 'null value' if column['is_nullable'] == 'NO' else None
+    if data_type in text_types:
+        if not isinstance(value, str):
+            return f'{type(value).__name__} is not text'
+        limit = column['character_maximum_length']
+        if limit and len(value) > limit:
+            return f'{len(value)} characters exceeds {limit}'
+    elif data_type in float_types or data_type in integer_types:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return f'{type(value).__name__} is not a number'
+        if data_type in integer_types:
+            if not isinstance(value, int):
+                return f'{value!r} is not an integer'
+            if not -integer_types[data_type] <= value < integer_types[data_type]:
+                return f'{value} is out of range for {data_type}'
+        elif math.isfinite(value) and abs(value) > float_types[data_type]:
+            return f'{value} is out of range for {data_type}'
+    elif data_type in timestamp_types:
+        if not isinstance(value, datetime.datetime):
+            return f'{type(value).__name__} is not a timestamp'
+    return None
+
+def record_error(record:dict, schema:dict[str, dict]) -> str | None:
+    '''Returns why a record can't be loaded, or None if it can'''
+    for name, value in record.items():
+        if name not in schema:
+            return f'unknown column {name}'
+        error = value_error(value, schema[name])
+        if error:
+            return f'{name}: {error}'
+    return None
+
+def copy_value(value) -> str:
+    '''Formats a value for COPY's text format'''
+    if value is None:
+        return '\\N'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def copy_and_merge(cur, merge:Merge, records:list[dict]) -> list[dict]:
+    '''Streams records into a staging table with COPY, then merges them into 
+    the table. Returns the rows written, as returned by the merge.'''
+    staging = f'{merge.table}_staging'
+    cur.execute(f'CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {merge.table} INCLUDING DEFAULTS) '
+                f'ON COMMIT DELETE ROWS')
+    cur.execute(f'TRUNCATE {staging}')
+    data = io.StringIO(''.join('\t'.join(copy_value(record.get(column)) for column in merge.columns) + '\n'
+                               for record in records))
+    cur.copy_expert(f'COPY {staging} ({", ".join(merge.columns)}) FROM STDIN', data)
+    cur.execute(merge.staged(staging))
+    rows = cur.fetchall()
+    cur.execute(f'TRUNCATE {staging}')
+    return rows
+
+def insert_each(cur, merge:Merge, records:list[dict]) -> tuple[list[dict], list]:
+    '''Merges records one at a time under savepoints. Returns the rows 
+    written, and the (record, error) pairs that failed.'''
+    query = merge.query(f'VALUES ({", ".join(f"%({column})s" for column in merge.columns)})')
+    rows, failed = [], []
+    for record in records:
+        cur.execute('SAVEPOINT load_row')
+        try:
+            cur.execute(query, {column: record.get(column) for column in merge.columns})
+            rows += cur.fetchall()
+            cur.execute('RELEASE SAVEPOINT load_row')
+        except psycopg2.Error as e:
+            cur.execute('ROLLBACK TO SAVEPOINT load_row')
+            failed.append((record, str(e).strip()))
+    return rows, failed
+
+def quarantine(cur, table:str, rejects:list[tuple[dict, str]]):
+    '''Saves rejected records and their reasons to the table's reject table'''
+    cur.execute(f'CREATE TABLE IF NOT EXISTS {table}_rejects ('
+                'rejected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, '
+                'reason VARCHAR(1000), record JSONB)')
+    for record, reason in rejects:
+        cur.execute(f'INSERT INTO {table}_rejects (reason, record) VALUES (%s, %s)',
+                    (reason[:1000], json.dumps(record, default=str)))
+
+def bulk_load(conn:psycopg2.extensions.connection, table:str, records:list[dict], 
+              keep:tuple=(), touch:str | None=None) -> dict:
+    '''Loads records into table without committing. Returns counts of rows 
+    inserted, updated, left unchanged and rejected, the time taken, the rows 
+    written (their key and whether they were inserted) and the rejected 
+    (record, reason) pairs.'''
+    start = time.perf_counter()
+    if not records:
+        return {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0, 
+                'seconds': 0.0, 'written': [], 'rejects': []}
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        schema = table_schema(cur, table)
+        columns = list(dict.fromkeys(column for record in records for column in record))
+        merge = Merge(table, columns, primary_key(cur, table), keep, touch)
+        valid, rejects = [], []
+        for record in records:
+            error = record_error(record, schema)
+            if error:
+                rejects.append((record, error))
+            else:
+                valid.append(record)
+
+        rows = []
+        if valid:
+            cur.execute('SAVEPOINT bulk_load')
+            try:
+                rows = copy_and_merge(cur, merge, valid)
+                cur.execute('RELEASE SAVEPOINT bulk_load')
+            except psycopg2.Error:
+                cur.execute('ROLLBACK TO SAVEPOINT bulk_load')
+                rows, failed = insert_each(cur, merge, valid)
+                rejects.extend(failed)
+        if rejects:
+            quarantine(cur, table, rejects)
+    inserted, updated = written(rows)
+    return {'rows': len(records),
+            'inserted': inserted,
+            'updated': updated,
+            'unchanged': len(records) - len(rejects) - inserted - updated,
+            'rejected': len(rejects),
+            'seconds': time.perf_counter() - start,
+            'written': [dict(row) for row in rows],
+            'rejects': rejects}
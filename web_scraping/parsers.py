@@ -0,0 +1,276 @@
+'''HTML parser backends for the scraper.
+
+The page and coin functions in web_scraper.py only use a small part of the
+BeautifulSoup API: find, find_all, get_text/text, attrs, item access,
+next_sibling, string, contents, len and str. The 'bs4' backend returns a
+BeautifulSoup document; the 'lxml' backend wraps lxml's tree in nodes that
+implement the same subset with the same results, without building a second
+tree in Python. stream_rows parses a page incrementally with the same nodes,
+keeping only the rows of the latest chunk.'''
+import codecs
+import itertools
+import re
+from typing import Iterable, Iterator
+from lxml import etree
+from bs4 import BeautifulSoup
+from bs4.dammit import EncodingDetector
+
+# Strings inside these tags are not plain text to BeautifulSoup, so get_text()
+# on any other tag leaves them out
+string_containers = {'rt', 'rp', 'style', 'script', 'template'}
+
+# Attributes BeautifulSoup splits into lists of values
+list_attributes = {'*': {'class', 'accesskey', 'dropzone'}, 'a': {'rel', 'rev'},
+                   'link': {'rel', 'rev'}, 'td': {'headers'}, 'th': {'headers'},
+                   'form': {'accept-charset'}, 'object': {'archive'}, 'area': {'rel'},
+                   'icon': {'sizes'}, 'iframe': {'sandbox'}, 'output': {'for'}}
+attribute_value = re.compile(r'\S+')
+
+# BeautifulSoup collapses whitespace-only strings outside these tags
+preserve_whitespace = {'pre', 'textarea'}
+ascii_spaces = set('\x20\x0a\x09\x0c\x0d')
+
+def collapse(value:str, preserve:bool) -> str:
+    '''Returns a string as BeautifulSoup stores it'''
+    if preserve or (value and (not value.isspace() or not set(value) <= ascii_spaces)):
+        return value
+    return '\n' if '\n' in value else ' '
+
+def preserves_whitespace(element) -> bool:
+    return any(tag.tag in preserve_whitespace for tag in (element, *element.iterancestors()))
+
+def string_kind(element) -> str:
+    '''Returns the container tag of strings directly inside element, or 'text' '''
+    for tag in (element, *element.iterancestors()):
+        if tag.tag in string_containers:
+            return tag.tag
+    return 'text'
+
+def wrap(element):
+    '''Returns the node for an lxml element, comment or processing instruction'''
+    if element is None:
+        return None
+    if not isinstance(element.tag, str):
+        return LxmlString(element.text or '', element, 'comment')
+    return LxmlNode(element)
+
+class LxmlString(str):
+    '''A string node: an element's text or tail, or a comment'''
+
+    def __new__(cls, value:str, element, position:str):
+        if not value or value.isspace():
+            anchor = element if position == 'text' else element.getparent()
+            value = collapse(value, anchor is not None and preserves_whitespace(anchor))
+        string = super().__new__(cls, value)
+        string.element = element
+        string.position = position
+        return string
+
+    @property
+    def next_sibling(self):
+        if self.position == 'text':
+            return wrap(self.element[0]) if len(self.element) else None
+        if self.position == 'comment' and self.element.tail:
+            return LxmlString(self.element.tail, self.element, 'tail')
+        return wrap(self.element.getnext())
+
+    @property
+    def string(self):
+        return self
+
+    def kind(self) -> str:
+        if self.position == 'comment':
+            return 'comment'
+        if self.position == 'text':
+            return string_kind(self.element)
+        parent = self.element.getparent()
+        return 'text' if parent is None else string_kind(parent)
+
+    def get_text(self, separator:str='', strip:bool=False) -> str:
+        if self.kind() != 'text':
+            return ''
+        return self.strip() if strip else str(self)
+
+    @property
+    def text(self) -> str:
+        return self.get_text()
+
+class LxmlNode:
+    '''An element node with the BeautifulSoup Tag methods the scraper uses'''
+
+    __slots__ = ('element', 'document')
+
+    def __init__(self, element, document:bool=False):
+        self.element = element
+        # A document's searches include its root element
+        self.document = document
+
+    @property
+    def name(self) -> str:
+        return self.element.tag
+
+    @property
+    def attrs(self) -> dict:
+        split = list_attributes['*'] | list_attributes.get(self.element.tag, set())
+        return {name: attribute_value.findall(value) if name in split else value
+                for name, value in self.element.attrib.items()}
+
+    def __getitem__(self, key:str):
+        return self.attrs[key]
+
+    def get(self, key:str, default=None):
+        return self.attrs.get(key, default)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    def __str__(self) -> str:
+        # The element's markup as parsed, for substring checks
+        return etree.tostring(self.element, encoding='unicode', method='html', with_tail=False)
+
+    @property
+    def contents(self) -> list:
+        element = self.element
+        nodes = [LxmlString(element.text, element, 'text')] if element.text else []
+        for child in element:
+            nodes.append(wrap(child))
+            if child.tail:
+                nodes.append(LxmlString(child.tail, child, 'tail'))
+        return nodes
+
+    @property
+    def next_sibling(self):
+        if self.element.tail:
+            return LxmlString(self.element.tail, self.element, 'tail')
+        return wrap(self.element.getnext())
+
+    @property
+    def string(self):
+        contents = self.contents
+        if len(contents) != 1:
+            return None
+        return contents[0].string
+
+    def find_all(self, name:str | None=None, **attrs) -> list:
+        '''Returns descendant elements named name whose attributes match attrs,
+        where True only requires the attribute to be present'''
+        elements = self.element.iter(name) if self.document else self.element.iterdescendants(name)
+        found = []
+        for element in elements:
+            if not isinstance(element.tag, str):
+                continue
+            if attrs and not all(key in element.attrib if value is True else LxmlNode(element).get(key) == value
+                                 for key, value in attrs.items()):
+                continue
+            found.append(LxmlNode(element))
+        return found
+
+    def find(self, name:str | None=None, **attrs):
+        found = self.find_all(name, **attrs)
+        return found[0] if found else None
+
+    def strings(self):
+        '''Yields the plain text strings inside the element'''
+        own_kind = self.element.tag if self.element.tag in string_containers else 'text'
+
+        def walk(element, kind, preserve):
+            if element.text and kind == own_kind:
+                yield collapse(element.text, preserve)
+            for child in element:
+                if isinstance(child.tag, str):
+                    yield from walk(child, child.tag if child.tag in string_containers else kind, 
+                                    preserve or child.tag in preserve_whitespace)
+                if child.tail and kind == own_kind:
+                    yield collapse(child.tail, preserve)
+
+        yield from walk(self.element, string_kind(self.element), preserves_whitespace(self.element))
+
+    def get_text(self, separator:str='', strip:bool=False) -> str:
+        if strip:
+            return separator.join(text.strip() for text in self.strings() if text.strip())
+        return separator.join(self.strings())
+
+    @property
+    def text(self) -> str:
+        return self.get_text()
+
+def bs4_document(content:bytes | str) -> BeautifulSoup:
+    return BeautifulSoup(content, 'lxml')
+
+def lxml_document(content:bytes | str) -> LxmlNode:
+    root = None
+    if isinstance(content, str):
+        if content.strip():
+            root = etree.fromstring(content, etree.HTMLParser())
+    elif content.strip():
+        # Try encodings in the order BeautifulSoup does, so both backends see the same text
+        for encoding in EncodingDetector(content, is_html=True).encodings:
+            try:
+                root = etree.fromstring(content, etree.HTMLParser(encoding=encoding))
+                break
+            except (UnicodeDecodeError, LookupError, etree.ParserError):
+                continue
+    if root is None:
+        root = etree.fromstring('<html></html>', etree.HTMLParser())
+    return LxmlNode(root, document=True)
+
+backends = {'bs4': bs4_document, 'lxml': lxml_document}
+
+def parse_html(content:bytes | str, backend:str='lxml'):
+    '''Returns a document for a page's raw html using the named backend'''
+    return backends[backend](content)
+
+def stream_encoding(head:bytes) -> str | None:
+    '''Returns the first encoding BeautifulSoup would try that can decode the 
+    start of a page'''
+    for encoding in EncodingDetector(head, is_html=True).encodings:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return None
+
+def release(element):
+    '''Frees a processed element's subtree and the siblings before it, unless 
+    it's inside another element of its kind, which is freed later'''
+    if next(element.iterancestors(element.tag), None) is not None:
+        return
+    element.clear(keep_tail=True)
+    parent = element.getparent()
+    while element.getprevious() is not None:
+        del parent[0]
+
+def stream_rows(chunks:Iterable[bytes], tag:str='tr', head_size:int=4096) -> Iterator[tuple]:
+    '''Parses a page as its raw html arrives in chunks, yielding (document, row) 
+    for every tag element once it's complete, where document holds everything 
+    parsed so far. A row is freed once the caller moves on to the next one, so 
+    the tree only holds rows of the latest chunk and memory stays flat however 
+    many rows the page has. The encoding is chosen from the first head_size 
+    bytes.'''
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= head_size:
+            break
+    if not head.strip():
+        return
+    parser = etree.HTMLPullParser(events=('end',), tag=tag, encoding=stream_encoding(head))
+
+    def rows():
+        for _, element in parser.read_events():
+            yield LxmlNode(element.getroottree().getroot(), document=True), LxmlNode(element)
+            release(element)
+
+    for chunk in itertools.chain([head], chunks):
+        parser.feed(chunk)
+        yield from rows()
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        return
+    yield from rows()
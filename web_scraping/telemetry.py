@@ -0,0 +1,138 @@
+'''Telemetry of crawl runs.
+
+Every page that leaves the crawl is recorded as one JSON line: the time it
+waited for the politeness budget, its fetch latency, HTTP status and size, the
+time spent parsing, enriching and loading it, how many coins it yielded and how
+often each coin field was filled. Coins are loaded in batches across pages, so
+a page's load time is its share (by coins) of its batch's. Totals are kept as
+pages are recorded and written as a summary line at the end of the run. They
+can also be exported while the run goes on, as a Prometheus text file that is
+rewritten every few seconds (e.g. for node_exporter's textfile collector).'''
+import json
+import os
+import time
+
+phases = ('wait', 'fetch', 'parse', 'enrich', 'load')
+
+def fill_rates(coins:list[dict]) -> dict[str, float]:
+    '''Returns the fraction of coins with a value for each field'''
+    if not coins:
+        return {}
+    fields = dict.fromkeys(field for coin in coins for field in coin)
+    return {field: sum(1 for coin in coins if coin.get(field) not in (None, '')) / len(coins)
+            for field in fields}
+
+def percentile(values:list[float], fraction:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+class Telemetry:
+    '''Per-page metrics of a crawl, appended as JSON lines to log_path (if
+    given) and totalled for the run summary. With a metrics_path, the totals
+    are exported there at most every export_interval seconds.'''
+
+    def __init__(self, log_path:str | None=None, metrics_path:str | None=None, export_interval:float=15.0):
+        self.metrics_path = metrics_path
+        self.export_interval = export_interval
+        self.started = time.time()
+        self.exported = time.monotonic()
+        self.pages = {}
+        self.seconds = dict.fromkeys(phases, 0.0)
+        self.latencies = []
+        self.parse_times = []
+        self.bytes = 0
+        self.coins = 0
+        self.filled = {}
+        self.log = None
+        if log_path:
+            os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+            self.log = open(log_path, 'a')
+            self.write({'event': 'start'})
+
+    def write(self, line:dict):
+        self.log.write(json.dumps({'time': round(time.time(), 3), **line}, default=str) + '\n')
+        self.log.flush()
+
+    def record(self, page:str, status:str, coins:list[dict] | None=None, **metrics):
+        '''Records a page that left the crawl as done, unchanged or failed,
+        with its metrics (wait_seconds, fetch_seconds, bytes, ...) and coins'''
+        self.pages[status] = self.pages.get(status, 0) + 1
+        for phase in phases:
+            self.seconds[phase] += metrics.get(f'{phase}_seconds', 0.0)
+        if 'fetch_seconds' in metrics:
+            self.latencies.append(metrics['fetch_seconds'])
+        if 'parse_seconds' in metrics:
+            self.parse_times.append(metrics['parse_seconds'])
+        self.bytes += metrics.get('bytes', 0)
+        if coins:
+            metrics['coins'] = len(coins)
+            metrics['fill'] = fill_rates(coins)
+            self.coins += len(coins)
+            for field, rate in metrics['fill'].items():
+                self.filled[field] = self.filled.get(field, 0) + round(rate * len(coins))
+        if self.log:
+            self.write({'event': 'page', 'url': page, 'status': status, **metrics})
+        if self.metrics_path and time.monotonic() - self.exported >= self.export_interval:
+            self.export()
+
+    def summary(self) -> dict:
+        '''Returns the run's totals so far'''
+        return {'elapsed_seconds': time.time() - self.started,
+                'pages': dict(self.pages),
+                'seconds': dict(self.seconds),
+                'bytes': self.bytes,
+                'coins': self.coins,
+                'fetch_seconds': {'p50': percentile(self.latencies, 0.5), 'p95': percentile(self.latencies, 0.95),
+                                  'max': max(self.latencies, default=0.0)},
+                'parse_seconds': {'p50': percentile(self.parse_times, 0.5), 'p95': percentile(self.parse_times, 0.95),
+                                  'max': max(self.parse_times, default=0.0)},
+                'fill': {field: count / self.coins for field, count in self.filled.items()} if self.coins else {}}
+
+    def export(self):
+        '''Writes the totals so far to metrics_path in Prometheus' text format'''
+        summary = self.summary()
+        lines = ['# TYPE scraper_elapsed_seconds gauge', f'scraper_elapsed_seconds {summary["elapsed_seconds"]:.3f}',
+                 '# TYPE scraper_pages_total counter']
+        lines += [f'scraper_pages_total{{status="{status}"}} {count}' for status, count in summary['pages'].items()]
+        lines.append('# TYPE scraper_phase_seconds_total counter')
+        lines += [f'scraper_phase_seconds_total{{phase="{phase}"}} {seconds:.3f}'
+                  for phase, seconds in summary['seconds'].items()]
+        lines += ['# TYPE scraper_fetched_bytes_total counter', f'scraper_fetched_bytes_total {summary["bytes"]}',
+                  '# TYPE scraper_coins_total counter', f'scraper_coins_total {summary["coins"]}']
+        for name in ('fetch_seconds', 'parse_seconds'):
+            lines.append(f'# TYPE scraper_{name} summary')
+            lines += [f'scraper_{name}{{quantile="{quantile}"}} {summary[name][key]:.6f}'
+                      for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('1', 'max'))]
+        lines.append('# TYPE scraper_field_fill_ratio gauge')
+        lines += [f'scraper_field_fill_ratio{{field="{field}"}} {rate:.4f}' for field, rate in summary['fill'].items()]
+        os.makedirs(os.path.dirname(self.metrics_path) or '.', exist_ok=True)
+        with open(self.metrics_path + '.tmp', 'w') as metrics:
+            metrics.write('\n'.join(lines) + '\n')
+        os.replace(self.metrics_path + '.tmp', self.metrics_path)
+        self.exported = time.monotonic()
+
+    def report(self) -> list[str]:
+        '''Returns the run summary as report lines'''
+        summary = self.summary()
+        pages = ', '.join(f'{count} {status}' for status, count in sorted(summary['pages'].items())) or 'none'
+        seconds = ', '.join(f'{summary["seconds"][phase]:.2f}s {phase}' for phase in phases)
+        fetch, parse = summary['fetch_seconds'], summary['parse_seconds']
+        lines = [f'run: {summary["elapsed_seconds"]:.2f}s elapsed; pages: {pages}; '
+                 f'{summary["bytes"] / 2**20:.2f} MiB fetched; {summary["coins"]} coins',
+                 f'time across workers: {seconds}',
+                 f'fetch latency p50 {fetch["p50"]:.3f}s p95 {fetch["p95"]:.3f}s max {fetch["max"]:.3f}s; '
+                 f'parse time p50 {parse["p50"]:.3f}s p95 {parse["p95"]:.3f}s max {parse["max"]:.3f}s']
+        if summary['fill']:
+            lines.append('field fill rates: ' + ', '.join(f'{field} {rate:.0%}' for field, rate in summary['fill'].items()))
+        return lines
+
+    def close(self):
+        '''Writes the run summary to the log, and a last export of the totals'''
+        if self.metrics_path:
+            self.export()
+        if self.log:
+            self.write({'event': 'summary', **self.summary()})
+            self.log.close()
+            self.log = None
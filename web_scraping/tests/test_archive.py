@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+import unittest
+# Add cwd to path
+sys.path.append(os.getcwd())
+from archive import PageArchive, read_page
+
+# PageArchive
+class TestPageArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = PageArchive(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store_and_read(self):
+        self.archive.store('http://testurl.com/page1', b'<html>one</html>')
+        self.archive.store('http://testurl.com/page0', b'<html>zero</html>')
+        self.assertEqual(self.archive.read('http://testurl.com/page1'), b'<html>one</html>')
+        self.assertIsNone(self.archive.read('http://testurl.com/missing'))
+        entries = self.archive.entries()
+        self.assertEqual([entry['url'] for entry in entries], ['http://testurl.com/page0', 'http://testurl.com/page1'])
+        self.assertEqual(read_page(entries[0]['path']), b'<html>zero</html>')
+        self.assertEqual(entries[0]['size'], 17)
+
+    def test_compressed(self):
+        html = b'<tr><td>RIC 12</td><td>AR Denarius</td></tr>' * 1000
+        self.archive.store('http://testurl.com/page1', html)
+        self.assertLess(os.path.getsize(self.archive.page_path('http://testurl.com/page1')), len(html) // 10)
+
+    def test_store_unchanged(self):
+        url = 'http://testurl.com/page1'
+        self.archive.store(url, b'<html>one</html>')
+        fetched = self.archive.lookup(url)['fetched']
+        self.archive.store(url, b'<html>one</html>')
+        self.assertEqual(self.archive.lookup(url)['fetched'], fetched)
+        self.archive.store(url, b'<html>two</html>')
+        self.assertEqual(self.archive.read(url), b'<html>two</html>')
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+import httpx
+# Add cwd to path
+sys.path.append(os.getcwd())
+from archive import PageArchive
+from enrich import fetch_files
+from fetcher import Fetcher, HttpCache
+
+# fetch_files()
+class TestFetchFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = PageArchive(self.directory.name)
+        self.requested = []
+        self.active = []
+        self.peak = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def handler(self, request):
+        self.requested.append(request.url.path)
+        self.active.append(1)
+        self.peak = max(self.peak, len(self.active))
+        await asyncio.sleep(0.01)
+        self.active.pop()
+        if request.url.path == '/missing.txt':
+            return httpx.Response(404)
+        if request.url.path == '/broken.txt':
+            return httpx.Response(500)
+        return httpx.Response(200, content=f'file {request.url.path}'.encode())
+
+    def fetch(self, urls, concurrency=3, http_cache=None):
+        async def fetch():
+            async with Fetcher(requests_per_minute=60000, burst=50, max_connections=10,
+                               transport=httpx.MockTransport(self.handler), cache=http_cache) as fetcher:
+                return await fetch_files(urls, fetcher, self.cache, concurrency)
+        return asyncio.run(fetch())
+
+    def test_fetch_files(self):
+        urls = [f'http://testsite.com/{i}.txt' for i in range(12)] + ['http://testsite.com/missing.txt', 
+                                                                     'http://testsite.com/broken.txt']
+        contents, stats = self.fetch(urls + urls[:2])
+        self.assertEqual(contents['http://testsite.com/3.txt'], b'file /3.txt')
+        self.assertEqual(len(contents), 12)
+        self.assertEqual(stats, {'cached': 0, 'fetched': 12, 'missing': 1, 'failed': 1})
+        # Each file is requested once, with at most 3 in flight
+        self.assertEqual(len(self.requested), 14)
+        self.assertLessEqual(self.peak, 3)
+
+    def test_resume_from_cache(self):
+        urls = ['http://testsite.com/1.txt', 'http://testsite.com/missing.txt', 'http://testsite.com/broken.txt']
+        self.fetch(urls)
+        self.requested.clear()
+        contents, stats = self.fetch(urls)
+        # Only the file that failed is requested again
+        self.assertEqual(self.requested, ['/broken.txt'])
+        self.assertEqual(contents, {'http://testsite.com/1.txt': b'file /1.txt'})
+        self.assertEqual(stats, {'cached': 1, 'fetched': 0, 'missing': 1, 'failed': 1})
+
+    def test_page_cache_untouched(self):
+        url = 'http://testsite.com/1.txt'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            http_cache = HttpCache(cache_dir)
+            http_cache.store(url, httpx.Headers({'etag': '"v1"'}))
+            contents, _ = self.fetch([url], http_cache=http_cache)
+        # Files aren't revalidated against, or counted in, the page cache
+        self.assertEqual(contents, {url: b'file /1.txt'})
+        self.assertEqual(http_cache.stats, {'requests': 0, 'revalidations': 0, 'hits': 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,316 @@
+import os
+import sys
+import asyncio
+import tempfile
+import threading
+import time
+import unittest
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+# Add cwd to path
+sys.path.append(os.getcwd())
+from fetcher import TokenBucket, RateController, HttpCache, Fetcher, retry_after, backoff_delay
+
+# TokenBucket
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.clock = lambda: self.now
+
+    def test_burst(self):
+        bucket = TokenBucket(requests_per_minute=60, burst=3, clock=self.clock)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(bucket.reserve(), 1.0)
+
+    def test_queued_reservations(self):
+        bucket = TokenBucket(requests_per_minute=2, burst=1, clock=self.clock)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 30.0)
+        self.assertEqual(bucket.reserve(), 60.0)
+
+    def test_refill(self):
+        bucket = TokenBucket(requests_per_minute=60, burst=2, clock=self.clock)
+        bucket.reserve()
+        bucket.reserve()
+        self.now = 1.5
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.5)
+        # Idle time never banks more than the burst
+        self.now = 100.0
+        self.assertEqual([bucket.reserve() for _ in range(2)], [0.0, 0.0])
+        self.assertGreater(bucket.reserve(), 0.0)
+
+    def test_set_rate_and_defer(self):
+        bucket = TokenBucket(requests_per_minute=60, burst=1, clock=self.clock)
+        bucket.reserve()
+        bucket.set_rate(120)
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.now = 1.0
+        bucket.defer(5)
+        self.assertEqual(bucket.reserve(), 5.0)
+
+# Retry helpers
+class TestRetryHelpers(unittest.TestCase):
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after('120'), 120.0)
+        self.assertEqual(retry_after('-3'), 0.0)
+        self.assertAlmostEqual(retry_after(formatdate(1000.0 + 30, usegmt=True), now=1000.0), 30.0)
+        self.assertIsNone(retry_after(None))
+        self.assertIsNone(retry_after('soon'))
+
+    def test_backoff_delay(self):
+        for attempt in range(8):
+            delay = backoff_delay(attempt, base=1.0, cap=20.0)
+            full = min(20.0, 2 ** attempt)
+            self.assertGreaterEqual(delay, full / 2)
+            self.assertLessEqual(delay, full)
+
+# RateController
+class TestRateController(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = TokenBucket(requests_per_minute=10, clock=lambda: 0.0)
+
+    def test_additive_increase_to_ceiling(self):
+        controller = RateController(self.bucket, floor=2, ceiling=14, increase=1, slow_seconds=5)
+        for _ in range(3):
+            controller.record(0.5, failed=False)
+        self.assertEqual(controller.requests_per_minute, 13)
+        for _ in range(3):
+            controller.record(0.5, failed=False)
+        self.assertEqual(controller.requests_per_minute, 14)
+        self.assertEqual(self.bucket.rate, 14 / 60)
+
+    def test_multiplicative_decrease_to_floor(self):
+        controller = RateController(self.bucket, floor=2, ceiling=14, increase=1)
+        controller.record(0.5, failed=True)
+        self.assertEqual(controller.requests_per_minute, 5)
+        for _ in range(3):
+            controller.record(0.5, failed=True)
+        self.assertEqual(controller.requests_per_minute, 2)
+        self.assertEqual(self.bucket.rate, 2 / 60)
+
+    def test_slow_responses(self):
+        controller = RateController(self.bucket, floor=1, ceiling=14, slow_seconds=2)
+        controller.record(8.0, failed=False)
+        self.assertEqual(controller.requests_per_minute, 5)
+
+    def test_error_rate_holds_rate(self):
+        controller = RateController(self.bucket, floor=1, ceiling=20, increase=1, window=10, max_error_rate=0.1)
+        controller.record(0.5, failed=True)
+        controller.record(0.5, failed=True)
+        # 2 of the last 10 failed, so successes don't raise the rate yet
+        for _ in range(8):
+            controller.record(0.5, failed=False)
+        self.assertEqual(controller.requests_per_minute, 2.5)
+        controller.record(0.5, failed=False)
+        self.assertEqual(controller.requests_per_minute, 3.5)
+
+# Stub site served on a local port; each path answers with a scripted sequence
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path, time.monotonic()))
+        script = self.server.scripts[self.path]
+        status, headers, delay = script.pop(0) if len(script) > 1 else script[0]
+        time.sleep(delay)
+        body = f'page {self.path}'.encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class TestFetcherRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.scripts = {}
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        self.base = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path:str, **options):
+        async def fetch():
+            async with Fetcher(**options) as fetcher:
+                content = await fetcher.fetch(self.base + path)
+                return content, fetcher.controller(self.base + path)
+        return asyncio.run(fetch())
+
+    def test_retry_after(self):
+        self.server.scripts['/busy'] = [(503, {'Retry-After': '0.3'}, 0), (200, {}, 0)]
+        content, controller = self.fetch('/busy', requests_per_minute=6000, retries=2, backoff_base=0.01)
+        self.assertEqual(content, b'page /busy')
+        times = [t for _, t in self.server.requests]
+        self.assertEqual(len(times), 2)
+        self.assertGreaterEqual(times[1] - times[0], 0.3)
+
+    def test_timeout_retry(self):
+        self.server.scripts['/slow'] = [(200, {}, 0.5), (200, {}, 0)]
+        content, controller = self.fetch('/slow', requests_per_minute=6000, min_requests_per_minute=600,
+                                         timeout=0.1, retries=2, backoff_base=0.01)
+        self.assertEqual(content, b'page /slow')
+        self.assertEqual(len(self.server.requests), 2)
+        # The timeout halved the rate, which holds while the recent error rate is high
+        self.assertEqual(controller.requests_per_minute, 3000)
+        self.assertEqual(controller.error_rate(), 0.5)
+
+    def test_retries_exhausted(self):
+        self.server.scripts['/down'] = [(500, {}, 0)]
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.fetch('/down', requests_per_minute=6000, retries=3, backoff_base=0.01)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_not_retried(self):
+        self.server.scripts['/missing'] = [(404, {}, 0)]
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.fetch('/missing', requests_per_minute=6000, retries=3, backoff_base=0.01)
+        self.assertEqual(len(self.server.requests), 1)
+
+# Fetcher
+class TestFetcher(unittest.TestCase):
+
+    def test_fetch_content(self):
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=b'TEST HTML CONTENT'))
+
+        async def fetch():
+            async with Fetcher(requests_per_minute=6000, transport=transport) as fetcher:
+                return await fetcher.fetch('http://testsite.com/coins/ric/augustus/i.html')
+
+        self.assertEqual(asyncio.run(fetch()), b'TEST HTML CONTENT')
+
+    def test_rate_bounds(self):
+        async def make_controller(**options):
+            async with Fetcher(requests_per_minute=8, **options) as fetcher:
+                return fetcher.controller('http://testsite.com/coins/ric/augustus/i.html')
+
+        # By default the rate never goes past the configured politeness
+        controller = asyncio.run(make_controller())
+        self.assertEqual((controller.floor, controller.ceiling), (2, 8))
+        controller.record(0.5, failed=True)
+        self.assertEqual(controller.requests_per_minute, 4)
+        for _ in range(30):
+            controller.record(0.5, failed=False)
+        self.assertEqual(controller.requests_per_minute, 8)
+
+        # With a higher max rate, it recovers past where it started
+        controller = asyncio.run(make_controller(max_requests_per_minute=16))
+        controller.record(0.5, failed=True)
+        for _ in range(30):
+            controller.record(0.5, failed=False)
+        self.assertEqual(controller.requests_per_minute, 16)
+
+    def test_fetch_failure(self):
+        transport = httpx.MockTransport(lambda request: httpx.Response(404))
+
+        async def fetch():
+            async with Fetcher(requests_per_minute=6000, transport=transport) as fetcher:
+                return await fetcher.fetch('http://testsite.com/coins/ric/augustus/i.html')
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            asyncio.run(fetch())
+
+    def test_politeness_per_host(self):
+        requests = []
+        def handler(request):
+            requests.append((request.url.host, time.monotonic()))
+            return httpx.Response(200)
+        transport = httpx.MockTransport(handler)
+        urls = [f'http://{host}/page{i}' for host in ('site-a.com', 'site-b.com') for i in range(3)]
+
+        async def fetch_all():
+            # Held at the starting rate, so the spacing doesn't adapt
+            async with Fetcher(requests_per_minute=600, max_requests_per_minute=600, burst=1, 
+                               max_connections=6, transport=transport) as fetcher:
+                await asyncio.gather(*[fetcher.fetch(url) for url in urls])
+
+        start = time.monotonic()
+        asyncio.run(fetch_all())
+        elapsed = time.monotonic() - start
+        # 3 requests per host at 10/second: ~0.2s, with both hosts in parallel
+        self.assertGreaterEqual(elapsed, 0.19)
+        self.assertLess(elapsed, 0.35)
+        for host in ('site-a.com', 'site-b.com'):
+            times = [t for h, t in requests if h == host]
+            self.assertGreaterEqual(times[2] - times[0], 0.19)
+
+    def test_connection_bound(self):
+        active = []
+        peak = []
+        async def handler(request):
+            active.append(1)
+            peak.append(len(active))
+            await asyncio.sleep(0.02)
+            active.pop()
+            return httpx.Response(200)
+        transport = httpx.MockTransport(handler)
+
+        async def fetch_all():
+            async with Fetcher(requests_per_minute=60000, burst=20, max_connections=3, transport=transport) as fetcher:
+                await asyncio.gather(*[fetcher.fetch(f'http://testsite.com/{i}') for i in range(12)])
+
+        asyncio.run(fetch_all())
+        self.assertEqual(max(peak), 3)
+
+# HttpCache
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(self.directory.name)
+        self.url = 'http://testsite.com/coins/ric/augustus/i.html'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store_and_lookup(self):
+        self.assertEqual(self.cache.request_headers(self.url), {})
+        self.cache.store(self.url, httpx.Headers({'etag': '"abc"', 'last-modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}))
+        self.assertEqual(self.cache.request_headers(self.url), 
+                         {'If-None-Match': '"abc"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        # Entries persist across instances
+        self.assertEqual(HttpCache(self.directory.name).lookup(self.url)['etag'], '"abc"')
+
+    def test_no_validators(self):
+        self.cache.store(self.url, httpx.Headers({'content-type': 'text/html'}))
+        self.assertIsNone(self.cache.lookup(self.url))
+
+    def test_conditional_fetch(self):
+        def handler(request):
+            if request.headers.get('if-modified-since') == 'Mon, 01 Jan 2024 00:00:00 GMT':
+                return httpx.Response(304)
+            return httpx.Response(200, content=b'TEST HTML CONTENT', 
+                                  headers={'last-modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        transport = httpx.MockTransport(handler)
+        urls = [self.url, 'http://testsite.com/coins/ric/tiberius/i.html']
+        self.cache.store(self.url, httpx.Headers({'last-modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}))
+
+        async def fetch_all():
+            async with Fetcher(requests_per_minute=6000, burst=2, transport=transport, cache=self.cache) as fetcher:
+                contents = [await fetcher.fetch(url) for url in urls]
+                # Requests with their own headers bypass the cache
+                response = await fetcher.get(self.url, headers={})
+                return contents + [response.content]
+
+        self.assertEqual(asyncio.run(fetch_all()), [None, b'TEST HTML CONTENT', b'TEST HTML CONTENT'])
+        self.assertEqual(self.cache.stats, {'requests': 2, 'revalidations': 1, 'hits': 1})
+        self.assertIn('1 hits', self.cache.report())
+
+if __name__ == '__main__':
+    unittest.main()
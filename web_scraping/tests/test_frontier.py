@@ -0,0 +1,123 @@
+import os
+import sys
+import threading
+import unittest
+# Add cwd to path
+sys.path.append(os.getcwd())
+from frontier import Frontier
+from web_scraper import connect_db
+
+# Test database variables
+db_info = {'db_name':'test_database',
+           'db_user':'postgres',
+           'db_password':'postgres',
+           'db_host':'test_db'}
+
+# Frontier
+class TestFrontier(unittest.TestCase):
+
+    def setUp(self):
+        self.frontier = Frontier(lambda: connect_db(**db_info), table='test_frontier', max_attempts=2)
+        self.frontier.create()
+        self.urls = [f'http://testurl.com/page{i}' for i in range(5)]
+
+    def tearDown(self):
+        self.frontier.execute('DROP TABLE test_frontier')
+        self.frontier.close()
+
+    def test_add(self):
+        self.assertEqual(self.frontier.add(self.urls), 5)
+        self.assertEqual(self.frontier.add(self.urls + ['http://testurl.com/new']), 1)
+        self.assertEqual(self.frontier.progress(),
+                         {'pending': 6, 'claimed': 0, 'done': 0, 'failed': 0, 'total': 6})
+
+    def test_add_many(self):
+        # More URLs than execute_values inserts per statement
+        urls = [f'http://testurl.com/page{i}' for i in range(250)]
+        self.assertEqual(self.frontier.add(urls[:120]), 120)
+        self.assertEqual(self.frontier.add(urls), 130)
+        self.assertEqual(self.frontier.progress()['total'], 250)
+
+    def test_claim_in_order(self):
+        self.frontier.add(self.urls)
+        claimed = self.frontier.claim(2)
+        self.assertEqual([row['url'] for row in claimed], self.urls[:2])
+        self.assertEqual([row['url'] for row in self.frontier.claim(10)], self.urls[2:])
+        self.assertEqual(self.frontier.claim(), [])
+        self.assertEqual(self.frontier.remaining(), 5)
+
+    def test_done_and_failed(self):
+        self.frontier.add(self.urls[:2])
+        self.frontier.claim(2)
+        self.frontier.done(self.urls[0], 'abc')
+        self.frontier.failed(self.urls[1], 'HTTP 500')
+        # Failed pages are retried until they run out of attempts
+        self.assertEqual([row['url'] for row in self.frontier.claim(2)], [self.urls[1]])
+        self.frontier.failed(self.urls[1], 'HTTP 500')
+        self.assertEqual(self.frontier.claim(2), [])
+        self.assertEqual(self.frontier.remaining(), 0)
+        self.frontier.done(self.urls[0])
+        rows = self.frontier.execute('SELECT url, status, attempts, content_hash, error, last_fetched '
+                                     'FROM test_frontier ORDER BY url')
+        self.assertEqual([(row['status'], row['attempts'], row['content_hash'], row['error']) for row in rows],
+                         [('done', 1, 'abc', None), ('failed', 2, None, 'HTTP 500')])
+        self.assertTrue(all(row['last_fetched'] for row in rows))
+
+    def test_done_batch(self):
+        self.frontier.add(self.urls[:3])
+        self.frontier.claim(3)
+        self.frontier.done(self.urls[2], 'old')
+        conn = connect_db(**db_info)
+        try:
+            self.frontier.done_batch(conn, [(self.urls[0], 'abc'), (self.urls[2], None)])
+            # Nothing is done until the transaction commits
+            self.assertEqual(self.frontier.progress()['claimed'], 3 - 1)
+            conn.rollback()
+            self.assertEqual(self.frontier.progress()['done'], 1)
+            self.frontier.done_batch(conn, [(self.urls[0], 'abc'), (self.urls[2], None)])
+            conn.commit()
+        finally:
+            conn.close()
+        rows = self.frontier.execute('SELECT status, content_hash FROM test_frontier ORDER BY url')
+        self.assertEqual([(row['status'], row['content_hash']) for row in rows],
+                         [('done', 'abc'), ('claimed', None), ('done', 'old')])
+
+    def test_requeue(self):
+        self.frontier.add(self.urls[:3])
+        self.frontier.claim(3)
+        self.frontier.done(self.urls[0], 'abc')
+        self.frontier.failed(self.urls[1], 'HTTP 500')
+        # Only pages fetched longer ago than the max age are requeued
+        self.assertEqual(self.frontier.requeue(60), 0)
+        self.assertEqual(self.frontier.requeue(), 2)
+        rows = self.frontier.execute('SELECT status, attempts, content_hash FROM test_frontier ORDER BY url')
+        self.assertEqual([(row['status'], row['attempts'], row['content_hash']) for row in rows],
+                         [('pending', 0, 'abc'), ('pending', 0, None), ('claimed', 1, None)])
+        self.assertEqual([row['content_hash'] for row in self.frontier.claim(2)], ['abc', None])
+
+    def test_expired_claim(self):
+        self.frontier.add(self.urls[:1])
+        self.frontier.claim()
+        self.assertEqual(self.frontier.claim(), [])
+        self.frontier.execute("UPDATE test_frontier SET claimed_at = now() - interval '1 hour'")
+        self.assertEqual([row['url'] for row in self.frontier.claim()], self.urls[:1])
+
+    def test_concurrent_claims(self):
+        self.frontier.add([f'http://testurl.com/page{i}' for i in range(200)])
+        claims = []
+        def worker():
+            frontier = Frontier(lambda: connect_db(**db_info), table='test_frontier')
+            while rows := frontier.claim(3):
+                claims.extend(row['url'] for row in rows)
+            frontier.close()
+        workers = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        # Every page is claimed exactly once
+        self.assertEqual(len(claims), 200)
+        self.assertEqual(len(set(claims)), 200)
+
+if __name__ == '__main__':
+    unittest.main()
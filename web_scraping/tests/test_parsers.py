@@ -0,0 +1,125 @@
+import os
+import sys
+import unittest
+# Add cwd to path
+sys.path.append(os.getcwd())
+from parsers import parse_html, stream_rows, LxmlNode
+from web_scraper import (pull_title, pull_subtitle, pull_coins, coin_catalog,
+                         coin_description, coin_metal, coin_txt, parse_page, 
+                         stream_coins)
+
+fixtures = 'tests/test_data/test_html'
+
+# Page with the markup the scraper has to cope with: comments, scripts,
+# whitespace text between cells, multi-valued attributes and bare text
+tricky_html = b'''<html><head><title> Trajan, Roman Emperor</title>
+<script>var x = "<tr bgcolor=red>";</script></head>
+<body><h2>Trajan</h2>   <!-- note -->
+<p>RIC</p><p><b>Trajan</b> <i>98-117 AD</i></p><font>Browse</font>
+<table>
+<tr><td>header</td></tr>
+<tr> <td class="cat main" bgcolor="#C0C0C0">RIC 12<!-- x --></td>
+<td>Filler filler Filler filler AR Denarius, 3.2g, 18mm, AD 103 IMP CAES NERVA <style>p {}</style>TRAIAN</td>
+<td><a href="RIC_12.jpg">jpg</a> <a href="RIC_12.txt">txt</a></td>
+</tr>
+<tr bgcolor="#FFD700"><td>RIC 13</td>text<td>Too short</td><td><a name="x">no href</a></td></tr>
+</table></body></html>'''
+
+def records(coins:list[dict] | None) -> list[dict]:
+    return [{col: val for col, val in coin.items() if col not in ('id', 'created', 'modified')}
+            for coin in coins or []]
+
+class TestParserBackends(unittest.TestCase):
+
+    def pages(self):
+        for filename in sorted(os.listdir(fixtures)):
+            with open(os.path.join(fixtures, filename), 'rb') as html_file:
+                html = html_file.read()
+            yield filename, html
+            yield filename + ' (no newlines)', html.replace(b'\n', b'')
+        yield 'tricky', tricky_html
+
+    def test_identical_records(self):
+        for name, html in self.pages():
+            with self.subTest(page=name):
+                self.assertEqual(records(parse_page(html, 'lxml')), records(parse_page(html, 'bs4')))
+
+    def test_identical_page_fields(self):
+        for name, html in self.pages():
+            with self.subTest(page=name):
+                soup, document = parse_html(html, 'bs4'), parse_html(html, 'lxml')
+                self.assertEqual(pull_title(document), pull_title(soup))
+                self.assertEqual(pull_subtitle(document), pull_subtitle(soup))
+                soup_coins, document_coins = pull_coins(soup), pull_coins(document)
+                self.assertEqual(len(document_coins), len(soup_coins))
+                for soup_coin, document_coin in zip(soup_coins, document_coins):
+                    self.assertEqual([str(node) for node in document_coin if not isinstance(node, LxmlNode)],
+                                     [str(node) for node in soup_coin if isinstance(node, str)])
+                    self.assertEqual(coin_catalog(document_coin), coin_catalog(soup_coin))
+                    self.assertEqual(coin_description(document_coin), coin_description(soup_coin))
+                    self.assertEqual(coin_metal(document_coin), coin_metal(soup_coin))
+                    self.assertEqual(coin_txt(document_coin, 'Trajan'), coin_txt(soup_coin, 'Trajan'))
+
+    def test_nodes(self):
+        soup, document = parse_html(tricky_html, 'bs4'), parse_html(tricky_html, 'lxml')
+        self.assertEqual(document.find('td').attrs, soup.find('td').attrs)
+        self.assertEqual(document.find('title').text, soup.find('title').text)
+        self.assertEqual(document.find('h2').next_sibling, soup.find('h2').next_sibling)
+        self.assertEqual(document.find('h2').next_sibling.next_sibling,
+                         soup.find('h2').next_sibling.next_sibling)
+        self.assertEqual(document.find('h2').string, soup.find('h2').string)
+        self.assertEqual([p.get_text(strip=True) for p in document.find_all('p')],
+                         [p.get_text(strip=True) for p in soup.find_all('p')])
+        self.assertEqual([a['href'] for a in document.find_all('a', href=True)],
+                         [a['href'] for a in soup.find_all('a', href=True)])
+        self.assertEqual(document.get_text(), soup.get_text())
+        self.assertIsNone(document.find('h3'))
+
+    def test_encodings(self):
+        pages = [b'<html><body><td>caf\xc3\xa9 \xa0AVG</td></body></html>',
+                 '<html><head><meta charset="windows-1252"></head><body><td>caf\xe9 \u201cq\u201d</td></body></html>'.encode('cp1252')]
+        for html in pages:
+            with self.subTest(html=html):
+                self.assertEqual(parse_html(html, 'lxml').find('td').get_text(), 
+                                 parse_html(html, 'bs4').find('td').get_text())
+
+    def test_empty_page(self):
+        self.assertIsNone(parse_page(b'', 'lxml'))
+        self.assertIsNone(pull_title(parse_html(b'', 'lxml')))
+
+def chunked(html:bytes, size:int) -> list[bytes]:
+    return [html[i:i + size] for i in range(0, len(html), size)]
+
+class TestStreaming(unittest.TestCase):
+
+    def test_identical_records(self):
+        for name, html in TestParserBackends.pages(self):
+            for size in (7, 1000, len(html) or 1):
+                with self.subTest(page=name, chunk_size=size):
+                    self.assertEqual(records(list(stream_coins(chunked(html, size)))),
+                                     records(parse_page(html, 'lxml')))
+
+    def test_stream_backend(self):
+        page = 'https://www.wildwinds.com/coins/ric/trajan/i.html'
+        self.assertEqual([coin['id'] for coin in parse_page(tricky_html, 'stream', page)],
+                         [coin['id'] for coin in parse_page(tricky_html, 'lxml', page)])
+        self.assertIsNone(parse_page(b'', 'stream'))
+
+    def test_flat_memory(self):
+        row = (b'<tr><td bgcolor="#C0C0C0">RIC 12</td><td>AR Denarius, 3.2g, 18mm. IMP CAES NERVA TRAIAN '
+               b'AVG GERM, laureate head right / P M TR P COS II P P.</td><td><a href="a.txt">txt</a></td></tr>\n')
+        html = b'<html><head><title>Trajan</title></head><body><h2>Trajan</h2><table>' + row * 5000 + b'</table></body></html>'
+        largest = 0
+        for document, _ in stream_rows(chunked(html, 4096)):
+            largest = max(largest, len(document.element.xpath('//tr | //td')))
+        # Only rows of the latest 4 KiB chunk are kept, not the 5000 parsed before them
+        self.assertLessEqual(largest, (4096 // len(row) + 2) * 4)
+        self.assertEqual(sum(1 for _ in stream_coins(chunked(html, 4096))), 5000)
+
+    def test_encodings(self):
+        html = ('<html><head><meta charset="windows-1252"></head><body><table><tr><td bgcolor="red">caf\xe9</td>'
+                '<td>\u201cq\u201d ' + 'x' * 60 + '</td><td></td></tr></table></body></html>').encode('cp1252')
+        self.assertEqual(records(list(stream_coins(chunked(html, 5)))), records(parse_page(html, 'bs4')))
+
+if __name__ == '__main__':
+    unittest.main()
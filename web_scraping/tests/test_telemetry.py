@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+# Add cwd to path
+sys.path.append(os.getcwd())
+from telemetry import Telemetry, fill_rates, percentile
+
+# fill_rates()
+class TestFillRates(unittest.TestCase):
+
+    def test_fill_rates(self):
+        coins = [{'catalog': 'RIC 1', 'mass': 3.1, 'era': None},
+                 {'catalog': 'RIC 2', 'mass': None, 'era': ''},
+                 {'catalog': 'RIC 3', 'mass': 2.9, 'era': 'AD'},
+                 {'catalog': 'RIC 4', 'mass': 0.0}]
+        self.assertEqual(fill_rates(coins), {'catalog': 1.0, 'mass': 0.75, 'era': 0.25})
+
+    def test_fill_rates_empty(self):
+        self.assertEqual(fill_rates([]), {})
+
+# percentile()
+class TestPercentile(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [float(i) for i in range(100, 0, -1)]
+        self.assertEqual(percentile(values, 0.5), 51.0)
+        self.assertEqual(percentile(values, 0.95), 96.0)
+        self.assertEqual(percentile(values, 1), 100.0)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+# Telemetry
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.directory.name, 'logs', 'telemetry.jsonl')
+        self.metrics_path = os.path.join(self.directory.name, 'metrics.prom')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def lines(self) -> list[dict]:
+        with open(self.log_path) as log:
+            return [json.loads(line) for line in log]
+
+    def test_record(self):
+        telemetry = Telemetry(self.log_path)
+        coins = [{'catalog': 'RIC 1', 'mass': 3.1}, {'catalog': 'RIC 2', 'mass': None}]
+        telemetry.record('http://testurl.com/page1', 'done', coins, wait_seconds=2.0, fetch_seconds=0.5,
+                         bytes=1000, parse_seconds=0.1, load_seconds=0.2)
+        telemetry.record('http://testurl.com/page2', 'unchanged', wait_seconds=1.0, fetch_seconds=0.3, bytes=0)
+        telemetry.record('http://testurl.com/page3', 'failed', stage='fetch', error='timed out', wait_seconds=1.0)
+        telemetry.close()
+
+        lines = self.lines()
+        self.assertEqual([line['event'] for line in lines], ['start', 'page', 'page', 'page', 'summary'])
+        self.assertEqual((lines[1]['coins'], lines[1]['fill']), (2, {'catalog': 1.0, 'mass': 0.5}))
+        self.assertEqual((lines[3]['stage'], lines[3]['error']), ('fetch', 'timed out'))
+        summary = lines[-1]
+        self.assertEqual(summary['pages'], {'done': 1, 'unchanged': 1, 'failed': 1})
+        self.assertEqual(summary['seconds'], {'wait': 4.0, 'fetch': 0.8, 'parse': 0.1, 'enrich': 0.0, 'load': 0.2})
+        self.assertEqual((summary['bytes'], summary['coins']), (1000, 2))
+        self.assertEqual(summary['fetch_seconds']['max'], 0.5)
+        self.assertEqual(summary['fill'], {'catalog': 1.0, 'mass': 0.5})
+
+    def test_log_appends(self):
+        for _ in range(2):
+            telemetry = Telemetry(self.log_path)
+            telemetry.record('http://testurl.com/page1', 'unchanged')
+            telemetry.close()
+        self.assertEqual([line['event'] for line in self.lines()].count('summary'), 2)
+
+    def test_export(self):
+        telemetry = Telemetry(metrics_path=self.metrics_path, export_interval=0)
+        telemetry.record('http://testurl.com/page1', 'done', [{'catalog': 'RIC 1'}], fetch_seconds=0.25, bytes=512)
+        # Exported while the run goes on, not only at the end
+        with open(self.metrics_path) as metrics:
+            exported = metrics.read().splitlines()
+        self.assertIn('scraper_pages_total{status="done"} 1', exported)
+        self.assertIn('scraper_fetched_bytes_total 512', exported)
+        self.assertIn('scraper_fetch_seconds{quantile="0.5"} 0.250000', exported)
+        self.assertIn('scraper_field_fill_ratio{field="catalog"} 1.0000', exported)
+
+    def test_export_interval(self):
+        telemetry = Telemetry(metrics_path=self.metrics_path, export_interval=3600)
+        telemetry.record('http://testurl.com/page1', 'done')
+        self.assertFalse(os.path.exists(self.metrics_path))
+        telemetry.close()
+        self.assertTrue(os.path.exists(self.metrics_path))
+
+    def test_report(self):
+        telemetry = Telemetry()
+        telemetry.record('http://testurl.com/page1', 'done', [{'catalog': 'RIC 1', 'mass': None}],
+                         wait_seconds=30.0, fetch_seconds=1.5, bytes=2**20)
+        report = telemetry.report()
+        self.assertIn('pages: 1 done; 1.00 MiB fetched; 1 coins', report[0])
+        self.assertIn('30.00s wait, 1.50s fetch', report[1])
+        self.assertEqual(report[-1], 'field fill rates: catalog 100%, mass 0%')
+
+if __name__ == '__main__':
+    unittest.main()
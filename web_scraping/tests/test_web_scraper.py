@@ -1,9 +1,15 @@
 import os
 import sys
+import asyncio
+import hashlib
+import json
+import tempfile
+import time
 import unittest
-from unittest.mock import patch, MagicMock, call, mock_open
+from unittest.mock import patch, MagicMock, ANY, call, mock_open
 import psycopg2
 import requests
+import httpx
 from bs4 import BeautifulSoup
 import datetime
 # Add cwd to path
@@ -12,8 +18,14 @@ from web_scraper import (connect_db, create_table, get_pages, scrape_page,
                          pull_title, pull_subtitle, pull_coins, coin_id, 
                          coin_catalog, coin_description, coin_metal, coin_era, 
                          coin_year, coin_txt, coin_mass, coin_diameter, 
-                         coin_inscriptions, coins_from_soup, load_coins, 
-                         check_state, update_state, scrape_and_load, main)
+                         coin_inscriptions, CoinExtractor, coins_from_soup, load_coins, 
+                         parse_page, scrape_and_load, main, table_columns, 
+                         column_dtypes, coin_hash, hash_columns, hash_dtypes, replay, 
+                         fetch_config, txt_fields, merge_txt, enrich_coins, 
+                         discover_pages, inscriptions_list, notify_change)
+from fetcher import Fetcher
+from frontier import Frontier
+from archive import PageArchive
 
 # Test database variables
 db_info = {'db_name':'test_database',
@@ -117,8 +129,9 @@ class TestGetPages(unittest.TestCase):
         
         self.assertEqual(result, expected_pages)
     
+    @patch('web_scraper.sleep')
     @patch('web_scraper.requests.get')
-    def test_get_pages_failure(self, mock_get):
+    def test_get_pages_failure(self, mock_get, mock_sleep):
         mock_get.side_effect = requests.exceptions.ConnectionError
         mock_get.__enter__.side_effect = mock_get
         mock_get.__exit__.side_effect = None
@@ -127,7 +140,75 @@ class TestGetPages(unittest.TestCase):
 
         with self.assertRaises(requests.ConnectionError):
             get_pages(test_url)
-        mock_get.assert_called_once()
+        # Retried with backoff before giving up
+        self.assertEqual(mock_get.call_count, fetch_config['retries'] + 1)
+        self.assertEqual(mock_sleep.call_count, fetch_config['retries'])
+
+# discover_pages()
+class TestDiscoverPages(unittest.TestCase):
+
+    roots = ['http://testsite.com/coins/ric/i.html', 'http://testsite.com/coins/rsc/i.html']
+
+    def setUp(self):
+        with open('tests/test_data/test_html/test_page_index.html', 'rb') as index_file:
+            self.index = index_file.read()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.cache_dir.name, 'discovery.json')
+        self.requests = []
+        self.status = 200
+        self.etag = '"v1"'
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def handler(self, request:httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.status != 200:
+            return httpx.Response(self.status)
+        if self.etag and request.headers.get('if-none-match') == self.etag:
+            return httpx.Response(304)
+        headers = {'ETag': self.etag} if self.etag else {}
+        return httpx.Response(200, content=self.index, headers=headers)
+
+    def discover(self) -> list[str]:
+        with patch.dict('web_scraper.fetch_config', {'retries': 0}):
+            return discover_pages(self.roots, self.cache_file, httpx.MockTransport(self.handler))
+
+    def test_discover_pages(self):
+        start = time.perf_counter()
+        pages = self.discover()
+        # Both indexes are requested at once, without waiting for the rate limit
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(pages, sorted(f'http://testsite.com/coins/{catalog}/{ruler}/i.html' 
+                                       for catalog in ['ric', 'rsc'] 
+                                       for ruler in ['agrippa', 'augustus', 'claudius']))
+
+        # A second run revalidates the indexes and reuses their cached pages
+        with patch('web_scraper.index_pages') as mock_index_pages:
+            self.assertEqual(self.discover(), pages)
+        mock_index_pages.assert_not_called()
+        self.assertEqual([request.headers.get('if-none-match') for request in self.requests[2:]], 
+                         ['"v1"', '"v1"'])
+
+    def test_discover_pages_unchanged_content(self):
+        self.etag = None
+        pages = self.discover()
+        # Without validators an index whose content hasn't changed isn't parsed again
+        with patch('web_scraper.index_pages') as mock_index_pages:
+            self.assertEqual(self.discover(), pages)
+        mock_index_pages.assert_not_called()
+        self.assertNotIn('if-none-match', self.requests[-1].headers)
+
+    def test_discover_pages_error(self):
+        pages = self.discover()
+        # An index that fails falls back to its cached pages
+        self.status = 404
+        self.assertEqual(self.discover(), pages)
+        # And with no cached pages the error is raised
+        os.remove(self.cache_file)
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.discover()
 
 # scrape_page()
 class TestScrapePage(unittest.TestCase):
@@ -144,19 +225,32 @@ class TestScrapePage(unittest.TestCase):
 
         result = scrape_page(test_url)
 
-        mock_get.assert_called_with(test_url)
+        mock_get.assert_called_with(test_url, timeout=fetch_config['timeout'])
         self.assertIsInstance(result, BeautifulSoup)
         self.assertEqual(result, BeautifulSoup(test_html_content, 'lxml'))
 
+    @patch('web_scraper.sleep')
     @patch('web_scraper.requests.get')
-    def test_scrape_page_failure(self, mock_get):
+    def test_scrape_page_failure(self, mock_get, mock_sleep):
         mock_get.side_effect = requests.ConnectionError
 
         test_url = 'http://testsite.com/coins/ric/augustus/i.html'
 
         with self.assertRaises(requests.ConnectionError):
             scrape_page(test_url)
-        mock_get.assert_called_once()
+        self.assertEqual(mock_get.call_count, fetch_config['retries'] + 1)
+
+    @patch('web_scraper.sleep')
+    @patch('web_scraper.requests.get')
+    def test_scrape_page_retry_after(self, mock_get, mock_sleep):
+        unavailable = MagicMock(status_code=503, headers={'retry-after': '7'})
+        ok = MagicMock(status_code=200, content=b'<html><body><h1>TEST</h1></body></html>')
+        mock_get.return_value.__enter__.side_effect = [unavailable, ok]
+
+        result = scrape_page('http://testsite.com/coins/ric/augustus/i.html')
+
+        mock_sleep.assert_called_once_with(7.0)
+        self.assertEqual(result.h1.text, 'TEST')
 
 # pull_title()
 class TestPullTitle(unittest.TestCase):
@@ -247,6 +341,10 @@ class TestPullCoins(unittest.TestCase):
 def test_coin_id():
     id = coin_id()
     assert len(id) == 36
+    page = 'https://www.wildwinds.com/coins/ric/augustus/i.html'
+    assert coin_id(page, 'RIC 1-1') == coin_id(page, 'RIC 1-1')
+    assert coin_id(page, 'RIC 1-1') != coin_id(page, 'RIC 1-2')
+    assert coin_id(page, 'RIC 1-1') != coin_id(page.replace('augustus', 'tiberius'), 'RIC 1-1')
 
 # Helper function
 def coins_from_html(path:str = None, html:str = None):
@@ -372,6 +470,17 @@ class TestCoinTxt(unittest.TestCase):
         no_txt_coin = coins_from_html(html=no_txt_html)
         self.assertIsNone(coin_txt(no_txt_coin, title=self.test_name))
 
+    def test_txt_page(self):
+        # Resolved against the page it's linked from, on any site or section
+        normal_coins = coins_from_html(path='tests/test_data/test_html/normal.html')
+        self.assertEqual(coin_txt(normal_coins[0], title=self.test_name, 
+                                  page='https://www.wildwinds.com/coins/rsc/julius_caesar/i.html'),
+                         'https://www.wildwinds.com/coins/rsc/julius_caesar/TEST_123.txt')
+        relative_html = '<tr><td bgcolor="#FF0000">TEST 123</td><td>Test Desc</td><td><a href="../other/TEST_123.txt">txt file</a></td></tr>'
+        relative_coin = coins_from_html(html=relative_html)
+        self.assertEqual(coin_txt(relative_coin, title=self.test_name, page='http://testurl.com/ric/test_name/i.html'),
+                         'http://testurl.com/ric/other/TEST_123.txt')
+
 # coin_mass()
 class TestCoinMass(unittest.TestCase):
 
@@ -427,6 +536,14 @@ class TestCoinInscriptions(unittest.TestCase):
         no_inscription_coin = coins_from_html(html=no_inscription_html)
         self.assertIsNone(coin_inscriptions(no_inscription_coin))
 
+    def test_inscriptions_length(self):
+        # Every known inscription together is longer than the column, so some are left out
+        case = ' '.join(inscriptions_list)
+        case_html = f'''<tr><td bgcolor="#FF0000">Id</td><td>Test Description Filler filler Filler filler {case} filler</td><td><a href='123.txt'>txt</a></td></tr>'''
+        inscriptions = coin_inscriptions(coins_from_html(html=case_html))
+        self.assertLessEqual(len(inscriptions), 100)
+        self.assertEqual(inscriptions.split(','), sorted(inscriptions.split(',')))
+
 # coins_from_soup()
 class TestCoinsFromSoup(unittest.TestCase):
 
@@ -451,6 +568,43 @@ class TestCoinsFromSoup(unittest.TestCase):
         self.assertIsInstance(test_coin['modified'], datetime.datetime)
         self.assertEqual(len(coins), 3)
 
+# CoinExtractor
+class TestCoinExtractor(unittest.TestCase):
+
+    def assert_matches_coin_functions(self, soup:BeautifulSoup):
+        title = pull_title(soup)
+        extractor = CoinExtractor(title, pull_subtitle(soup))
+        for coin in pull_coins(soup):
+            extracted = extractor.extract(coin)
+            if not coin_description(coin):
+                self.assertIsNone(extracted)
+                continue
+            expected = {'name': title, 'name_detail': pull_subtitle(soup), 
+                        'catalog': coin_catalog(coin), 'description': coin_description(coin), 
+                        'metal': coin_metal(coin), 'mass': coin_mass(coin), 
+                        'diameter': coin_diameter(coin), 'era': coin_era(coin), 
+                        'year': coin_year(coin), 'inscriptions': coin_inscriptions(coin), 
+                        'txt': coin_txt(coin, title=title)}
+            self.assertEqual({col: extracted[col] for col in expected}, expected)
+            self.assertEqual(extracted['created'], extracted['modified'])
+
+    def test_fixtures(self):
+        fixtures = 'tests/test_data/test_html'
+        for filename in sorted(os.listdir(fixtures)):
+            with self.subTest(fixture=filename):
+                with open(os.path.join(fixtures, filename), 'r') as html_file:
+                    html = html_file.read()
+                self.assert_matches_coin_functions(BeautifulSoup(html.replace('\n', '').encode(), 'lxml'))
+
+    def test_descriptions(self):
+        descriptions = ['Filler filler Filler filler S P Q R, TRP IMP C CAESAR 44 BC 3,5g 18.5mm filler',
+                        'Filler filler Filler filler AD 12-14 and 200/201 AD, TR POT, PM PON MAX 11-2 gm',
+                        'Filler filler Filler filler 400 BC 75g 60mm S-C SC,SPQR TRIB,AVGVSTVS PAX filler',
+                        'Filler filler Filler filler filler with no era, year, mass or inscriptions']
+        rows = ''.join(f'<tr><td bgcolor="#c0c0c0">Id</td><td>{description}</td>'
+                       f'<td><a href="1.txt">txt</a></td></tr>' for description in descriptions)
+        self.assert_matches_coin_functions(BeautifulSoup(f'<html><title>Test, name</title><table>{rows}</table></html>', 'lxml'))
+
 # load_coins()
 class TestLoadCoins(unittest.TestCase):
 
@@ -466,28 +620,35 @@ class TestLoadCoins(unittest.TestCase):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.side_effect = [
+            [{'column_name': 'name', 'data_type': 'character varying', 'character_maximum_length': 30, 'is_nullable': 'YES'},
+             {'column_name': 'mass', 'data_type': 'real', 'character_maximum_length': None, 'is_nullable': 'YES'}],
+            [],
+            [{'inserted': True}, {'inserted': True}]]
         mock_connect.return_value = mock_conn
 
-        load_coins(self.coins, mock_conn, self.table_name)
-
-        expected_calls = [
-            call(f"INSERT INTO {self.table_name} (name, mass) VALUES (%(name)s, %(mass)s);", coin)
-            for coin in self.coins
-        ]
-        mock_cursor.execute.assert_has_calls(expected_calls, any_order=True)
+        stats = load_coins(self.coins, mock_conn, self.table_name)
 
+        copied = mock_cursor.copy_expert.call_args[0][1].getvalue()
+        self.assertEqual(copied, 'Test name 1\t0.0\nTest name 2\t2.4\n')
+        mock_cursor.execute.assert_any_call(f"INSERT INTO {self.table_name} (name, mass) SELECT name, mass "
+                                            f"FROM {self.table_name}_staging ON CONFLICT DO NOTHING "
+                                            f"RETURNING (xmax = 0) AS inserted")
+        self.assertEqual(stats['inserted'], 2)
+        self.assertEqual(stats['rejected'], 0)
         mock_conn.commit.assert_called()
-        mock_cursor.close.assert_called()
 
     @patch('web_scraper.psycopg2.connect')
     def test_load_coins_failure(self, mock_connect):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.__enter__.return_value = mock_cursor
         mock_connect.return_value = mock_conn
         mock_cursor.execute.side_effect = psycopg2.Error("Test error")
 
-        load_coins(self.coins, mock_conn, self.table_name)
+        self.assertIsNone(load_coins(self.coins, mock_conn, self.table_name))
 
         mock_conn.rollback.assert_called()
 
@@ -506,100 +667,595 @@ class TestLoadCoins(unittest.TestCase):
         self.assertEqual(result[0], expected_row_1)
         self.assertEqual(result[1], expected_row_2)
 
-# check_state()
-class TestCheckState(unittest.TestCase):
+    def test_load_coins_rejects(self):
+        conn = connect_db(**db_info)
+        create_table(conn, self.table_name, self.table_columns, self.dtypes)
+        coins = self.coins + [{'name': 'Test name 3' * 5, 'mass': 1.0}, 
+                              {'name': 'Test name 4', 'mass': 'heavy'},
+                              {'name': 'Tab\tand\\backslash', 'mass': None}]
+        stats = load_coins(coins, conn, self.table_name, commit=False)
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT name FROM {self.table_name};")
+            names = [row['name'] for row in cursor.fetchall()]
+            cursor.execute(f"SELECT reason, record FROM {self.table_name}_rejects;")
+            rejects = cursor.fetchall()
+        conn.close()
+
+        self.assertEqual(names, ['Test name 1', 'Test name 2', 'Tab\tand\\backslash'])
+        self.assertEqual((stats['inserted'], stats['rejected']), (3, 2))
+        self.assertEqual([reject['reason'] for reject in rejects], 
+                         ['name: 55 characters exceeds 30', 'mass: str is not a number'])
+        self.assertEqual(rejects[1]['record'], {'name': 'Test name 4', 'mass': 'heavy'})
 
-    @patch('web_scraper.os.path.exists')
-    def test_missing_state(self, mock_exists):
-        mock_exists.return_value = False
-        state = check_state('dummy_path.csv')
-        self.assertIsNone(state)
-    
-    @patch('web_scraper.os.path.exists')
-    @patch('web_scraper.open', new_callable=mock_open, read_data='Scraping State')
-    def test_active_state(self, mock_file, mock_exists):
-        mock_exists.return_value = True
-        state = check_state('dummy_path.csv')
-        self.assertEqual(state, 'Scraping State')
-        
-    @patch('web_scraper.os.path.exists')
-    @patch('web_scraper.open', new_callable=mock_open, read_data='Scraping/Loading complete')
-    @patch('web_scraper.exit')
-    def test_complete_state(self, mock_exit, mock_file, mock_exists):
-        mock_exists.return_value = True
-        check_state('dummy_path.csv')
-        mock_exit.assert_called_once()
-
-# update_state()
-class TestUpdateState(unittest.TestCase):
-
-    @patch('web_scraper.open', new_callable=mock_open)
-    def test_update_state(self, mock_open):
-        test_input = "test_input"
-        test_path = "test_state.csv"
-
-        update_state(test_path, test_input)
-
-        mock_open.assert_called_once_with(test_path, "a")
-        mock_file = mock_open()
-        mock_file.write.assert_called()
-        args, _ = mock_file.write.call_args
-        self.assertIn(test_input, args[0]) # Assert write called with test_input
+    def test_load_coins_row_fallback(self):
+        # Rows that pass validation but break a constraint are rejected one by one
+        conn = connect_db(**db_info)
+        create_table(conn, self.table_name, self.table_columns, 
+                     ['VARCHAR(30) PRIMARY KEY', 'REAL CHECK (mass >= 0)'])
+        coins = self.coins + [{'name': 'Test name 3', 'mass': -1.0}, {'name': 'Test name 2', 'mass': 2.4}]
+        stats = load_coins(coins, conn, self.table_name, commit=False)
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT name FROM {self.table_name} ORDER BY name;")
+            names = [row['name'] for row in cursor.fetchall()]
+            cursor.execute(f"SELECT reason FROM {self.table_name}_rejects;")
+            rejects = cursor.fetchall()
+        conn.close()
+
+        self.assertEqual(names, ['Test name 1', 'Test name 2'])
+        self.assertEqual((stats['inserted'], stats['unchanged'], stats['rejected']), (2, 1, 1))
+        self.assertIn('check constraint', rejects[0]['reason'])
+
+    def test_load_coins_upsert(self):
+        conn = connect_db(**db_info)
+        create_table(conn, 'test_coins', table_columns, column_dtypes)
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        page = 'https://www.wildwinds.com/coins/ric/test_name/i.html'
+        first = parse_page(html, page=page)
+        stats = load_coins(first, conn, 'test_coins', commit=False)
+        self.assertEqual((stats['inserted'], stats['updated'], stats['unchanged']), (3, 0, 0))
+
+        # A re-scrape yields the same ids and only rewrites the coin that changed
+        second = parse_page(html.replace(b'8.24g', b'8.25g'), page=page)
+        self.assertEqual([coin['id'] for coin in second], [coin['id'] for coin in first])
+        stats = load_coins(second, conn, 'test_coins', commit=False)
+        self.assertEqual((stats['inserted'], stats['updated'], stats['unchanged']), (0, 1, 2))
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT id, mass, created, modified FROM test_coins')
+            rows = {row['id']: row for row in cursor.fetchall()}
+        conn.close()
+
+        changed = rows[first[0]['id']]
+        self.assertAlmostEqual(changed['mass'], 8.25, places=5)
+        self.assertEqual(changed['created'], first[0]['created'])
+        self.assertEqual(changed['modified'], second[0]['modified'])
+        for coin in first[1:]:
+            self.assertEqual(rows[coin['id']]['modified'], coin['modified'])
+
+    def test_load_coins_notify(self):
+        listener = connect_db(**db_info)
+        listener.set_session(autocommit=True)
+        with listener.cursor() as cursor:
+            cursor.execute('LISTEN roman_coins_changes')
+        conn = connect_db(**db_info)
+        create_table(conn, 'test_coins', table_columns, column_dtypes)
+        conn.commit()
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        page = 'https://www.wildwinds.com/coins/ric/test_name/i.html'
+        first = parse_page(html, page=page)
+        second = parse_page(html.replace(b'8.24g', b'8.25g'), page=page)
+        try:
+            load_coins(first, conn, 'test_coins')
+            load_coins(second, conn, 'test_coins')
+            time.sleep(0.1)
+            listener.poll()
+            payloads = [json.loads(notify.payload) for notify in listener.notifies]
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute('DROP TABLE test_coins')
+            conn.commit()
+            conn.close()
+            listener.close()
+
+        # The changed coins are named, so the API's change feed can read them whenever they commit
+        self.assertEqual([(payload['op'], sorted(payload['ids'])) for payload in payloads],
+                         [('insert', sorted(coin['id'] for coin in first)), ('update', [first[0]['id']])])
+
+    def test_notify_change_format(self):
+        # Pins the payloads the API's change feed parses (see notify_change in api/changes.py)
+        cursor = MagicMock()
+        ids = [f'coin-{number}' for number in range(250)]
+        notify_change(cursor, 'insert', 250, ids)
+        notify_change(cursor, 'update', 3, [])
+        payloads = [(args[1][0], json.loads(args[1][1])) for args, _ in cursor.execute.call_args_list]
+        self.assertEqual(payloads, 
+                         [('roman_coins_changes', {'op':'insert', 'count':len(chunk), 'ids':chunk})
+                          for chunk in (ids[:100], ids[100:200], ids[200:])] + 
+                         [('roman_coins_changes', {'op':'update', 'count':3})])
+
+    def test_load_coins_hashes(self):
+        conn = connect_db(**db_info)
+        create_table(conn, 'test_coins', table_columns, column_dtypes)
+        create_table(conn, 'test_coins_hashes', hash_columns, hash_dtypes)
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        page = 'https://www.wildwinds.com/coins/ric/test_name/i.html'
+        first = parse_page(html, page=page)
+        stats = load_coins(first[:2], conn, 'test_coins', commit=False, hashes='test_coins_hashes')
+        self.assertEqual((stats['skipped'], stats['changed'], stats['added']), (0, 0, 2))
+
+        # Only the changed and the new coin reach the table
+        second = parse_page(html.replace(b'8.24g', b'8.25g'), page=page)
+        stats = load_coins(second, conn, 'test_coins', commit=False, hashes='test_coins_hashes')
+        self.assertEqual((stats['skipped'], stats['changed'], stats['added']), (1, 1, 1))
+        self.assertEqual((stats['rows'], stats['inserted'], stats['updated']), (2, 1, 1))
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT id, row_hash FROM test_coins_hashes')
+            hashes = {row['id']: row['row_hash'] for row in cursor.fetchall()}
+        conn.close()
+        self.assertEqual(hashes, {coin['id']: coin_hash(coin) for coin in second})
+
+    def test_coin_hash(self):
+        coin = {'id': 'a', 'name': 'Trajan', 'mass': 3.2, 'created': datetime.datetime(2024, 1, 1), 
+                'modified': datetime.datetime(2024, 1, 1)}
+        rescraped = dict(coin, id='b', created=datetime.datetime(2024, 2, 1), modified=datetime.datetime(2024, 2, 1))
+        self.assertEqual(coin_hash(coin), coin_hash(rescraped))
+        self.assertNotEqual(coin_hash(coin), coin_hash(dict(coin, mass=3.3)))
+
+# .txt enrichment
+class TestEnrichCoins(unittest.TestCase):
+
+    txt = (b'Trajan AR Denarius. 3.35 g, 19 mm. Rome mint, struck AD 103-111.\r\n'
+           b'IMP TRAIANO AVG GER DAC P M TR P COS V P P, laureate bust right /\r\n'
+           b'S P Q R OPTIMO PRINCIPI, Pax standing left. RIC 12.')
+
+    def test_txt_fields(self):
+        self.assertEqual(txt_fields(self.txt), {'mass': 3.35, 'diameter': 19.0, 'era': 'AD', 'year': 103,
+                                                'inscriptions': 'AVG,COS,IMP,S P Q R,TR'})
+        self.assertEqual(txt_fields('Denier, 3,1g, caf\xe9'.encode('cp1252'))['mass'], 3.1)
+
+    def test_merge_txt(self):
+        coin = {'mass': None, 'diameter': 18.0, 'era': None, 'year': None, 'inscriptions': 'IMP,SC'}
+        self.assertTrue(merge_txt(coin, txt_fields(self.txt)))
+        # Missing fields are filled, fields from the row kept and inscriptions combined
+        self.assertEqual(coin, {'mass': 3.35, 'diameter': 18.0, 'era': 'AD', 'year': 103, 
+                                'inscriptions': 'AVG,COS,IMP,S P Q R,SC,TR'})
+        self.assertFalse(merge_txt(coin, txt_fields(self.txt)))
+
+    def test_merge_txt_length(self):
+        coin = {'mass': 1.0, 'diameter': 18.0, 'era': 'AD', 'year': 100, 'inscriptions': 'AVGVSTVS,CAESAR,CONSVL'}
+        fields = {'mass': None, 'diameter': None, 'era': None, 'year': None, 
+                  'inscriptions': ','.join(sorted(inscriptions_list))}
+        # Merged inscriptions still fit the inscriptions column
+        self.assertTrue(merge_txt(coin, fields))
+        self.assertLessEqual(len(coin['inscriptions']), 100)
+        self.assertFalse(merge_txt(coin, fields))
+
+    def test_enrich_coins(self):
+        def handler(request):
+            if request.url.path.endswith('missing.txt'):
+                return httpx.Response(404)
+            return httpx.Response(200, content=self.txt)
+        coins = [{'txt': 'http://testsite.com/trajan/RIC_12.txt', 'mass': None, 'diameter': None, 
+                  'era': None, 'year': None, 'inscriptions': None},
+                 {'txt': 'http://testsite.com/trajan/missing.txt', 'mass': None, 'diameter': None, 
+                  'era': None, 'year': None, 'inscriptions': None},
+                 {'txt': None, 'mass': 1.0}]
+
+        async def enrich(cache_dir):
+            async with Fetcher(requests_per_minute=6000, burst=5, transport=httpx.MockTransport(handler)) as fetcher:
+                return await enrich_coins(coins, fetcher, PageArchive(cache_dir), concurrency=2)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            stats = asyncio.run(enrich(cache_dir))
+        self.assertEqual(stats, {'cached': 0, 'fetched': 1, 'missing': 1, 'failed': 0, 'enriched': 1})
+        self.assertEqual((coins[0]['mass'], coins[0]['inscriptions']), (3.35, 'AVG,COS,IMP,S P Q R,TR'))
+        self.assertIsNone(coins[1]['mass'])
 
 # scrape_and_load()
 class TestScrapeAndLoad(unittest.TestCase):
 
-    @patch('web_scraper.scrape_page')
+    def setUp(self):
+        self.requested = []
+        def handler(request):
+            self.requested.append(str(request.url))
+            if request.url.path == '/broken':
+                return httpx.Response(500)
+            return httpx.Response(200, content=b'<html><body></body></html>')
+        self.transport = httpx.MockTransport(handler)
+        self.table_name = 'test_table'
+        self.frontier = Frontier(lambda: connect_db(**db_info), table='test_frontier', max_attempts=2)
+        self.frontier.create()
+        self.conn = connect_db(**db_info)
+
+    def tearDown(self):
+        self.conn.close()
+        self.frontier.execute('DROP TABLE IF EXISTS test_frontier, test_load, test_load_hashes')
+        self.frontier.close()
+
+    def statuses(self) -> dict:
+        return {row['url']: (row['status'], row['attempts']) 
+                for row in self.frontier.execute('SELECT url, status, attempts FROM test_frontier')}
+
     @patch('web_scraper.coins_from_soup')
     @patch('web_scraper.load_coins')
-    @patch('web_scraper.update_state')
-    @patch('web_scraper.check_state')
-    def test_scrape_and_load(self, mock_check_state, mock_update_state, mock_load_coins, mock_coins_from_soup, mock_scrape_page):
-        mock_conn = MagicMock()
-        mock_scrape_page.return_value = MagicMock()
+    def test_scrape_and_load(self, mock_load_coins, mock_coins_from_soup):
+        mock_coins_from_soup.return_value = [{'coin': 'data'}]
+        pages = ['http://testurl.com/page1', 'http://testurl.com/page2']
+        self.frontier.add(pages)
+
+        scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, 
+                        burst=2, cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                        transport=self.transport)
+
+        self.assertEqual(sorted(self.requested), pages)
+        # Coins from pages parsed while a load is pending are loaded together
+        loaded = [coin for args, _ in mock_load_coins.call_args_list for coin in args[0]]
+        self.assertEqual(loaded, [{'coin': 'data'}] * 2)
+        mock_load_coins.assert_called_with(ANY, self.conn, self.table_name, commit=False, hashes='test_table_hashes')
+        self.assertEqual(self.statuses(), {page: ('done', 1) for page in pages})
+        hashes = {row['content_hash'] for row in self.frontier.execute('SELECT content_hash FROM test_frontier')}
+        self.assertEqual(hashes, {hashlib.sha256(b'<html><body></body></html>').hexdigest()})
+
+    @patch('web_scraper.coins_from_soup')
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_resume(self, mock_load_coins, mock_coins_from_soup):
+        mock_coins_from_soup.return_value = [{'coin': 'data'}]
+        pages = ['http://testurl.com/page1', 'http://testurl.com/broken', 'http://testurl.com/page3']
+        self.frontier.add(pages)
+        self.frontier.claim()
+        self.frontier.done(pages[0])
+
+        scrape_and_load(self.conn, self.frontier, self.table_name, retries=0, requests_per_minute=6000, 
+                        burst=2, cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                        transport=self.transport)
+
+        # Page 1 was already loaded; the broken page is retried up to max_attempts
+        self.assertEqual(sorted(self.requested), [pages[1], pages[1], pages[2]])
+        self.assertEqual(mock_load_coins.call_count, 1)
+        self.assertEqual(self.statuses(), {pages[0]: ('done', 1), pages[1]: ('failed', 2), pages[2]: ('done', 1)})
+        error = self.frontier.execute('SELECT error FROM test_frontier WHERE url = %s', (pages[1],))[0]['error']
+        self.assertIn('500', error)
+
+    @patch('web_scraper.coins_from_soup')
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_load_error(self, mock_load_coins, mock_coins_from_soup):
         mock_coins_from_soup.return_value = [{'coin': 'data'}]
+        mock_load_coins.return_value = None
+        self.frontier.add(['http://testurl.com/page1'])
+
+        scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, 
+                        burst=2, cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                        transport=self.transport)
 
-        state_path = '/path/to/statefile'
+        # Never marked done, so it's retried while it has attempts left
+        row = self.frontier.execute('SELECT status, error, content_hash FROM test_frontier')[0]
+        self.assertEqual((row['status'], row['error'], row['content_hash']), ('failed', 'load error', None))
+
+    @patch('web_scraper.coins_from_soup')
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_cached(self, mock_load_coins, mock_coins_from_soup):
+        def handler(request):
+            if request.headers.get('if-none-match') == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, content=b'<html><body></body></html>', headers={'etag': '"v1"'})
+        mock_coins_from_soup.return_value = [{'coin': 'data'}]
+        pages = ['http://testurl.com/page1', 'http://testurl.com/page2']
+        self.frontier.add(pages)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, 
+                                burst=2, cache_dir=cache_dir, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                                transport=httpx.MockTransport(handler))
+                self.assertEqual(self.frontier.requeue(), 2)
+
+        # The recrawl revalidates both pages and loads neither, keeping their hashes
+        loaded = [coin for args, _ in mock_load_coins.call_args_list for coin in args[0]]
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(self.statuses(), {page: ('pending', 0) for page in pages})
+        hashes = {row['content_hash'] for row in self.frontier.execute('SELECT content_hash FROM test_frontier')}
+        self.assertEqual(hashes, {hashlib.sha256(b'<html><body></body></html>').hexdigest()})
+
+    @patch('web_scraper.parse_page')
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_unchanged_content(self, mock_load_coins, mock_parse_page):
+        mock_parse_page.return_value = [{'coin': 'data'}]
         pages = ['http://testurl.com/page1', 'http://testurl.com/page2']
-        table_name = 'test_table'
+        self.frontier.add(pages)
+        scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, 
+                        burst=2, cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                        transport=self.transport)
+        self.assertEqual(self.frontier.requeue(), 2)
+
+        # The same content is fetched again, but neither page is parsed or loaded
+        scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, 
+                        burst=2, cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                        transport=self.transport)
+        self.assertEqual(len(self.requested), 4)
+        self.assertEqual(mock_parse_page.call_count, 2)
+        loaded = [coin for args, _ in mock_load_coins.call_args_list for coin in args[0]]
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(self.statuses(), {page: ('done', 1) for page in pages})
 
-        mock_check_state.side_effect = [None, 'http://testurl.com/page1']
+    @patch('web_scraper.coins_from_soup')
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_archive(self, mock_load_coins, mock_coins_from_soup):
+        mock_coins_from_soup.return_value = [{'coin': 'data'}]
+        pages = ['http://testurl.com/page1', 'http://testurl.com/broken']
+        self.frontier.add(pages)
 
-        scrape_and_load(mock_conn, state_path, pages, table_name, delay=0)
+        with tempfile.TemporaryDirectory() as archive_dir:
+            scrape_and_load(self.conn, self.frontier, self.table_name, retries=0, requests_per_minute=6000, 
+                            burst=2, cache_dir=None, archive_dir=archive_dir, telemetry_path=None, parse_workers=0, 
+                            transport=self.transport)
+            archive = PageArchive(archive_dir)
+            self.assertEqual([entry['url'] for entry in archive.entries()], pages[:1])
+            self.assertEqual(archive.read(pages[0]), b'<html><body></body></html>')
 
-        self.assertEqual(mock_scrape_page.call_count, 2)
-        mock_load_coins.assert_called_with([{'coin': 'data'}], mock_conn, table_name)
-        mock_update_state.assert_called() 
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_enrich(self, mock_load_coins):
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        def handler(request):
+            self.requested.append(request.url.path)
+            if request.url.path.endswith('.txt'):
+                return httpx.Response(200, content=b'Weight 7.77 g. IMP CAES BRIT AVG, head right.')
+            return httpx.Response(200, content=html.replace(b'8.24g', b''))
+        self.frontier.add(['http://testurl.com/page1'])
+
+        with tempfile.TemporaryDirectory() as txt_cache_dir:
+            scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, 
+                            burst=5, cache_dir=None, archive_dir=None, telemetry_path=None, txt_cache_dir=txt_cache_dir, 
+                            parse_workers=0, transport=httpx.MockTransport(handler))
+            cached = len(PageArchive(txt_cache_dir).entries())
+
+        loaded = [coin for args, _ in mock_load_coins.call_args_list for coin in args[0]]
+        txt_files = {coin['txt'] for coin in loaded if coin['txt']}
+        self.assertEqual(cached, len(txt_files))
+        # .txt links are resolved against the page they're on
+        self.assertTrue(txt_files)
+        self.assertTrue(all(url.startswith('http://testurl.com/') for url in txt_files))
+        self.assertEqual(len([path for path in self.requested if path.endswith('.txt')]), len(txt_files))
+        # The coin whose weight was taken out of the row gets it from its .txt file
+        self.assertIn(7.77, [coin['mass'] for coin in loaded])
+        self.assertTrue(all('BRIT' in coin['inscriptions'] for coin in loaded if coin['txt']))
+
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_pipeline(self, mock_load_coins):
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        def handler(request):
+            if request.url.path == '/broken':
+                return httpx.Response(500)
+            return httpx.Response(200, content=html)
+        pages = [f'http://testurl.com/page{i}' for i in range(10)]
+        pages.insert(4, 'http://testurl.com/broken')
+        self.frontier.add(pages)
+
+        # Parsed in worker processes, loaded in batches of up to 6 coins
+        scrape_and_load(self.conn, self.frontier, self.table_name, retries=0, requests_per_minute=60000, 
+                        burst=10, cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=2, 
+                        load_batch_size=6, queue_size=2, 
+                        transport=httpx.MockTransport(handler))
+
+        loaded = [coin for args, _ in mock_load_coins.call_args_list for coin in args[0]]
+        self.assertEqual(len(loaded), 30)
+        self.assertEqual({coin['catalog'] for coin in loaded}, {'TEST 123', 'TEST 124', 'TEST 125'})
+        progress = self.frontier.progress()
+        self.assertEqual((progress['done'], progress['failed'], progress['total']), (10, 1, 11))
+
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_telemetry(self, mock_load_coins):
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        def handler(request):
+            if request.url.path == '/broken':
+                return httpx.Response(500)
+            return httpx.Response(200, content=html)
+        pages = ['http://testurl.com/page1', 'http://testurl.com/page2', 'http://testurl.com/broken']
+        self.frontier.add(pages)
+
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, 'telemetry.jsonl')
+            metrics_path = os.path.join(directory, 'metrics.prom')
+            scrape_and_load(self.conn, self.frontier, self.table_name, retries=0, requests_per_minute=6000, 
+                            burst=3, cache_dir=None, archive_dir=None, telemetry_path=log_path, 
+                            metrics_path=metrics_path, parse_workers=0, transport=httpx.MockTransport(handler))
+            with open(log_path) as log:
+                lines = [json.loads(line) for line in log]
+            with open(metrics_path) as metrics:
+                exported = metrics.read()
+
+        # A line per page attempt, between the run's start and summary
+        self.assertEqual([line['event'] for line in (lines[0], lines[-1])], ['start', 'summary'])
+        page_lines = {(line['url'], line['status']): line for line in lines if line['event'] == 'page'}
+        self.assertEqual(set(page_lines), {(pages[0], 'done'), (pages[1], 'done'), (pages[2], 'failed')})
+        done = page_lines[(pages[0], 'done')]
+        self.assertEqual((done['http_status'], done['bytes'], done['coins']), (200, len(html), 3))
+        for metric in ('wait_seconds', 'fetch_seconds', 'parse_seconds', 'load_seconds'):
+            self.assertGreaterEqual(done[metric], 0)
+        self.assertEqual(done['fill']['catalog'], 1.0)
+        self.assertEqual(page_lines[(pages[2], 'failed')]['stage'], 'fetch')
+        summary = lines[-1]
+        self.assertEqual(summary['coins'], 6)
+        self.assertEqual(summary['pages']['done'], 2)
+        self.assertIn('scraper_coins_total 6', exported)
+
+    def test_scrape_and_load_transaction(self):
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            html = html_file.read()
+        create_table(self.conn, 'test_load', table_columns, column_dtypes)
+        create_table(self.conn, 'test_load_hashes', hash_columns, hash_dtypes)
+        self.conn.commit()
+        pages = ['http://testurl.com/page1', 'http://testurl.com/page2']
+        self.frontier.add(pages)
+        def crawl(**kwargs):
+            scrape_and_load(self.conn, self.frontier, 'test_load', requests_per_minute=6000, burst=2, 
+                            cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                            transport=httpx.MockTransport(lambda request: httpx.Response(200, content=html)), 
+                            **kwargs)
+
+        # Marking the pages done fails, so the coins loaded with them are rolled back too
+        with patch.object(Frontier, 'done_batch', side_effect=psycopg2.OperationalError('connection lost')):
+            crawl()
+        self.assertEqual(self.count('test_load'), 0)
+        self.assertEqual(self.count('test_load_hashes'), 0)
+        self.assertEqual(self.statuses(), {page: ('failed', 1) for page in pages})
+
+        crawl()
+        self.assertEqual(self.count('test_load'), 6)
+        self.assertEqual(self.statuses(), {page: ('done', 2) for page in pages})
+
+    @patch('web_scraper.coins_from_soup')
+    @patch('web_scraper.load_coins')
+    def test_scrape_and_load_batch_seconds(self, mock_load_coins, mock_coins_from_soup):
+        mock_coins_from_soup.return_value = [{'coin': 'data'}]
+        pages = [f'http://testurl.com/page{i}' for i in range(6)]
+        self.frontier.add(pages)
+
+        # Pages that arrive within the time threshold share one transaction
+        with patch.object(Frontier, 'done_batch', autospec=True, side_effect=Frontier.done_batch) as mock_done_batch:
+            scrape_and_load(self.conn, self.frontier, self.table_name, requests_per_minute=6000, burst=6, 
+                            cache_dir=None, archive_dir=None, telemetry_path=None, parse_workers=0, 
+                            load_batch_seconds=60, transport=self.transport)
+        self.assertEqual(mock_load_coins.call_count, 1)
+        self.assertEqual(len(mock_load_coins.call_args[0][0]), 6)
+        mock_done_batch.assert_called_once()
+        self.assertEqual(sorted(url for url, _ in mock_done_batch.call_args[0][2]), pages)
+        self.assertEqual(self.statuses(), {page: ('done', 1) for page in pages})
+
+    def count(self, table:str) -> int:
+        with self.conn.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) AS rows FROM {table}')
+            return cursor.fetchone()['rows']
+
+# replay()
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = connect_db(**db_info)
+        create_table(self.conn, 'test_replay', table_columns, column_dtypes)
+        create_table(self.conn, 'test_replay_hashes', hash_columns, hash_dtypes)
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.archive = PageArchive(self.archive_dir.name)
+        with open('tests/test_data/test_html/normal.html', 'rb') as html_file:
+            self.html = html_file.read()
+        self.pages = [f'https://www.wildwinds.com/coins/ric/emperor{i}/i.html' for i in range(8)]
+        for page in self.pages:
+            self.archive.store(page, self.html)
+
+    def tearDown(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute('DROP TABLE test_replay, test_replay_hashes')
+        self.conn.commit()
+        self.conn.close()
+        self.archive_dir.cleanup()
+
+    def coins(self) -> dict:
+        with self.conn.cursor() as cursor:
+            cursor.execute('SELECT id, mass FROM test_replay')
+            return {row['id']: row['mass'] for row in cursor.fetchall()}
+
+    def test_replay(self):
+        stats = replay(self.conn, 'test_replay', self.archive_dir.name, parse_workers=2, load_batch_size=10)
+        self.assertEqual((stats['pages'], stats['coins'], stats['parse_errors'], stats['load_errors']), 
+                         (8, 24, 0, 0))
+        coins = self.coins()
+        self.assertEqual(len(coins), 24)
+
+        # Replaying again rebuilds the same coins, with a changed page's coin updated in place
+        self.archive.store(self.pages[0], self.html.replace(b'8.24g', b'8.25g'))
+        replay(self.conn, 'test_replay', self.archive_dir.name, parse_workers=0)
+        replayed = self.coins()
+        self.assertEqual(replayed.keys(), coins.keys())
+        changed = [id for id in coins if replayed[id] != coins[id]]
+        self.assertEqual(len(changed), 1)
+        self.assertAlmostEqual(replayed[changed[0]], 8.25, places=5)
 
 # main()
 class TestMain(unittest.TestCase):
 
-    @patch('web_scraper.get_pages')
+    @patch('web_scraper.discover_pages')
     @patch('web_scraper.connect_db')
     @patch('web_scraper.create_table')
     @patch('web_scraper.scrape_and_load')
-    def test_main(self, mock_scrape_and_load, mock_create_table, mock_connect_db, mock_get_pages):
-        mock_get_pages.return_value = ['page1', 'page2', 'page3']
+    @patch('web_scraper.Frontier')
+    def test_main(self, mock_frontier, mock_scrape_and_load, mock_create_table, mock_connect_db, mock_discover_pages):
+        mock_discover_pages.return_value = ['page1', 'page2', 'page3']
         mock_conn = MagicMock()
         mock_connect_db.return_value.__enter__.return_value = mock_conn
+        frontier = mock_frontier.return_value
+        frontier.remaining.return_value = 6
 
         test_db_info = db_info
         test_table_name = table_info['name']
         test_table_columns = table_info['columns']
         test_column_dtypes = table_info['dtypes']
-        test_state_path = '/test/state/path'
 
         with patch('web_scraper.db_info', test_db_info), \
              patch('web_scraper.table_name', test_table_name), \
              patch('web_scraper.table_columns', test_table_columns), \
-             patch('web_scraper.column_dtypes', test_column_dtypes), \
-             patch('web_scraper.state_path', test_state_path):
+             patch('web_scraper.column_dtypes', test_column_dtypes):
             main()
 
-        mock_get_pages.assert_has_calls([call('https://www.wildwinds.com/coins/ric/i.html'), call('https://www.wildwinds.com/coins/rsc/i.html')])
+        mock_discover_pages.assert_called_once_with()
         mock_connect_db.assert_called_with(**test_db_info)
-        mock_create_table.assert_called_with(mock_conn, test_table_name, test_table_columns, test_column_dtypes)
-        mock_scrape_and_load.assert_called_with(mock_conn, test_state_path, ['page1', 'page1', 'page2', 'page2', 'page3', 'page3'], test_table_name)
+        mock_create_table.assert_has_calls([call(mock_conn, test_table_name, test_table_columns, test_column_dtypes),
+                                            call(mock_conn, 'test_table_hashes', hash_columns, hash_dtypes)])
+        mock_conn.cursor.return_value.__enter__.return_value.execute.assert_called_with(
+            'CREATE INDEX IF NOT EXISTS test_table_modified_idx ON test_table (modified, id)')
+        frontier.create.assert_called_once()
+        frontier.add.assert_called_with(['page1', 'page2', 'page3'])
+        mock_scrape_and_load.assert_called_with(mock_conn, frontier, test_table_name)
+        frontier.requeue.assert_not_called()
+
+    @patch('web_scraper.discover_pages')
+    @patch('web_scraper.connect_db')
+    @patch('web_scraper.create_table')
+    @patch('web_scraper.scrape_and_load')
+    @patch('web_scraper.Frontier')
+    def test_main_completed(self, mock_frontier, mock_scrape_and_load, mock_create_table, mock_connect_db, mock_discover_pages):
+        mock_discover_pages.return_value = ['page1']
+        mock_frontier.return_value.remaining.return_value = 0
+
+        main()
+
+        mock_scrape_and_load.assert_not_called()
+
+    @patch('web_scraper.discover_pages')
+    @patch('web_scraper.connect_db')
+    @patch('web_scraper.create_table')
+    @patch('web_scraper.scrape_and_load')
+    @patch('web_scraper.Frontier')
+    def test_main_recrawl(self, mock_frontier, mock_scrape_and_load, mock_create_table, mock_connect_db, mock_discover_pages):
+        mock_discover_pages.return_value = ['page1']
+        mock_conn = MagicMock()
+        mock_connect_db.return_value.__enter__.return_value = mock_conn
+        frontier = mock_frontier.return_value
+        # Requeued pages make a completed crawl run again
+        frontier.remaining.side_effect = lambda: frontier.requeue.call_count
+
+        main(recrawl_minutes=60)
+
+        frontier.requeue.assert_called_once_with(60)
+        mock_scrape_and_load.assert_called_once_with(mock_conn, frontier, ANY)
+
+    @patch('web_scraper.connect_db')
+    @patch('web_scraper.create_table')
+    @patch('web_scraper.replay')
+    @patch('web_scraper.discover_pages')
+    def test_main_replay(self, mock_discover_pages, mock_replay, mock_create_table, mock_connect_db):
+        mock_conn = MagicMock()
+        mock_connect_db.return_value.__enter__.return_value = mock_conn
+
+        with patch('web_scraper.table_name', 'test_table'):
+            main('archive')
+
+        # Rebuilt from the archive without any requests
+        mock_replay.assert_called_once_with(mock_conn, 'test_table', 'archive')
+        mock_discover_pages.assert_not_called()
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
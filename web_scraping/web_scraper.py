@@ -2,15 +2,31 @@
 # coding: utf-8
 
 from time import sleep
+import argparse
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import requests
 from bs4 import BeautifulSoup
 import re
 import os
-import csv
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import datetime
 import uuid
+import json
+import hashlib
+from typing import Iterable, Iterator
+from urllib.parse import urljoin
+import httpx
+from fetcher import Fetcher, HttpCache, retry_statuses, retry_after, backoff_delay
+from parsers import parse_html, stream_rows
+from loader import bulk_load
+from frontier import Frontier
+from archive import PageArchive, read_page
+from enrich import fetch_files
+from telemetry import Telemetry
 
 db_info = {'db_name':os.getenv('DB_NAME', 'roman_coins'),
            'db_user':os.getenv('DB_USER', 'postgres'),
@@ -27,7 +43,63 @@ column_dtypes = [
     'VARCHAR(105)', 'TIMESTAMP', 'TIMESTAMP'
     ]
 
-state_path = '/app/data/scraping_state.csv'
+# Content fingerprint of each coin, to skip coins that haven't changed
+hash_columns = ['id', 'row_hash', 'checked']
+hash_dtypes = ['VARCHAR(50) PRIMARY KEY', 'VARCHAR(64)', 'TIMESTAMP']
+
+cache_path = os.getenv('SCRAPER_CACHE_DIR', '/app/data/http_cache')
+
+# Raw html of fetched pages, for rebuilding the dataset without re-crawling
+archive_path = os.getenv('SCRAPER_ARCHIVE_DIR', '/app/data/archive')
+
+# Directory indexes listing the ruler pages, and where the pages found in them 
+# are cached with the indexes' validators
+index_roots = os.getenv('SCRAPER_INDEX_ROOTS', 'https://www.wildwinds.com/coins/ric/i.html,'
+                                               'https://www.wildwinds.com/coins/rsc/i.html').split(',')
+discovery_path = os.getenv('SCRAPER_DISCOVERY_CACHE', '/app/data/discovery.json')
+
+# JSON-lines log of each page's metrics and the run summary, and a Prometheus 
+# text file the running totals are exported to every export_interval seconds
+telemetry_config = {'log_path':os.getenv('SCRAPER_TELEMETRY_LOG', '/app/data/telemetry.jsonl'),
+                    'metrics_path':os.getenv('SCRAPER_METRICS_FILE'),
+                    'export_interval':float(os.getenv('SCRAPER_METRICS_INTERVAL', 15))}
+
+# Cache of the coins' .txt detail files; set it to enrich coins with their 
+# fields, fetching at most concurrency files at once
+txt_config = {'cache_dir':os.getenv('SCRAPER_TXT_CACHE_DIR'),
+              'concurrency':int(os.getenv('SCRAPER_TXT_CONCURRENCY', 4))}
+
+# Politeness budget and connection bound for page requests. The rate adapts to 
+# the site between the min and max rates (unset: a quarter of the starting rate, 
+# and the starting rate, which is the site's required delay; setting a higher max 
+# rate opts in to going faster); failed requests are retried with backoff
+fetch_config = {'requests_per_minute':float(os.getenv('SCRAPER_REQUESTS_PER_MINUTE', 2)),
+                'burst':int(os.getenv('SCRAPER_BURST', 1)),
+                'max_connections':int(os.getenv('SCRAPER_MAX_CONNECTIONS', 4)),
+                'min_requests_per_minute':float(os.getenv('SCRAPER_MIN_REQUESTS_PER_MINUTE', 0)) or None,
+                'max_requests_per_minute':float(os.getenv('SCRAPER_MAX_REQUESTS_PER_MINUTE', 0)) or None,
+                'timeout':float(os.getenv('SCRAPER_TIMEOUT', 30)),
+                'retries':int(os.getenv('SCRAPER_RETRIES', 3))}
+
+# Parse stage processes, rows per load batch, and bound of each queue between stages. 
+# A load batch is one transaction; it's also closed once it has been open for 
+# load_batch_seconds, or when 0, whenever no other page is ready to join it
+pipeline_config = {'parse_workers':int(os.getenv('SCRAPER_PARSE_WORKERS', os.cpu_count() or 1)),
+                   'load_batch_size':int(os.getenv('SCRAPER_LOAD_BATCH_SIZE', 500)),
+                   'load_batch_seconds':float(os.getenv('SCRAPER_LOAD_BATCH_SECONDS', 0)),
+                   'queue_size':int(os.getenv('SCRAPER_QUEUE_SIZE', 8))}
+
+# HTML parser backend for coin pages ('lxml' or 'bs4'; see parsers.py), or 'stream'
+# to extract coins row by row without building the page's tree. Pages are still 
+# fetched whole, since their content is hashed and archived.
+parser_backend = os.getenv('SCRAPER_PARSER', 'lxml')
+
+# Postgres channel the API's change feed listens on, and the coin IDs named per 
+# notification (keeping payloads well under Postgres' 8000 byte limit). The 
+# notification format must match notify_change in the API's changes.py, which 
+# ships in its own image; both sides have a test pinning it.
+change_channel = 'roman_coins_changes'
+notify_ids = 100
 
 def connect_db(db_name, db_user, db_password, db_host):
     '''Returns a connection with PostgreSQL db at path'''
@@ -47,10 +119,27 @@ def create_table(conn:psycopg2.extensions.connection, table:str, cols:list, dtyp
                     ', '.join(f'{col} {dtype}' for col, dtype 
                                 in zip(cols, dtypes)) + ');')
 
-def get_pages(directory_url:str):
-    '''Scrapes directory for a list of coin figurehead pages'''
-    with requests.get(directory_url) as html:
-        soup = BeautifulSoup(html.content, 'lxml')
+def request_page(url:str, retries:int=fetch_config['retries']) -> bytes:
+    '''Returns the content of url. Connection errors, timeouts and retryable 
+    statuses are retried after the server's Retry-After or a jittered 
+    exponential backoff.'''
+    for attempt in range(retries + 1):
+        try:
+            with requests.get(url, timeout=fetch_config['timeout']) as html:
+                if html.status_code not in retry_statuses:
+                    return html.content
+                if attempt == retries:
+                    html.raise_for_status()
+                delay = retry_after(html.headers.get('retry-after'))
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            delay = None
+        sleep(backoff_delay(attempt) if delay is None else min(delay, 300))
+
+def index_pages(content:bytes, directory_url:str) -> list[str]:
+    '''Returns the coin figurehead pages listed in a directory index'''
+    soup = BeautifulSoup(content, 'lxml')
     pages = []
     root = directory_url[:-6]
     for element in soup.find_all("tr"):
@@ -59,10 +148,86 @@ def get_pages(directory_url:str):
             pages.append(root + branch["href"])
     return pages
 
+def get_pages(directory_url:str):
+    '''Scrapes directory for a list of coin figurehead pages'''
+    return index_pages(request_page(directory_url), directory_url)
+
+def load_discovery(cache_file:str) -> dict:
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_discovery(cache_file:str, entries:dict):
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as cache:
+        json.dump(entries, cache)
+    os.replace(cache_file + '.tmp', cache_file)
+
+async def discover(roots:list[str], fetcher:Fetcher, cache_file:str) -> tuple[list[str], dict]:
+    '''Fetches all directory indexes concurrently and returns the pages they 
+    list, with counts of indexes unchanged and changed. Each index's pages are 
+    cached with its validators and content hash, so later runs only revalidate 
+    it, and its links are only read again when it changed. An index that 
+    can't be fetched falls back to its cached pages.'''
+    entries = load_discovery(cache_file)
+    stats = {'unchanged': 0, 'changed': 0, 'stale': 0}
+
+    async def discover_root(root:str) -> list[str]:
+        entry = entries.get(root)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        await fetcher.wait_turn(root)
+        try:
+            response = await fetcher.get(root, headers=headers)
+        except httpx.HTTPError as e:
+            if not entry:
+                raise
+            print(f'Fetch error for {root}, using the pages cached at '
+                  f'{datetime.datetime.fromtimestamp(entry["fetched"]):%Y-%m-%d %H:%M}:', e)
+            stats['stale'] += 1
+            return entry['pages']
+        if response.status_code == 304:
+            stats['unchanged'] += 1
+            entry['fetched'] = time.time()
+            return entry['pages']
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if entry and entry['content_hash'] == content_hash:
+            stats['unchanged'] += 1
+            pages = entry['pages']
+        else:
+            stats['changed'] += 1
+            pages = index_pages(response.content, root)
+        entries[root] = {'pages': pages, 'content_hash': content_hash, 'fetched': time.time(),
+                         'etag': response.headers.get('etag'),
+                         'last_modified': response.headers.get('last-modified')}
+        return pages
+
+    found = await asyncio.gather(*[discover_root(root) for root in roots])
+    save_discovery(cache_file, entries)
+    return sorted(set(page for pages in found for page in pages)), stats
+
+def discover_pages(roots:list[str]=index_roots, cache_file:str=discovery_path, transport=None) -> list[str]:
+    '''Returns the coin figurehead pages listed in the directory indexes at 
+    roots, which are requested together once per run'''
+    async def run():
+        async with Fetcher(fetch_config['requests_per_minute'], max(fetch_config['burst'], len(roots)), 
+                           timeout=fetch_config['timeout'], retries=fetch_config['retries'], 
+                           transport=transport) as fetcher:
+            return await discover(roots, fetcher, cache_file)
+    start = time.perf_counter()
+    pages, stats = asyncio.run(run())
+    print(f"Discovered {len(pages)} pages from {len(roots)} indexes in {time.perf_counter() - start:.2f}s: "
+          f"{stats['unchanged']} unchanged, {stats['changed']} changed, {stats['stale']} from cache after errors")
+    return pages
+
 def scrape_page(url: str):
     '''Returns BeautifulSoup object of url'''
-    with requests.get(url) as html:
-        soup = BeautifulSoup(html.content, 'lxml')
+    soup = BeautifulSoup(request_page(url), 'lxml')
     return soup
 
 def pull_title(soup):
@@ -118,8 +283,12 @@ def pull_coins(soup):
     coins = [coin.contents for coin in soup.find_all('tr') if len(coin) >2 and 'bgcolor' in str(coin)]
     return coins
 
-def coin_id():
-    return str(uuid.uuid4())
+def coin_id(page:str | None=None, key:str | None=None):
+    '''Returns a coin id: derived from the page URL and the coin's key on that 
+    page, so re-scrapes produce the same id, or random without a page'''
+    if page is None:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{page}#{key}'))
 
 def coin_catalog(coin):
     '''Returns catalog information (str) from individual coin (BeautifulSoup) object'''
@@ -192,14 +361,17 @@ def coin_year(coin):
 
     return min(valid_years) if valid_years else None
 
-def coin_txt(coin, title):
-    '''Returns .txt url (str) from coin (BeautifulSoup) object'''
+def coin_txt(coin, title, page:str | None=None):
+    '''Returns .txt url (str) from coin (BeautifulSoup) object, resolved against
+    the page URL if given, or else the ruler's RIC directory named by title'''
     base_url = 'https://www.wildwinds.com/coins/ric/'
     for level in [2, 1, 3, 4, 5]:
         try:
             for a in coin[level].find_all('a', href=True):
                 filename = a['href']
                 if '.txt' in filename:
+                    if page is not None:
+                        return urljoin(page, filename)
                     return base_url + title.replace(' ', '_').lower() + '/' + filename
         except:
             continue
@@ -238,117 +410,628 @@ people, each renewal indicated by numerals), "CENS" (Censor, a public office
 overseeing taxes, morality, the census and membership in various orders), 
 "BRIT" (Britannicus).'''
 
+inscriptions_list = ['AVG', 'IMP', 'CAES', 'GERM', 'COS', 'CONSVL', 'PP', 
+                     'PO', 'PF', 'SC', 'CENS', 'TPP', 'TR', 'RESTITVT', 
+                     'BRIT', 'AVGVSTVS', 'CAESAR', 'C', 'TRIB', 'POT', 'PON',
+                     'MAX', 'PM', 'SPQR', 'S P Q R', 'S-C', 'TRP', 'PAX']
+# Length of the inscriptions column
+inscriptions_size = 100
+
+def join_inscriptions(inscriptions:set[str]) -> str | None:
+    '''Returns inscriptions as 'EX1,EX2' in sorted order, leaving out those 
+    that would make it longer than the inscriptions column'''
+    joined = ''
+    for inscription in sorted(inscriptions):
+        extended = f'{joined},{inscription}' if joined else inscription
+        if len(extended) <= inscriptions_size:
+            joined = extended
+    return joined or None
+
 def coin_inscriptions(coin):
     '''Returns recognized inscriptions (str:'EX1,EX2') from coin (BeautifulSoup) object'''
-    inscriptions_list = ['AVG', 'IMP', 'CAES', 'GERM', 'COS', 'CONSVL', 'PP', 
-                         'PO', 'PF', 'SC', 'CENS', 'TPP', 'TR', 'RESTITVT', 
-                         'BRIT', 'AVGVSTVS', 'CAESAR', 'C', 'TRIB', 'POT', 'PON',
-                         'MAX', 'PM', 'SPQR', 'S P Q R', 'S-C', 'TRP', 'PAX']
     try:
         description = coin_description(coin)
         inscriptions = {i for i in inscriptions_list if f' {i} ' in description or f' {i},' in description}
-        return ','.join(sorted(list(inscriptions))) if inscriptions else None
+        return join_inscriptions(inscriptions)
     except:
         return None
 
-def coins_from_soup(soup:BeautifulSoup):
-    '''Returns a list of parsed coins as col:val dicts'''
-    title = pull_title(soup)
-    subtitle = pull_subtitle(soup)
-    coins = []
-    for coin in pull_coins(soup):
-        if coin_description(coin):
-            current_datetime = datetime.datetime.now()
-            coins.append({
-                'id':coin_id(),
-                'name':title,
-                'name_detail':subtitle,
-                'catalog':coin_catalog(coin),
-                'description':coin_description(coin),
-                'metal':coin_metal(coin),
-                'mass':coin_mass(coin),
-                'diameter':coin_diameter(coin),
-                'era':coin_era(coin),
-                'year':coin_year(coin),
-                'inscriptions':coin_inscriptions(coin),
-                'txt':coin_txt(coin, title=title),
-                'created':current_datetime,
-                'modified':current_datetime
-            })
+class CoinExtractor:
+    '''Extracts every field of a page's coin rows, reading each row's 
+    description once and matching it with precompiled patterns. Produces the 
+    same values as the individual coin_* functions.'''
+
+    era_pattern = re.compile(r'\b(AD|BC)\b')
+    year_pattern = re.compile(r'\b(AD|BC)\s*(\d{1,3})(?:/(\d{1,3})|-(\d{1,3}))?\b|'
+                              r'\b(\d{1,3})(?:/(\d{1,3})|-(\d{1,3}))?\s*(AD|BC)\b')
+    mass_pattern = re.compile(r'(\d+((\.|\,|\-)\d+)?)\s?(?:g|gm|gr)\b')
+    diameter_pattern = re.compile(r'(\d{1,2}(\.\d+)?)\s?(?:mm)')
+    # Zero-width, so inscriptions sharing a space (e.g. ' AVG CAES ') all match
+    inscription_pattern = re.compile(
+        r'(?= (' + '|'.join(re.escape(i) for i in inscriptions_list) + r')[ ,])')
+
+    def __init__(self, title:str | None, subtitle:str | None, page:str | None=None):
+        self.title = title
+        self.subtitle = subtitle
+        self.page = page
+        self.rows = 0
+        self.catalogs = {}
+
+    def key(self, catalog:str | None) -> str:
+        '''Returns the next row's key on its page: its catalog number and how 
+        many rows before it share that number, or its position if it has none'''
+        self.rows += 1
+        if not catalog:
+            return f'row-{self.rows}'
+        self.catalogs[catalog] = self.catalogs.get(catalog, 0) + 1
+        return f'{catalog}-{self.catalogs[catalog]}'
+
+    def extract(self, coin) -> dict | None:
+        '''Returns a coin's fields as col:val dicts, or None if it has no description'''
+        catalog = coin_catalog(coin)
+        key = self.key(catalog)
+        description = coin_description(coin)
+        if not description:
+            return None
+        current_datetime = datetime.datetime.now()
+        era = self.era_pattern.search(description)
+        return {
+            'id':coin_id(self.page, key),
+            'name':self.title,
+            'name_detail':self.subtitle,
+            'catalog':catalog,
+            'description':description,
+            'metal':coin_metal(coin),
+            'mass':self.mass(description),
+            'diameter':self.diameter(description),
+            'era':era.group(0) if era else None,
+            'year':self.year(description),
+            'inscriptions':self.inscriptions(description),
+            'txt':coin_txt(coin, title=self.title, page=self.page),
+            'created':current_datetime,
+            'modified':current_datetime
+        }
+
+    def year(self, description:str) -> int | None:
+        valid_years = []
+        for match in self.year_pattern.finditer(description):
+            era1, start_year1, _, _, start_year2, _, _, era2 = match.groups()
+            era = era1 or era2
+            year = int(start_year1 or start_year2)
+            if year and -50 <= year <= 500:
+                valid_years.append(year if era != 'BC' else -year)
+        return min(valid_years) if valid_years else None
+
+    def mass(self, description:str) -> float | None:
+        match = self.mass_pattern.search(description)
+        if not match:
+            return None
+        mass = float(match.group(1).replace(',', '.').replace('-', '.'))
+        return mass if 0 < mass < 50 else None
+
+    def diameter(self, description:str) -> float | None:
+        match = self.diameter_pattern.search(description)
+        if not match:
+            return None
+        diameter = float(match.group(1))
+        return diameter if 0 < diameter <= 50 else None
 
+    def inscriptions(self, description:str) -> str | None:
+        return join_inscriptions({match.group(1) for match in self.inscription_pattern.finditer(description)})
+
+def coins_from_soup(soup, page:str | None=None):
+    '''Returns a list of parsed coins as col:val dicts from a document of either 
+    parser backend, with ids derived from the page URL if given'''
+    title = pull_title(soup)
+    extractor = CoinExtractor(title, pull_subtitle(soup), page)
+    coins = [coin for coin in map(extractor.extract, pull_coins(soup)) if coin]
     return coins if coins else None
 
-def load_coins(coins:list[dict] | None, conn:psycopg2.extensions.connection, table:str, commit:bool=True):
-    '''Loads a list of coins into a postgres table using SQL INSERT statements'''
+def is_coin_row(row) -> bool:
+    '''Returns whether a table row holds a coin, as pull_coins decides, but by 
+    looking for a bgcolor attribute rather than rendering the row to a string'''
+    return len(row) > 2 and (row.get('bgcolor') is not None or row.find(bgcolor=True) is not None)
+
+def stream_coins(chunks:Iterable[bytes], page:str | None=None) -> Iterator[dict]:
+    '''Yields parsed coins as col:val dicts one row at a time while a page's raw 
+    html arrives in chunks, keeping only the latest chunk's rows in memory. The 
+    name and subtitle are read from the markup before the first row.'''
+    extractor = None
+    for document, row in stream_rows(chunks):
+        if extractor is None:
+            extractor = CoinExtractor(pull_title(document), pull_subtitle(document), page)
+        if is_coin_row(row):
+            coin = extractor.extract(row.contents)
+            if coin:
+                yield coin
+
+def parse_page(content:bytes, backend:str=parser_backend, page:str | None=None):
+    '''Returns a list of parsed coins from a page's raw html. The 'stream' 
+    backend extracts them row by row from chunks of the fetched content 
+    instead of building the whole tree.'''
+    if backend == 'stream':
+        chunks = (content[i:i + 65536] for i in range(0, len(content), 65536))
+        return list(stream_coins(chunks, page)) or None
+    return coins_from_soup(parse_html(content, backend), page)
+
+def decode_txt(content:bytes) -> str:
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('windows-1252', errors='replace')
+
+def txt_fields(content:bytes) -> dict:
+    '''Returns the fields found in a coin's .txt detail file'''
+    text = ' '.join(decode_txt(content).split())
+    extractor = CoinExtractor(None, None)
+    era = extractor.era_pattern.search(text)
+    return {'mass': extractor.mass(text),
+            'diameter': extractor.diameter(text),
+            'era': era.group(0) if era else None,
+            'year': extractor.year(text),
+            'inscriptions': extractor.inscriptions(text)}
+
+def merge_txt(coin:dict, fields:dict) -> bool:
+    '''Fills a coin's missing fields from its .txt fields and adds their 
+    inscriptions to its own. Returns whether the coin changed.'''
+    changed = False
+    for col in ('mass', 'diameter', 'era', 'year'):
+        if coin.get(col) is None and fields[col] is not None:
+            coin[col] = fields[col]
+            changed = True
+    if fields['inscriptions']:
+        inscriptions = set(filter(None, (coin.get('inscriptions') or '').split(',')))
+        merged = join_inscriptions(inscriptions | set(fields['inscriptions'].split(',')))
+        if merged != coin.get('inscriptions'):
+            coin['inscriptions'] = merged
+            changed = True
+    return changed
+
+async def enrich_coins(coins:list[dict], fetcher:Fetcher, cache:PageArchive, 
+                       concurrency:int=txt_config['concurrency']) -> dict[str, int]:
+    '''Merges the fields of each coin's .txt detail file into the coin. Files 
+    are fetched concurrently within the fetcher's politeness budget and kept 
+    in cache. Returns counts of files cached, fetched, missing and failed, and 
+    of coins enriched.'''
+    contents, stats = await fetch_files([coin['txt'] for coin in coins if coin.get('txt')], 
+                                        fetcher, cache, concurrency)
+    stats['enriched'] = sum(1 for coin in coins 
+                            if coin.get('txt') in contents and merge_txt(coin, txt_fields(contents[coin['txt']])))
+    return stats
+
+def notify_change(cur, op:str, count:int, ids:list[str]):
+    '''Queues change notifications on the cursor's transaction, naming the 
+    changed coins when their ids are known, so the API's change feed reads 
+    them however late the transaction commits'''
+    if not ids:
+        cur.execute('SELECT pg_notify(%s, %s)', (change_channel, json.dumps({'op':op, 'count':count})))
+    for start in range(0, len(ids), notify_ids):
+        chunk = ids[start:start + notify_ids]
+        cur.execute('SELECT pg_notify(%s, %s)', 
+                    (change_channel, json.dumps({'op':op, 'count':len(chunk), 'ids':chunk})))
+
+def coin_hash(coin:dict) -> str:
+    '''Returns a fingerprint of a coin's scraped content'''
+    content = {col: val for col, val in coin.items() if col not in ('id', 'created', 'modified')}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+def changed_coins(coins:list[dict], conn:psycopg2.extensions.connection, hashes:str) -> tuple[list, dict, dict]:
+    '''Returns the coins whose fingerprint differs from the one stored in the 
+    hashes table, each coin's fingerprint, and how many were skipped, changed 
+    and added'''
+    fingerprints = {coin['id']: coin_hash(coin) for coin in coins}
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f'SELECT id, row_hash FROM {hashes} WHERE id = ANY(%s)', (list(fingerprints),))
+        stored = {row['id']: row['row_hash'] for row in cur.fetchall()}
+    changed = [coin for coin in coins if stored.get(coin['id']) != fingerprints[coin['id']]]
+    counts = {'skipped': len(coins) - len(changed),
+              'changed': sum(1 for coin in changed if coin['id'] in stored),
+              'added': sum(1 for coin in changed if coin['id'] not in stored)}
+    return changed, fingerprints, counts
+
+def load_coins(coins:list[dict] | None, conn:psycopg2.extensions.connection, table:str, commit:bool=True, 
+               hashes:str | None=None):
+    '''Bulk loads a list of coins into a postgres table through a staging table. 
+    Coins already in the table are only updated (and their modified time moved 
+    forward) when their content changed; coins that can't be loaded are 
+    quarantined in the table's reject table. With a hashes table, coins whose 
+    fingerprint is unchanged are skipped before loading.'''
+    if not coins:
+        return None
     try:
-        cur = conn.cursor()
-        for coin in coins:
-            columns = ', '.join(coin.keys())
-            placeholders = ', '.join(f'%({col})s' for col in coin.keys())
-            query = f'INSERT INTO {table} ({columns}) VALUES ({placeholders});'
-            cur.execute(query, coin)
+        counts = {}
+        if hashes:
+            coins, fingerprints, counts = changed_coins(coins, conn, hashes)
+        stats = bulk_load(conn, table, coins, keep=('created',), touch='modified')
+        with conn.cursor() as cur:
+            for op, count, inserted in (('insert', stats['inserted'], True), ('update', stats['updated'], False)):
+                if count:
+                    notify_change(cur, op, count, [row['id'] for row in stats['written'] 
+                                                   if row['inserted'] == inserted and 'id' in row])
+            if hashes:
+                rejected = {id(record) for record, _ in stats['rejects']}
+                checked = datetime.datetime.now()
+                execute_values(cur, f'INSERT INTO {hashes} (id, row_hash, checked) VALUES %s '
+                                    'ON CONFLICT (id) DO UPDATE SET row_hash = EXCLUDED.row_hash, checked = EXCLUDED.checked',
+                               [(coin['id'], fingerprints[coin['id']], checked) 
+                                for coin in coins if id(coin) not in rejected])
         if commit:
-            conn.commit()            
+            conn.commit()
     except psycopg2.Error as e:
         print('Load error:', e)
         conn.rollback()
+        return None
+    stats.update(counts)
+    rate = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+    skipped = f"{stats['skipped']} skipped unchanged, " if hashes else ''
+    print(f"loaded {stats['rows']} coins in {stats['seconds']:.3f}s ({rate:.0f} rows/s): {skipped}{stats['inserted']} new, "
+          f"{stats['updated']} updated, {stats['unchanged']} unchanged, {stats['rejected']} rejected")
+    return stats
+
+def scrape_and_load(conn:psycopg2.extensions.connection, frontier:Frontier, table:str, 
+                    requests_per_minute:float=fetch_config['requests_per_minute'], 
+                    burst:int=fetch_config['burst'], 
+                    max_connections:int=fetch_config['max_connections'], 
+                    min_requests_per_minute:float | None=fetch_config['min_requests_per_minute'], 
+                    max_requests_per_minute:float | None=fetch_config['max_requests_per_minute'], 
+                    retries:int=fetch_config['retries'], 
+                    cache_dir:str | None=cache_path, 
+                    archive_dir:str | None=archive_path, 
+                    txt_cache_dir:str | None=txt_config['cache_dir'], 
+                    txt_concurrency:int=txt_config['concurrency'], 
+                    telemetry_path:str | None=telemetry_config['log_path'], 
+                    metrics_path:str | None=telemetry_config['metrics_path'], 
+                    parse_workers:int=pipeline_config['parse_workers'], 
+                    load_batch_size:int=pipeline_config['load_batch_size'], 
+                    load_batch_seconds:float=pipeline_config['load_batch_seconds'], 
+                    queue_size:int=pipeline_config['queue_size'], transport=None):
+    '''Composite function scrapes the frontier's pages for coins and loads them into 
+    postgres table. Pages are parsed in a pool of parse_workers processes, or on 
+    one thread if 0. With an archive_dir, fetched pages are archived. With a 
+    txt_cache_dir, coins are enriched from their .txt detail files. Each page's 
+    metrics are logged to telemetry_path and exported to metrics_path.'''
+    cache = HttpCache(cache_dir) if cache_dir else None
+    archive = PageArchive(archive_dir) if archive_dir else None
+    txt_cache = PageArchive(txt_cache_dir) if txt_cache_dir else None
+    fetcher = Fetcher(requests_per_minute, burst, max_connections, timeout=fetch_config['timeout'], 
+                      transport=transport, cache=cache, min_requests_per_minute=min_requests_per_minute, 
+                      max_requests_per_minute=max_requests_per_minute, retries=retries)
+    telemetry = Telemetry(telemetry_path, metrics_path, telemetry_config['export_interval'])
+    if parse_workers:
+        executor = ProcessPoolExecutor(parse_workers)
+    else:
+        executor = ThreadPoolExecutor(1)
+    try:
+        with executor:
+            stats = asyncio.run(crawl(conn, frontier, table, fetcher, executor, 
+                                      max(parse_workers, 1), load_batch_size, queue_size, archive, 
+                                      txt_cache, txt_concurrency, telemetry, load_batch_seconds))
     finally:
-        cur.close()
-
-def check_state(path:str):
-    '''Returns last row of csv state file if it exists, else None'''
-    if os.path.exists(path):
-        with open(path) as state_file:
-            reader = csv.reader(state_file)
-            rows = [row for row in reader]
-        state = rows[-1][0]
-        if state == 'Scraping/Loading complete':
-            print('Scraping already completed. Exiting.')
-            exit()
-        return state
-    return None
-        
-def update_state(path:str, input:str):
-    ''' Creates csv state file if one doesn't exist; appends it with input'''
-    with open(path, 'a') as state:
-        w = csv.writer(state)
-        w.writerow([input])
-
-def scrape_and_load(conn:psycopg2.extensions.connection, state_path:str | None, pages:list[str], table:str, delay:int=30):
-    '''Composite function scrapes a page for coins and loads them into postgres table'''
-    state = check_state(state_path)
-    if state is not None:
-        checkpoint = pages.index(state) + 1
+        telemetry.close()
+    for line in stats + telemetry.report():
+        print(line)
+    if cache:
+        print(cache.report())
+    for line in fetcher.report():
+        print(line)
+
+def replay_page(path:str, page:str, backend:str=parser_backend):
+    '''Returns a list of parsed coins from an archived page'''
+    return parse_page(read_page(path), backend, page)
+
+def replay(conn:psycopg2.extensions.connection, table:str, archive_dir:str=archive_path, 
+           parse_workers:int=pipeline_config['parse_workers'], 
+           load_batch_size:int=pipeline_config['load_batch_size']) -> dict:
+    '''Rebuilds the table from archived pages without network access. Pages are 
+    decompressed and parsed in a pool of parse_workers processes (one thread 
+    if 0), and their coins loaded in batches of about load_batch_size; only 
+    coins whose content changed are written. Returns counts of pages, coins 
+    and failures, and the time taken.'''
+    entries = PageArchive(archive_dir).entries()
+    print(f'replaying {len(entries)} archived pages from {archive_dir}...')
+    stats = {'pages': len(entries), 'coins': 0, 'parse_errors': 0, 'load_errors': 0}
+    start = time.perf_counter()
+    if parse_workers:
+        executor = ProcessPoolExecutor(parse_workers)
     else:
-        checkpoint = 0
-    for page in pages[checkpoint:]:
-        print(f'requesting {page} ({pages.index(page) + 1}/{len(pages)})')
-        sleep(delay)
-        soup = scrape_page(page)
-        coins = coins_from_soup(soup)
+        executor = ThreadPoolExecutor(1)
+    with executor:
+        futures = [executor.submit(replay_page, entry['path'], entry['url']) for entry in entries]
+        batch = []
+        for entry, future in zip(entries, futures):
+            try:
+                batch.extend(future.result() or [])
+            except Exception as e:
+                print(f'Parse error for {entry["url"]}:', e)
+                stats['parse_errors'] += 1
+            if batch and (len(batch) >= load_batch_size or future is futures[-1]):
+                if load_coins(batch, conn, table, hashes=f'{table}_hashes') is None:
+                    stats['load_errors'] += len(batch)
+                stats['coins'] += len(batch)
+                batch = []
+    stats['seconds'] = time.perf_counter() - start
+    print(f"Replay complete: {stats['coins']} coins from {stats['pages']} pages in {stats['seconds']:.2f}s, "
+          f"{stats['parse_errors']} parse errors, {stats['load_errors']} coins not loaded")
+    return stats
+
+class StageStats:
+    '''Throughput of a pipeline stage and depth of the queue feeding it'''
+
+    def __init__(self, name:str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.depths = []
+
+    def sample(self, queue:asyncio.Queue | None):
+        if queue is not None:
+            self.depths.append(queue.qsize())
+
+    def record(self, items:int, start:float):
+        self.items += items
+        self.busy += time.perf_counter() - start
+
+    def report(self, elapsed:float) -> str:
+        line = (f'{self.name}: {self.items} in {self.busy:.2f}s busy, '
+                f'{self.items / elapsed if elapsed else 0:.2f}/s overall')
+        if self.depths:
+            line += (f', queue depth mean {sum(self.depths) / len(self.depths):.1f} '
+                     f'max {max(self.depths)}')
+        return line
+
+async def crawl(conn:psycopg2.extensions.connection, frontier:Frontier, table:str, 
+                fetcher:Fetcher, executor, parse_workers:int=1, load_batch_size:int=500, 
+                queue_size:int=8, archive:PageArchive | None=None, 
+                txt_cache:PageArchive | None=None, txt_concurrency:int=4, 
+                telemetry:Telemetry | None=None, load_batch_seconds:float=0) -> list[str]:
+    '''Runs pages claimed from the frontier through fetch, parse, and load 
+    stages connected by bounded queues, so a slow stage holds back the ones 
+    before it. Pages are fetched concurrently within the fetcher's politeness 
+    budget, parsed in executor, and loaded in batches of about load_batch_size 
+    coins, or of the pages ready within load_batch_seconds. Pages whose content 
+    hash matches the last crawl aren't parsed, and coins whose fingerprint is 
+    unchanged aren't written. Each batch's coins are loaded and its pages 
+    marked done in one transaction, so a crash never leaves a page loaded but 
+    not done; it's crawled again from the last batch. Fetched pages are saved to 
+    archive, if given. With a txt_cache, an enrich stage between parse and 
+    load merges each coin's .txt detail file into it. Each page's timings and 
+    coins are recorded in telemetry. Returns a report line per stage.'''
+    loop = asyncio.get_running_loop()
+    telemetry = telemetry or Telemetry()
+    total = (await asyncio.to_thread(frontier.progress))['total']
+    # Items are (page, content or coins, response headers, content hash, 
+    # metrics); content and coins are None for pages that haven't changed
+    fetched = asyncio.Queue(queue_size)
+    parsed = asyncio.Queue(queue_size)
+    enriched = asyncio.Queue(queue_size) if txt_cache else parsed
+    stages = ('fetch pages', 'parse pages') + (('enrich coins',) if txt_cache else ()) + ('load coins',)
+    stats = {stage: StageStats(stage) for stage in stages}
+    txt_files = {'cached': 0, 'fetched': 0, 'missing': 0, 'failed': 0, 'enriched': 0}
+    pages = {'skipped': 0, 'changed': 0, 'added': 0}
+    rows = dict(pages)
+
+    async def fetch_stage():
+        while True:
+            claimed = await asyncio.to_thread(frontier.claim)
+            if not claimed:
+                return
+            page = claimed[0]['url']
+            start = time.perf_counter()
+            await fetcher.wait_turn(page)
+            metrics = {'wait_seconds': time.perf_counter() - start}
+            print(f'requesting {page} ({claimed[0]["position"] + 1}/{total})')
+            start = time.perf_counter()
+            try:
+                response = await fetcher.get(page)
+            except httpx.HTTPError as e:
+                print(f'Fetch error for {page}:', e)
+                stats['fetch pages'].record(1, start)
+                error = str(e) or type(e).__name__
+                telemetry.record(page, 'failed', stage='fetch', error=error, 
+                                 fetch_seconds=time.perf_counter() - start, **metrics)
+                await asyncio.to_thread(frontier.failed, page, error)
+                continue
+            metrics.update(fetch_seconds=time.perf_counter() - start, http_status=response.status_code, 
+                           bytes=len(response.content))
+            previous_hash = claimed[0]['content_hash']
+            if response.status_code == 304:
+                print(f'unchanged {page}, skipping')
+                pages['skipped'] += 1
+                item = (page, None, None, None, metrics)
+            else:
+                content_hash = hashlib.sha256(response.content).hexdigest()
+                if archive:
+                    await asyncio.to_thread(archive.store, page, response.content, content_hash)
+                if content_hash == previous_hash:
+                    # Same content as the last crawl, so there's nothing new to parse
+                    print(f'unchanged content {page}, skipping')
+                    pages['skipped'] += 1
+                    item = (page, None, response.headers, content_hash, metrics)
+                else:
+                    pages['changed' if previous_hash else 'added'] += 1
+                    item = (page, response.content, response.headers, content_hash, metrics)
+            stats['fetch pages'].record(1, start)
+            await fetched.put(item)
+
+    async def parse_stage():
+        while True:
+            stats['parse pages'].sample(fetched)
+            item = await fetched.get()
+            if item is None:
+                return
+            page, content, headers, content_hash, metrics = item
+            if content is not None:
+                start = time.perf_counter()
+                try:
+                    content = await loop.run_in_executor(executor, partial(parse_page, content, page=page))
+                except Exception as e:
+                    print(f'Parse error for {page}:', e)
+                    telemetry.record(page, 'failed', stage='parse', error=str(e), 
+                                     parse_seconds=time.perf_counter() - start, **metrics)
+                    await asyncio.to_thread(frontier.failed, page, f'parse error: {e}')
+                    continue
+                finally:
+                    stats['parse pages'].record(1, start)
+                metrics['parse_seconds'] = time.perf_counter() - start
+            await parsed.put((page, content, headers, content_hash, metrics))
+
+    async def enrich_stage():
+        while True:
+            stats['enrich coins'].sample(parsed)
+            item = await parsed.get()
+            if item is None:
+                return
+            if item[1]:
+                start = time.perf_counter()
+                counts = await enrich_coins(item[1], fetcher, txt_cache, txt_concurrency)
+                stats['enrich coins'].record(len(item[1]), start)
+                item[4]['enrich_seconds'] = time.perf_counter() - start
+                for outcome in txt_files:
+                    txt_files[outcome] += counts[outcome]
+            await enriched.put(item)
+
+    def commit_batch(coins:list[dict], done:list[tuple[str, str | None]]) -> dict | None:
+        '''Loads coins and marks pages done in one transaction. Returns the load
+        stats, or None if it was rolled back.'''
+        loaded = {}
+        if coins:
+            loaded = load_coins(coins, conn, table, commit=False, hashes=f'{table}_hashes')
+            if loaded is None:
+                return None
+        try:
+            frontier.done_batch(conn, done)
+            conn.commit()
+        except psycopg2.Error as e:
+            print('Load error:', e)
+            conn.rollback()
+            return None
+        return loaded
+
+    async def load_batch(batch:list[tuple]):
+        coins = [coin for _, page_coins, _, _, _ in batch for coin in page_coins or []]
         if coins:
             print(f'loading {len(coins)} coins into database {db_info["db_name"]} as {db_info["db_user"]}...')
-            load_coins(coins, conn, table)
-        update_state(state_path, page)
-    message = 'Scraping/Loading complete'
-    update_state(state_path, message)
-    print(f'{message}: {len(pages)} pages')
+        start = time.perf_counter()
+        loaded = await asyncio.to_thread(commit_batch, coins, [(page, content_hash) 
+                                                               for page, _, _, content_hash, _ in batch])
+        load_seconds = time.perf_counter() - start
+        if coins:
+            stats['load coins'].record(len(coins), start)
+        if loaded:
+            for outcome in rows:
+                rows[outcome] += loaded[outcome]
+        for page, page_coins, headers, content_hash, metrics in batch:
+            if page_coins:
+                # The page's share of its batch's load
+                metrics['load_seconds'] = load_seconds * len(page_coins) / len(coins)
+            if loaded is None:
+                telemetry.record(page, 'failed', page_coins, stage='load', error='load error', **metrics)
+                await asyncio.to_thread(frontier.failed, page, 'load error')
+                continue
+            if fetcher.cache and headers is not None:
+                fetcher.cache.store(page, headers)
+            telemetry.record(page, 'done' if 'parse_seconds' in metrics else 'unchanged', page_coins, **metrics)
+
+    async def load_stage():
+        batch, opened = [], 0.0
+        while True:
+            stats['load coins'].sample(enriched)
+            timeout = None
+            if batch and load_batch_seconds:
+                timeout = max(opened + load_batch_seconds - time.monotonic(), 0)
+            try:
+                item = await asyncio.wait_for(enriched.get(), timeout)
+            except asyncio.TimeoutError:
+                item = False
+            if item:
+                if not batch:
+                    opened = time.monotonic()
+                batch.append(item)
+            coins = sum(len(page_coins or []) for _, page_coins, _, _, _ in batch)
+            # Load once the batch is full or has been open long enough, or with 
+            # no time threshold whenever nothing else is ready yet
+            if load_batch_seconds:
+                due = time.monotonic() - opened >= load_batch_seconds
+            else:
+                due = enriched.empty()
+            if batch and (not item or due or coins >= load_batch_size):
+                await load_batch(batch)
+                batch = []
+            if item is None:
+                return
+
+    async def run_stages(stage, workers:int, downstream:asyncio.Queue, downstream_workers:int):
+        await asyncio.gather(*[stage() for _ in range(workers)])
+        for _ in range(downstream_workers):
+            await downstream.put(None)
+
+    start = time.perf_counter()
+    async with fetcher:
+        tasks = [asyncio.create_task(run_stages(fetch_stage, fetcher.max_connections, fetched, parse_workers)),
+                 asyncio.create_task(run_stages(parse_stage, parse_workers, parsed, 1)),
+                 asyncio.create_task(load_stage())]
+        if txt_cache:
+            tasks.append(asyncio.create_task(run_stages(enrich_stage, 1, enriched, 1)))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    elapsed = time.perf_counter() - start
+    progress = await asyncio.to_thread(frontier.progress)
+    print(f"Scraping/Loading complete: {progress['done']} of {progress['total']} pages done, "
+          f"{progress['failed']} failed, {progress['claimed']} claimed by other scrapers")
+    print(f"pages: {pages['skipped']} skipped unchanged, {pages['changed']} changed, {pages['added']} added; "
+          f"coins: {rows['skipped']} skipped unchanged, {rows['changed']} changed, {rows['added']} added")
+    if txt_cache:
+        print(f".txt files: {txt_files['fetched']} fetched, {txt_files['cached']} cached, "
+              f"{txt_files['missing']} missing, {txt_files['failed']} failed; {txt_files['enriched']} coins enriched")
+    return [stage.report(elapsed) for stage in stats.values()]
 
-def main():
+def main(replay_dir:str | None=None, recrawl_minutes:float | None=None):
     '''Scrapes, processes, and loads data from over 200 page requests, which 
-    takes a couple hours due to required 30-second delay between requests)'''
+    takes a couple hours due to required 30-second delay between requests 
+    (the default rate, and unless SCRAPER_MAX_REQUESTS_PER_MINUTE is raised, 
+    the fastest the rate adapts to). Several scrapers can run at once; they share the crawl frontier. With 
+    recrawl_minutes, pages crawled longer ago than that are crawled again, 
+    revalidating them against the HTTP cache and their last content hash. 
+    With a replay_dir, the data is instead rebuilt from the pages archived there.'''
     with connect_db(**db_info) as conn:
         create_table(conn, table_name, table_columns, column_dtypes)
+        create_table(conn, f'{table_name}_hashes', hash_columns, hash_dtypes)
+        # The API pages through coins in (modified, id) order along this index
+        with conn.cursor() as cur:
+            cur.execute(f'CREATE INDEX IF NOT EXISTS {table_name}_modified_idx ON {table_name} (modified, id)')
     conn.close()
-    print("Sourcing Roman Empire coin pages...")
-    empire_pages = list(set(get_pages('https://www.wildwinds.com/coins/ric/i.html')))
-    sleep(30)
-    print("Sourcing Roman Republic coin pages...")
-    republic_pages = list(set(get_pages('https://www.wildwinds.com/coins/rsc/i.html')))
-    combined_pages = sorted(empire_pages + republic_pages)
+    if replay_dir:
+        with connect_db(**db_info) as conn:
+            replay(conn, table_name, replay_dir)
+        conn.close()
+        return
+    frontier = Frontier(lambda: connect_db(**db_info))
+    frontier.create()
+    print("Sourcing Roman Empire and Roman Republic coin pages...")
+    combined_pages = discover_pages()
+    print(f'{frontier.add(combined_pages)} new pages added to the crawl frontier')
+    if recrawl_minutes is not None:
+        print(f'{frontier.requeue(recrawl_minutes)} crawled pages requeued to be recrawled')
+    if not frontier.remaining():
+        print('Scraping already completed. Exiting.')
+        frontier.close()
+        return
     with connect_db(**db_info) as conn:
-        scrape_and_load(conn, state_path, combined_pages, table_name)
+        scrape_and_load(conn, frontier, table_name)
     conn.close()
+    frontier.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Scrapes Roman coins from wildwinds.com into postgres')
+    parser.add_argument('--replay', nargs='?', const=archive_path, metavar='ARCHIVE_DIR',
+                        help='rebuild the data from archived pages instead of crawling '
+                             f'(default archive: {archive_path})')
+    parser.add_argument('--recrawl', nargs='?', type=float, const=0, metavar='MAX_AGE_MINUTES',
+                        help='crawl again the pages last fetched more than MAX_AGE_MINUTES ago '
+                             '(default: all), skipping those that have not changed')
+    args = parser.parse_args()
+    main(args.replay, args.recrawl)